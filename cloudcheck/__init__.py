@@ -1,3 +1,80 @@
-from .cloudcheck import CloudCheck
+import os
 
-__all__ = ["CloudCheck"]
+from .buckets import BucketMatch, BucketMatcher
+from .classify import classify
+from .pure import PureCloudCheck
+from .stream import lookup_stream
+
+try:
+    if os.getenv("CLOUDCHECK_PURE_PYTHON"):
+        raise ImportError("CLOUDCHECK_PURE_PYTHON is set")
+    from .cloudcheck import CloudCheck as _CloudCheck, Provider
+except ImportError:
+    # no compiled extension for this platform or interpreter
+    _CloudCheck = None
+    Provider = None
+
+
+if _CloudCheck is None:
+    CloudCheck = PureCloudCheck
+else:
+
+    class CloudCheck(_CloudCheck):
+        def lookup_stream(self, targets, concurrency=4, chunk_size=1000):
+            """
+            Asynchronously iterate over (target, providers) for every target in a
+            sync or async iterable, e.g.:
+
+                async for target, providers in cloudcheck.lookup_stream(open("hosts.txt")):
+                    ...
+            """
+            return lookup_stream(self, targets, concurrency, chunk_size)
+
+        def classify(
+            self, source, batch_size=1000, window=100_000, only_hits=True, **kwargs
+        ):
+            """
+            Iterate over (line_number, line, hits) for the lines of a log file or
+            other text, where hits maps each IP and hostname found in the line to
+            its providers, e.g.:
+
+                for line_number, line, hits in cloudcheck.classify(open("access.log", "rb")):
+                    ...
+            """
+            return classify(self, source, batch_size, window, only_hits, **kwargs)
+
+        def lookup_ip_array(self, addresses, tags=False):
+            """
+            Look up a NumPy array of packed IP addresses: uint32 for IPv4, or an
+            (N, 2) uint64 array of (high, low) halves for IPv6.
+
+            Returns a uint32 array of provider ids (0 for no match; see
+            provider_names()), plus a uint64 array of tag masks (see tag_names())
+            if tags=True. Contiguous input is not copied.
+            """
+            import numpy as np
+
+            addresses = np.ascontiguousarray(addresses)
+            if addresses.dtype == np.uint32 and addresses.ndim == 1:
+                lookup_into = self.lookup_ipv4_into
+            elif addresses.dtype == np.uint64 and addresses.shape[1:] == (2,):
+                lookup_into = self.lookup_ipv6_into
+            else:
+                raise ValueError(
+                    "addresses must be a uint32 array (IPv4) or an (N, 2) uint64 array (IPv6)"
+                )
+            provider_ids = np.zeros(len(addresses), dtype=np.uint32)
+            tag_masks = np.zeros(len(addresses), dtype=np.uint64) if tags else None
+            lookup_into(addresses, provider_ids, tag_masks)
+            if tags:
+                return provider_ids, tag_masks
+            return provider_ids
+
+
+__all__ = [
+    "BucketMatch",
+    "BucketMatcher",
+    "CloudCheck",
+    "Provider",
+    "PureCloudCheck",
+]
@@ -0,0 +1,5 @@
+import sys
+
+from cloudcheck.cli import main
+
+sys.exit(main())
@@ -0,0 +1,251 @@
+"""
+ASNDB lookups for the updater, deduplicated and cached.
+
+Every org ID and ASN is requested at most once per run, however many
+providers ask for it: concurrent lookups of the same key share one request.
+Responses are also kept on disk (one JSON file per key), so a rerun only
+refetches entries older than the TTL, and those with a conditional request
+when ASNDB sent an ETag or Last-Modified.
+
+Many values can be resolved per request from a bulk endpoint when the server
+has one (see lookup_many()). The public ASNDB has no such endpoint, so this is
+opt-in: pass bulk=True or set CLOUDCHECK_ASNDB_BULK=1.
+cloudcheck_update.asndb_server is a local stand-in server for testing and
+benchmarking both paths.
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from urllib.parse import quote, urlsplit
+
+from .scheduler import get_scheduler
+
+# seconds an ASNDB response is used without asking ASNDB again
+ASNDB_TTL = float(os.getenv("CLOUDCHECK_ASNDB_TTL", 20 * 60 * 60))
+# bulk endpoint: GET {url}/bulk/{kind}?ids=a,b,c returns
+# {"results": {"a": record, ...}}, leaving out values it does not know
+ASNDB_BULK_PATH = "bulk"
+# whether clients use the bulk endpoint unless told otherwise
+ASNDB_BULK = os.getenv("CLOUDCHECK_ASNDB_BULK", "").lower() in ("1", "true", "yes")
+
+
+class ASNDB:
+    """
+    An ASNDB client whose lookups return futures of the parsed JSON records.
+    Requests go through the shared scheduler; cache_dir defaults to
+    ~/.cache/cloudcheck/asndb/<ASNDB host>. Unless bulk=True (the default
+    is ASNDB_BULK), every value is requested from its own endpoint.
+    """
+
+    def __init__(self, url, cache_dir=None, ttl=ASNDB_TTL, bulk=None, batch_size=100):
+        self.url = url.rstrip("/")
+        self.bulk = ASNDB_BULK if bulk is None else bulk
+        self.batch_size = batch_size
+        # whether the bulk endpoint of each kind works, once known
+        self._bulk = {}
+        if cache_dir is None:
+            # one directory per ASNDB server, so a test server never mixes in
+            cache_dir = (
+                Path.home()
+                / ".cache"
+                / "cloudcheck"
+                / "asndb"
+                / quote(urlsplit(self.url).netloc, safe="")
+            )
+        self.cache_dir = Path(cache_dir)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # futures of this run's lookups, by (kind, value)
+        self._futures = {}
+
+    def org(self, org_id, key=None):
+        """Future of the ASNDB record of an org ID ({"asns": [...], ...})."""
+        return self.lookup("org", org_id, key=key)
+
+    def asn(self, asn, key=None):
+        """Future of the ASNDB record of an ASN ({"subnets": [...], ...})."""
+        return self.lookup("asn", asn, key=key)
+
+    def lookup(self, kind, value, key=None):
+        """
+        Future of the ASNDB record at /{kind}/{value}. key is the scheduler
+        queue to use (the provider name) if a request is needed.
+        """
+        return self.lookup_many(kind, [value], key=key)[value]
+
+    def lookup_many(self, kind, values, key=None):
+        """
+        Futures of the ASNDB records of many values of one kind, by value.
+        Values that are neither in flight nor cached are requested in batches
+        of batch_size from the bulk endpoint (see ASNDB_BULK_PATH) if bulk is
+        enabled, and one by one otherwise, or once the bulk endpoint has
+        failed.
+        """
+        futures = {}
+        missing = []
+        for value in values:
+            future, new = self._claim(kind, value)
+            futures[value] = future
+            if not new:
+                continue
+            cached = self._read_cache(self._cache_path(kind, value))
+            if cached is not None and time.time() - cached["fetched"] < self.ttl:
+                future.set_result(cached["data"])
+            else:
+                missing.append((value, future, cached))
+        if len(missing) > 1 and self._bulk.get(kind, self.bulk):
+            for i in range(0, len(missing), self.batch_size):
+                self._fetch_bulk(kind, missing[i : i + self.batch_size], key)
+        else:
+            for value, future, cached in missing:
+                self._fetch(kind, value, future, cached, key)
+        return futures
+
+    def _claim(self, kind, value):
+        """The future of a lookup, and whether this caller has to resolve it."""
+        cache_key = (kind, str(value))
+        with self._lock:
+            future = self._futures.get(cache_key)
+            if future is not None:
+                return future, False
+            future = Future()
+            self._futures[cache_key] = future
+        future.set_running_or_notify_cancel()
+        future.add_done_callback(lambda f: self._forget_failure(cache_key, f))
+        return future, True
+
+    def _fetch(self, kind, value, future, cached, key):
+        headers = {"x-rate-limit-blocking": "true"}
+        if cached is not None:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+        url = f"{self.url}/{kind}/{quote(str(value), safe='')}"
+        print(f"Fetching {url}")
+        response = get_scheduler().submit(
+            url, key=key, include_api_key=True, headers=headers
+        )
+        cache_path = self._cache_path(kind, value)
+        response.add_done_callback(
+            lambda f: self._on_response(f, future, cache_path, cached)
+        )
+
+    def _fetch_bulk(self, kind, batch, key):
+        url = f"{self.url}/{ASNDB_BULK_PATH}/{kind}"
+        ids = ",".join(str(value) for value, _, _ in batch)
+        print(f"Fetching {len(batch)} records from {url}")
+        response = get_scheduler().submit(
+            url,
+            key=key,
+            include_api_key=True,
+            headers={"x-rate-limit-blocking": "true"},
+            params={"ids": ids},
+        )
+        response.add_done_callback(
+            lambda f: self._on_bulk_response(f, kind, batch, key)
+        )
+
+    def _on_bulk_response(self, response_future, kind, batch, key):
+        """
+        Resolve a batch from a bulk response, falling back to single lookups.
+        Any failure (an error status or a malformed body) turns bulk lookups
+        of this kind off for the rest of the run.
+        """
+        records = {}
+        try:
+            res = response_future.result()
+            if not 200 <= res.status_code < 300:
+                raise ValueError(f"{res.url} -> {res}")
+            records = res.json()["results"]
+            if not isinstance(records, dict):
+                raise ValueError(f"{res.url} -> malformed results")
+        except Exception as e:
+            print(f"Bulk {kind} lookup failed ({e}), falling back to single lookups")
+            self._bulk[kind] = False
+            records = {}
+        for value, future, cached in batch:
+            data = records.get(str(value))
+            if data is None:
+                self._fetch(kind, value, future, cached, key)
+                continue
+            try:
+                self._write_cache(
+                    self._cache_path(kind, value),
+                    {
+                        "fetched": time.time(),
+                        "etag": None,
+                        "last_modified": None,
+                        "data": data,
+                    },
+                )
+            except OSError as e:
+                print(f"Failed to cache {kind} {value}: {e}")
+            future.set_result(data)
+
+    def _forget_failure(self, cache_key, future):
+        # a failed lookup is forgotten, so a later one tries again
+        if future.exception() is None:
+            return
+        with self._lock:
+            if self._futures.get(cache_key) is future:
+                del self._futures[cache_key]
+
+    def _on_response(self, response_future, future, cache_path, cached):
+        try:
+            res = response_future.result()
+            print(f"{res.url} -> {res}: {res.text}")
+            if res.status_code == 304 and cached is not None:
+                data = cached["data"]
+            else:
+                data = res.json()
+            if res.status_code in (200, 304):
+                self._write_cache(
+                    cache_path,
+                    {
+                        "fetched": time.time(),
+                        "etag": res.headers.get("ETag") or (cached or {}).get("etag"),
+                        "last_modified": res.headers.get("Last-Modified")
+                        or (cached or {}).get("last_modified"),
+                        "data": data,
+                    },
+                )
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(data)
+
+    def _cache_path(self, kind, value):
+        return self.cache_dir / kind / f"{quote(str(value), safe='')}.json"
+
+    def _read_cache(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, path, entry):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(
+            f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_asndb(url):
+    """The ASNDB client shared by every provider, for an ASNDB URL."""
+    with _clients_lock:
+        if url not in _clients:
+            _clients[url] = ASNDB(url)
+        return _clients[url]
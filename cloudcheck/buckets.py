@@ -0,0 +1,210 @@
+"""
+Storage bucket matching with the STORAGE_BUCKET_HOSTNAME and
+STORAGE_BUCKET_NAME regexes of every provider, compiled once.
+
+Every hostname pattern ends in a literal domain (amazonaws.com, r2.dev,
+blob.core.windows.net, ...), so the patterns are grouped by the last two
+labels of that domain and combined into one regex per group. A hostname is
+only matched against the group for its own last two labels, so the vast
+majority of hostnames are rejected with a single dict lookup.
+
+Many providers share a bucket name pattern, so each distinct name pattern is
+compiled and run once per name, and the set of patterns that matched maps to
+a set of providers that is worked out once per distinct mask.
+"""
+
+import functools
+import itertools
+import re
+from typing import (
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+# the literal domain a hostname pattern ends with, e.g. "blob\.core\.windows\.net)"
+_LITERAL_SUFFIX = re.compile(r"((?:[a-z0-9-]+\\\.)+[a-z0-9-]+)\)*$")
+
+
+class BucketMatch(NamedTuple):
+    provider: str
+    bucket: str
+    endpoint: str
+
+
+def _dispatch_key(hostname: str) -> str:
+    return ".".join(hostname.rsplit(".", 2)[-2:])
+
+
+def _pattern_key(pattern: str) -> Optional[str]:
+    """The last two labels of the literal domain a pattern ends with, if any."""
+    match = _LITERAL_SUFFIX.search(pattern)
+    if match is None:
+        return None
+    labels = match.group(1).split(r"\.")
+    if len(labels) < 2:
+        return None
+    return ".".join(labels[-2:])
+
+
+class _Group:
+    """Several hostname patterns combined into one alternation."""
+
+    def __init__(self, patterns: List[Tuple[str, str]]):
+        alternatives = []
+        # provider and group offset for each alternative, by its group name
+        self.alternatives = {}
+        offset = 0
+        for i, (provider, pattern) in enumerate(patterns):
+            groups = re.compile(pattern).groups
+            if groups != 2:
+                raise ValueError(
+                    f"{provider} STORAGE_BUCKET_HOSTNAME pattern must have two groups "
+                    f"(bucket and endpoint): {pattern}"
+                )
+            alternatives.append(f"(?P<p{i}>{pattern})")
+            self.alternatives[f"p{i}"] = (provider, offset + 1)
+            offset += groups + 1
+        self.regex = re.compile("|".join(alternatives))
+
+    def match(self, hostname: str) -> Optional[BucketMatch]:
+        match = self.regex.fullmatch(hostname)
+        if match is None:
+            return None
+        # the outermost group of an alternative closes last
+        provider, offset = self.alternatives[match.lastgroup]
+        return BucketMatch(provider, match.group(offset + 1), match.group(offset + 2))
+
+
+def _provider_regexes() -> Dict[str, Dict[str, List[str]]]:
+    from cloudcheck.providers import _provider_instances
+
+    return {name: provider.regexes for name, provider in _provider_instances.items()}
+
+
+class BucketMatcher:
+    """
+    Matches hostnames against the STORAGE_BUCKET_HOSTNAME regexes of all
+    providers at once, e.g.:
+
+        matcher = BucketMatcher()
+        matcher.match_hostname("mybucket.s3.amazonaws.com")
+        # BucketMatch(provider='Amazon', bucket='mybucket', endpoint='s3.amazonaws.com')
+
+    It also filters candidate bucket names (see valid_bucket_names()).
+
+    regexes maps provider names to their regexes, and defaults to the provider
+    definitions in cloudcheck.providers. The "regexes" of each provider in
+    cloud_providers_v2.json can be passed instead.
+    """
+
+    def __init__(self, regexes: Optional[Dict[str, Dict[str, List[str]]]] = None):
+        if regexes is None:
+            regexes = _provider_regexes()
+        by_key: Dict[Optional[str], List[Tuple[str, str]]] = {}
+        for provider in sorted(regexes):
+            for pattern in regexes[provider].get("STORAGE_BUCKET_HOSTNAME", []):
+                by_key.setdefault(_pattern_key(pattern), []).append((provider, pattern))
+        # patterns without a literal domain are tried on every hostname
+        fallback = by_key.pop(None, [])
+        self._fallback = _Group(fallback) if fallback else None
+        self._groups = {key: _Group(patterns) for key, patterns in by_key.items()}
+
+        # providers by STORAGE_BUCKET_NAME pattern
+        name_patterns: Dict[str, set] = {}
+        for provider, provider_regexes in regexes.items():
+            for pattern in provider_regexes.get("STORAGE_BUCKET_NAME", []):
+                name_patterns.setdefault(pattern, set()).add(provider)
+        self._name_patterns = [
+            (re.compile(pattern).fullmatch, frozenset(pattern_providers))
+            for pattern, pattern_providers in name_patterns.items()
+        ]
+        # only the masks names actually produce are ever expanded, and they
+        # are shared by every valid_bucket_names() call
+        self._valid_for = functools.lru_cache(maxsize=None)(self._providers_for_mask)
+
+    def match_hostname(self, hostname: str) -> Optional[BucketMatch]:
+        """Return the provider, bucket name and endpoint of a bucket hostname, or None."""
+        hostname = hostname.strip().rstrip(".").lower()
+        group = self._groups.get(_dispatch_key(hostname))
+        if group is not None:
+            match = group.match(hostname)
+            if match is not None:
+                return match
+        if self._fallback is not None:
+            return self._fallback.match(hostname)
+        return None
+
+    def match_hostnames(
+        self, hostnames: Iterable[str]
+    ) -> Iterator[Tuple[str, BucketMatch]]:
+        """
+        Lazily yield (hostname, match) for every bucket hostname in an
+        iterable (e.g. an open file), skipping everything else.
+        """
+        match_hostname = self.match_hostname
+        for hostname in hostnames:
+            match = match_hostname(hostname)
+            if match is not None:
+                yield hostname.strip(), match
+
+    def _providers_for_mask(self, mask: int) -> FrozenSet[str]:
+        """The providers a name is valid for, by bitmask of the patterns it matches."""
+        valid = set()
+        for i, (_, pattern_providers) in enumerate(self._name_patterns):
+            if mask & (1 << i):
+                valid |= pattern_providers
+        return frozenset(valid)
+
+    def _name_checks(self, providers: Optional[Iterable[str]]):
+        """
+        The compiled name patterns relevant to the given providers, each with
+        its bit in the mask passed to _valid_for().
+        """
+        wanted = None if providers is None else frozenset(providers)
+        return wanted, [
+            (fullmatch, 1 << i)
+            for i, (fullmatch, pattern_providers) in enumerate(self._name_patterns)
+            if wanted is None or pattern_providers & wanted
+        ]
+
+    def valid_bucket_names(
+        self,
+        names: Iterable[str],
+        providers: Optional[Iterable[str]] = None,
+        chunk_size: int = 10_000,
+        include_invalid: bool = False,
+    ) -> Iterator[Tuple[str, FrozenSet[str]]]:
+        """
+        Lazily yield (name, providers) for every candidate bucket name in an
+        iterable (e.g. an open wordlist), where providers is the set of
+        providers whose STORAGE_BUCKET_NAME regexes accept the name. Names no
+        provider accepts are skipped unless include_invalid=True.
+
+        providers limits the check to some providers. Names are processed in
+        chunks of chunk_size, and each distinct pattern runs once per name.
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        wanted, bits = self._name_checks(providers)
+        valid_for = self._valid_for
+        names = iter(names)
+        while True:
+            chunk = [name.strip() for name in itertools.islice(names, chunk_size)]
+            if not chunk:
+                return
+            for name in chunk:
+                mask = 0
+                for fullmatch, bit in bits:
+                    if fullmatch(name):
+                        mask |= bit
+                if mask or include_invalid:
+                    valid = valid_for(mask)
+                    if wanted is not None:
+                        valid &= wanted
+                    yield name, valid
@@ -0,0 +1,143 @@
+import codecs
+import ipaddress
+import re
+from collections import OrderedDict
+
+# one pass over each line finds every IPv6 address, IPv4 address (or CIDR)
+# and hostname in it
+_TOKENS = re.compile(
+    r"(?P<ipv6>(?<![\w:.])(?:[0-9A-Fa-f]{0,4}:){2,7}[0-9A-Fa-f]{0,4}(?:/\d{1,3})?(?![\w:]))"
+    # a dot may follow an IPv4 address (the end of a sentence), but not a
+    # fifth number as in an OID or a version string
+    r"|(?P<ipv4>(?<![\w.])(?:\d{1,3}\.){3}\d{1,3}(?:/\d{1,2})?(?!\.?\w))"
+    r"|(?P<hostname>(?<![\w.-])(?:[A-Za-z0-9_](?:[A-Za-z0-9_-]{0,61}[A-Za-z0-9_])?\.)+"
+    r"[A-Za-z][A-Za-z0-9-]{0,62}(?![\w-]))"
+)
+
+
+def _is_ipv6(token):
+    # cheap filter for timestamps and MAC addresses before parsing
+    if "::" not in token and token.count(":") != 7:
+        return False
+    try:
+        ipaddress.ip_network(token, strict=False)
+    except ValueError:
+        return False
+    return True
+
+
+def extract_tokens(line):
+    """Return the distinct IPs, CIDRs and (lowercased) hostnames in a line of text."""
+    tokens = {}
+    for match in _TOKENS.finditer(line):
+        kind = match.lastgroup
+        token = match.group()
+        if kind == "hostname":
+            token = token.lower()
+        elif kind == "ipv6" and not _is_ipv6(token):
+            continue
+        tokens[token] = None
+    return list(tokens)
+
+
+def _lines(source, encoding, max_line_length):
+    """
+    Split file objects or arbitrary str/bytes chunks into lines, without the
+    line endings. A line longer than max_line_length is cut, so memory stays
+    bounded even if the input has no newlines.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    tail = ""
+    for chunk in source:
+        if not isinstance(chunk, str):
+            chunk = decoder.decode(chunk)
+        lines = (tail + chunk).split("\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line.rstrip("\r")
+        while len(tail) > max_line_length:
+            yield tail[:max_line_length]
+            tail = tail[max_line_length:]
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail.rstrip("\r")
+
+
+def classify(
+    cloudcheck,
+    source,
+    batch_size=1000,
+    window=100_000,
+    only_hits=True,
+    encoding="utf-8",
+    max_line_length=1 << 20,
+):
+    """
+    Find the IPs and hostnames in a stream of text (logs, scanner output, ...)
+    and look them up.
+
+    source is a file object (text or binary) or any iterable of str or bytes
+    chunks; chunks do not need to end on line boundaries. Tokens are looked
+    up in batches of batch_size with lookup_many_sync(), and the results of
+    the most recent `window` distinct tokens are remembered, so repeated
+    tokens are only looked up once. Only one batch of lines is held at a
+    time, so memory stays constant no matter how large the input is.
+
+    Yields (line_number, line, hits) for each line, in input order, where
+    hits maps each token in the line to its providers. Lines and tokens
+    without a match are skipped unless only_hits=False. Provider lists are
+    shared between records and should not be modified.
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    if window < 1:
+        raise ValueError("window must be at least 1")
+    seen = OrderedDict()
+
+    def remember(token, providers):
+        seen[token] = providers
+        seen.move_to_end(token)
+        if len(seen) > window:
+            seen.popitem(last=False)
+
+    pending = []
+    # results of the tokens in the pending lines; cached results are copied
+    # here as lines are queued, so evicting them from `seen` is harmless
+    results = {}
+    unresolved = {}
+
+    def flush():
+        if unresolved:
+            tokens = list(unresolved)
+            for token, providers in zip(tokens, cloudcheck.lookup_many_sync(tokens)):
+                results[token] = providers
+                remember(token, providers)
+            unresolved.clear()
+        for line_number, line, tokens in pending:
+            hits = {token: results[token] for token in tokens}
+            if only_hits:
+                hits = {
+                    token: providers for token, providers in hits.items() if providers
+                }
+                if not hits:
+                    continue
+            yield line_number, line, hits
+        pending.clear()
+        results.clear()
+
+    for line_number, line in enumerate(_lines(source, encoding, max_line_length), 1):
+        tokens = extract_tokens(line)
+        if not tokens and only_hits:
+            continue
+        for token in tokens:
+            if token in results or token in unresolved:
+                continue
+            if token in seen:
+                seen.move_to_end(token)
+                results[token] = seen[token]
+            else:
+                unresolved[token] = None
+        pending.append((line_number, line, tokens))
+        if len(unresolved) >= batch_size or len(pending) >= batch_size:
+            yield from flush()
+    yield from flush()
@@ -0,0 +1,215 @@
+"""
+Bulk lookups from the command line:
+
+    python -m cloudcheck hosts.txt > results.ndjson
+    cat hosts.txt | cloudcheck-bulk --format csv --workers 8 --ordered
+
+Targets are read one per line from files or stdin, split into chunks, and
+looked up by a pool of worker processes. The index is loaded once in the
+parent: with the compiled extension it is published to a temporary file that
+every worker maps, and the pure-Python engine is inherited by forked workers.
+"""
+
+import argparse
+import csv
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+# the engine of this process (the parent's, or a worker's)
+_cloudcheck = None
+
+
+def _engine_options(args):
+    options = {}
+    if args.path is not None:
+        options["path"] = args.path
+    if args.url is not None:
+        options["url"] = args.url
+    if args.offline:
+        options["offline"] = True
+    return options
+
+
+def _init_worker(options, index_path):
+    global _cloudcheck
+    from cloudcheck import CloudCheck
+
+    if index_path is not None:
+        _cloudcheck = CloudCheck(index_path=index_path)
+    elif _cloudcheck is None:
+        # not forked from the parent, so the index has to be built again
+        _cloudcheck = CloudCheck(**options)
+
+
+def _format_ndjson(targets, results):
+    return "".join(
+        json.dumps({"target": target, "providers": providers}) + "\n"
+        for target, providers in zip(targets, results)
+    )
+
+
+def _format_csv(targets, results):
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    for target, providers in zip(targets, results):
+        names = ";".join(provider["name"] for provider in providers)
+        tags = ";".join(
+            sorted({tag for provider in providers for tag in provider["tags"]})
+        )
+        writer.writerow([target, names, tags])
+    return output.getvalue()
+
+
+_FORMATTERS = {"ndjson": _format_ndjson, "csv": _format_csv}
+
+
+def _lookup_chunk(targets, output_format):
+    """Look up a chunk of targets and return the formatted output."""
+    return _FORMATTERS[output_format](targets, _cloudcheck.lookup_many_sync(targets))
+
+
+def _read_targets(paths):
+    """Yield the non-empty, stripped lines of each file ("-" is stdin)."""
+    for path in paths:
+        if path == "-":
+            f = sys.stdin
+        else:
+            f = open(path, errors="replace")
+        try:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+def _chunks(targets, chunk_size):
+    targets = iter(targets)
+    while True:
+        chunk = list(itertools.islice(targets, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _run_pool(chunks, args, options, index_path, write):
+    """
+    Look up chunks in worker processes, with at most two chunks per worker in
+    flight so memory stays bounded however large the input is.
+    """
+    max_pending = args.workers * 2
+    pending = deque()
+    if index_path is not None:
+        # the extension's runtime threads do not survive a fork, so workers
+        # start fresh and map the published index
+        context = multiprocessing.get_context("spawn")
+    elif "fork" in multiprocessing.get_all_start_methods():
+        # forked workers inherit the parent's engine instead of rebuilding it
+        context = multiprocessing.get_context("fork")
+    else:
+        context = None
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(options, index_path),
+    ) as executor:
+        for chunk in chunks:
+            pending.append(executor.submit(_lookup_chunk, chunk, args.format))
+            if len(pending) < max_pending:
+                continue
+            if args.ordered:
+                write(pending.popleft().result())
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in [future for future in pending if future in done]:
+                    pending.remove(future)
+                    write(future.result())
+        while pending:
+            write(pending.popleft().result())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="cloudcheck-bulk",
+        description="Look up IPs, networks and hostnames (one per line) in bulk.",
+    )
+    parser.add_argument(
+        "files", nargs="*", default=["-"], help="input files (default: stdin)"
+    )
+    parser.add_argument("-f", "--format", choices=sorted(_FORMATTERS), default="ndjson")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of worker processes (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--ordered", action="store_true", help="write results in input order"
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=10_000, help="targets per batch"
+    )
+    parser.add_argument("--path", help="load the signatures from this JSON file")
+    parser.add_argument("--url", help="fetch the signatures from this URL")
+    parser.add_argument(
+        "--offline", action="store_true", help="only use the cached signatures"
+    )
+    args = parser.parse_args(argv)
+    if args.workers < 1 or args.chunk_size < 1:
+        parser.error("--workers and --chunk-size must be at least 1")
+
+    global _cloudcheck
+    from cloudcheck import CloudCheck
+
+    options = _engine_options(args)
+    _cloudcheck = CloudCheck(**options)
+    # load the index before any worker starts
+    _cloudcheck.lookup_many_sync([])
+
+    out = sys.stdout
+    if args.format == "csv":
+        out.write("target,providers,tags\n")
+    chunks = _chunks(_read_targets(args.files), args.chunk_size)
+    index_path = None
+    try:
+        if args.workers == 1:
+            for chunk in chunks:
+                out.write(_lookup_chunk(chunk, args.format))
+        else:
+            shm = "/dev/shm" if os.path.isdir("/dev/shm") else None
+            fd, index_path = tempfile.mkstemp(
+                prefix="cloudcheck-", suffix=".idx", dir=shm
+            )
+            os.close(fd)
+            try:
+                _cloudcheck.publish_index(index_path)
+            except NotImplementedError:
+                # the pure-Python engine: each worker loads the data itself
+                os.unlink(index_path)
+                index_path = None
+            _run_pool(chunks, args, options, index_path, out.write)
+        out.flush()
+    except BrokenPipeError:
+        # the reader went away (e.g. piped into head)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, out.fileno())
+        return 1
+    finally:
+        if index_path is not None:
+            os.unlink(index_path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+"""
+A compact distribution format for cloud_providers_v2.json, emitted by the
+updater next to the JSON (which stays the human-readable source of truth).
+
+The file is gzip-compressed and contains:
+
+    MAGIC (8 bytes) | SHA-256 of the payload (32 bytes) | payload
+
+and the payload is:
+
+    header length (u32, little-endian) | header (JSON) | network records
+
+The header holds every provider field except "cidrs", plus the number of
+IPv4 and IPv6 networks of each provider. The networks follow, provider by
+provider in header order, as (network address, prefix length) records: 4 + 1
+bytes for IPv4 and 16 + 1 bytes for IPv6, big-endian.
+"""
+
+import gzip
+import hashlib
+import ipaddress
+import json
+import logging
+import struct
+
+log = logging.getLogger("cloudcheck")
+
+MAGIC = b"CCPACK1\0"
+_HEADER_LEN = struct.Struct("<I")
+
+
+def _networks(name, cidrs):
+    # the JSON has already been written by the time the updater packs it, so
+    # a bad CIDR is left out of the pack rather than failing the whole update
+    for cidr in cidrs:
+        try:
+            yield ipaddress.ip_network(cidr, strict=False)
+        except ValueError as e:
+            log.warning(f"Skipping invalid CIDR for {name}: {e}")
+
+
+def pack(providers):
+    """
+    Serialize cloud_providers_v2.json data into the compact format. Invalid
+    CIDRs are logged and skipped.
+    """
+    header = []
+    records = bytearray()
+    for name in sorted(providers):
+        provider = dict(providers[name])
+        networks = list(_networks(name, provider.pop("cidrs", [])))
+        ipv4 = sorted(n for n in networks if n.version == 4)
+        ipv6 = sorted(n for n in networks if n.version == 6)
+        for network in ipv4 + ipv6:
+            records += network.network_address.packed
+            records.append(network.prefixlen)
+        header.append(
+            {"key": name, "ipv4": len(ipv4), "ipv6": len(ipv6), "provider": provider}
+        )
+    header = json.dumps(header, separators=(",", ":"), sort_keys=True).encode()
+    payload = _HEADER_LEN.pack(len(header)) + header + bytes(records)
+    # mtime=0 keeps the output byte-for-byte reproducible
+    return gzip.compress(MAGIC + hashlib.sha256(payload).digest() + payload, mtime=0)
+
+
+def content_hash(data):
+    """The SHA-256 (hex) of a packed file's payload, as stored in it."""
+    return _unwrap(data)[0].hex()
+
+
+def _unwrap(data):
+    data = gzip.decompress(data)
+    if data[: len(MAGIC)] != MAGIC:
+        raise ValueError("Not a packed cloudcheck signature file")
+    digest = data[len(MAGIC) : len(MAGIC) + 32]
+    payload = data[len(MAGIC) + 32 :]
+    if hashlib.sha256(payload).digest() != digest:
+        raise ValueError("Packed cloudcheck signature file is corrupt")
+    return digest, payload
+
+
+def unpack(data):
+    """Parse a packed file back into the cloud_providers_v2.json structure."""
+    _, payload = _unwrap(data)
+    (header_len,) = _HEADER_LEN.unpack_from(payload)
+    offset = _HEADER_LEN.size + header_len
+    header = json.loads(payload[_HEADER_LEN.size : offset])
+    providers = {}
+    for entry in header:
+        cidrs = []
+        for version, count in ((4, entry["ipv4"]), (6, entry["ipv6"])):
+            size = 4 if version == 4 else 16
+            address = ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+            for _ in range(count):
+                network = address(payload[offset : offset + size])
+                cidrs.append(f"{network}/{payload[offset + size]}")
+                offset += size + 1
+        provider = dict(entry["provider"])
+        provider["cidrs"] = cidrs
+        providers[entry["key"]] = provider
+    if offset != len(payload):
+        raise ValueError("Packed cloudcheck signature file has trailing data")
+    return providers
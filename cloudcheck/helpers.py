@@ -1,7 +1,10 @@
 import ipaddress
 import os
+import threading
 import requests
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import List, Set, Union
 
 
@@ -201,6 +204,53 @@ browser_base_headers = {
 }
 
 
+# (connect, read) timeout in seconds of every request, unless one is passed
+REQUEST_TIMEOUT = (
+    float(os.getenv("CLOUDCHECK_CONNECT_TIMEOUT", 10)),
+    float(os.getenv("CLOUDCHECK_READ_TIMEOUT", 60)),
+)
+# retries of connection errors and 5xx gateway errors, with exponential backoff
+# (429 and 503 are left to the scheduler, which honors Retry-After)
+REQUEST_RETRIES = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(500, 502, 504),
+    allowed_methods=("GET",),
+    raise_on_status=False,
+)
+
+_adapter = None
+_adapter_lock = threading.Lock()
+_local = threading.local()
+
+
+def _get_adapter():
+    global _adapter
+    with _adapter_lock:
+        if _adapter is None:
+            _adapter = HTTPAdapter(
+                pool_connections=64, pool_maxsize=16, max_retries=REQUEST_RETRIES
+            )
+        return _adapter
+
+
+def get_session():
+    """
+    The requests.Session of the calling thread. requests.Session isn't
+    thread-safe, so each worker thread gets its own, but they all share one
+    HTTPAdapter: connections are kept alive and pooled per host across
+    threads, and failed connections are retried (REQUEST_RETRIES).
+    """
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = _get_adapter()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _local.session = session
+    return session
+
+
 def request(url, include_api_key=False, browser_headers=False, **kwargs):
     headers = kwargs.get("headers", {})
     if browser_headers:
@@ -209,7 +259,8 @@ def request(url, include_api_key=False, browser_headers=False, **kwargs):
     if include_api_key and bbot_io_api_key:
         headers["Authorization"] = f"Bearer {bbot_io_api_key}"
     kwargs["headers"] = headers
-    return requests.get(url, **kwargs)
+    kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+    return get_session().get(url, **kwargs)
 
 
 def parse_v2fly_domain_file(file_path: Path) -> Set[str]:
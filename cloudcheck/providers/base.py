@@ -3,12 +3,14 @@ import os
 import traceback
 import subprocess
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import as_completed
 from pathlib import Path
 from typing import Dict, List, Union
 from pydantic import BaseModel, field_validator, computed_field
 
-from ..helpers import defrag_cidrs, parse_v2fly_domain_file, request
+from ..helpers import defrag_cidrs, parse_v2fly_domain_file
+from ..asndb import get_asndb
+from ..scheduler import get_scheduler
 
 
 v2fly_repo_pulled = False
@@ -150,18 +152,27 @@ class BaseProvider(BaseModel):
 
     def _fetch_org_id(self, org_id: str):
         """Fetch ASNs for a single org_id."""
-        print(f"Fetching cidrs for {org_id} from asndb")
+        return self._org_id_asns(
+            org_id, self._asndb().lookup("org", org_id, key=self.name)
+        )
+
+    def _org_id_asns(self, org_id, future):
         try:
-            url = f"{self._asndb_url}/org/{org_id}"
-            print(f"Fetching {url}")
-            res = self.request(url, include_api_key=True)
-            print(f"{url} -> {res}: {res.text}")
-            j = res.json()
+            j = future.result()
             return j.get("asns", []), []
         except Exception as e:
             error = f"Failed to fetch cidrs for {org_id} from asndb: {e}:\n{traceback.format_exc()}"
             return [], [error]
 
+    def _asndb(self):
+        """The ASNDB client, whose lookups are shared with other providers and cached."""
+        return get_asndb(self._asndb_url)
+
+    def _submit_asndb(self, kind, values):
+        """Look up many org IDs or ASNs at once, and return {future: value}."""
+        futures = self._asndb().lookup_many(kind, values, key=self.name)
+        return {future: value for value, future in futures.items()}
+
     def fetch_org_ids(
         self,
     ) -> List[Union[ipaddress.IPv4Network, ipaddress.IPv6Network]]:
@@ -171,34 +182,29 @@ class BaseProvider(BaseModel):
         print(f"Fetching {len(self.org_ids)} org ids for {self.name}")
         asns = set()
 
-        # Parallelize org_id fetching
-        with ThreadPoolExecutor() as executor:
-            org_futures = {
-                executor.submit(self._fetch_org_id, org_id): org_id
-                for org_id in self.org_ids
-            }
-            for future in as_completed(org_futures):
-                _asns, _errors = future.result()
-                errors.extend(_errors)
-                asns.update(_asns)
-
-        # Parallelize ASN fetching
-        with ThreadPoolExecutor() as executor:
-            asn_futures = {executor.submit(self.fetch_asn, asn): asn for asn in asns}
-            for future in as_completed(asn_futures):
-                asn_cidrs, _errors = future.result()
-                errors.extend(_errors)
-                cidrs.update(asn_cidrs)
+        # queue every lookup at once; the scheduler decides how many run
+        org_futures = self._submit_asndb("org", self.org_ids)
+        for future in as_completed(org_futures):
+            _asns, _errors = self._org_id_asns(org_futures[future], future)
+            errors.extend(_errors)
+            asns.update(_asns)
+
+        asn_futures = self._submit_asndb("asn", sorted(asns))
+        for future in as_completed(asn_futures):
+            asn_cidrs, _errors = self._asn_cidrs(asn_futures[future], future)
+            errors.extend(_errors)
+            cidrs.update(asn_cidrs)
 
         return cidrs, asns, errors
 
     def fetch_asns(self) -> List[Union[ipaddress.IPv4Network, ipaddress.IPv6Network]]:
         """Fetch CIDRs for a given list of ASNs from ASNDB."""
-        cidrs = []
+        cidrs = set()
         errors = []
         print(f"Fetching {len(self.asns)} ASNs for {self.name}")
-        for asn in self.asns:
-            asn_cidrs, _errors = self.fetch_asn(asn)
+        asn_futures = self._submit_asndb("asn", self.asns)
+        for future in as_completed(asn_futures):
+            asn_cidrs, _errors = self._asn_cidrs(asn_futures[future], future)
             errors.extend(_errors)
             cidrs.update(asn_cidrs)
         return cidrs, errors
@@ -207,14 +213,13 @@ class BaseProvider(BaseModel):
         self, asn: int
     ) -> List[Union[ipaddress.IPv4Network, ipaddress.IPv6Network]]:
         """Fetch CIDRs for a given ASN from ASNDB."""
+        return self._asn_cidrs(asn, self._asndb().lookup("asn", asn, key=self.name))
+
+    def _asn_cidrs(self, asn, future):
         cidrs = []
         errors = []
-        url = f"{self._asndb_url}/asn/{asn}"
-        print(f"Fetching {url}")
         try:
-            res = self.request(url, include_api_key=True)
-            print(f"{url} -> {res.text}")
-            j = res.json()
+            j = future.result()
             cidrs = j.get("subnets", [])
         except Exception as e:
             errors.append(
@@ -276,11 +281,19 @@ class BaseProvider(BaseModel):
                 )
         return repo_dir, errors
 
-    def request(self, *args, **kwargs):
+    def submit(self, *args, **kwargs):
+        """
+        Queue a request with the shared scheduler (see cloudcheck.scheduler),
+        which limits concurrency and per-host rates across all providers.
+        Returns a Future of the response.
+        """
         headers = kwargs.get("headers", {})
         headers["x-rate-limit-blocking"] = "true"
         kwargs["headers"] = headers
-        return request(*args, **kwargs)
+        return get_scheduler().submit(*args, key=self.name, **kwargs)
+
+    def request(self, *args, **kwargs):
+        return self.submit(*args, **kwargs).result()
 
     def __str__(self):
         return self.name
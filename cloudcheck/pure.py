@@ -0,0 +1,439 @@
+"""
+A pure-Python lookup engine, used when the compiled extension is not available
+for a platform or interpreter.
+
+It builds the same index as the Rust engine from cloud_providers_v2.json:
+networks nested inside another provider network are folded into the outermost
+one, as are domains nested under another provider domain. What remains does
+not overlap, so IPs are found by bisecting sorted start/end tables, and
+hostnames by walking a trie of reversed domain labels.
+"""
+
+import asyncio
+import gzip
+import ipaddress
+import json
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from array import array
+from bisect import bisect_right
+from pathlib import Path
+
+from .classify import classify
+from .stream import lookup_stream
+
+CLOUDCHECK_SIGNATURE_URL = "https://raw.githubusercontent.com/blacklanternsecurity/cloudcheck/refs/heads/stable/cloud_providers_v2.json"
+CACHE_TTL = 24 * 60 * 60
+
+_VALID_DNS = re.compile(r"[a-z0-9\-_.]+")
+# marks the end of a domain in the label trie
+_LEAF = ""
+
+
+def _fnv1a(data):
+    """64-bit FNV-1a, as used by the Rust engine to name cache files."""
+    h = 0xCBF29CE484222325
+    for b in data:
+        h = ((h ^ b) * 0x100000001B3) & 0xFFFFFFFFFFFFFFFF
+    return h
+
+
+def _cache_path(url):
+    """
+    The cache file of a URL, named like the Rust engine names it so both share
+    it. Only the upstream URL gets the plain name.
+    """
+    directory = Path.home() / ".cache" / "cloudcheck"
+    if url == CLOUDCHECK_SIGNATURE_URL:
+        return directory / "cloud_providers_v2.json"
+    return directory / f"cloud_providers_v2.{_fnv1a(url.encode()):016x}.json"
+
+
+def _load_json(path=None, data=None, url=None, offline=False, ttl=CACHE_TTL):
+    """
+    Load the signature JSON the same way the Rust engine does: from a file, from
+    memory, or from the cache file of the URL, fetching it again once it is
+    older than the TTL. A stale cache file is still used if the fetch fails.
+    """
+    if data is not None:
+        return json.loads(data)
+    if path is not None:
+        with open(path, "rb") as f:
+            return json.load(f)
+
+    url = url or os.getenv("CLOUDCHECK_SIGNATURE_URL", CLOUDCHECK_SIGNATURE_URL)
+    cache_path = _cache_path(url)
+    try:
+        fresh = time.time() - cache_path.stat().st_mtime < ttl
+    except OSError:
+        fresh = False
+    if not fresh and not offline:
+        try:
+            body = _fetch(url, cache_path)
+            if body is not None:
+                return json.loads(body)
+        except OSError:
+            if not cache_path.exists():
+                raise
+    with open(cache_path, "rb") as f:
+        return json.load(f)
+
+
+def _fetch(url, cache_path):
+    """
+    Fetch the signatures into the cache file, conditionally on the ETag and
+    Last-Modified stored next to it (in the same file the Rust engine uses).
+    Returns the new data, or None if the cache file is still current, in which
+    case only its modification time is refreshed.
+    """
+    validators_path = cache_path.with_suffix(".meta")
+    validators = {}
+    if cache_path.exists():
+        try:
+            validators = json.loads(validators_path.read_bytes())
+        except (OSError, ValueError):
+            pass
+    headers = {"Accept-Encoding": "gzip"}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            body = response.read()
+            if response.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            validators = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+        os.utime(cache_path)
+        return None
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    cache_path.write_bytes(body)
+    if validators["etag"] or validators["last_modified"]:
+        validators_path.write_text(json.dumps(validators))
+    else:
+        validators_path.unlink(missing_ok=True)
+    return body
+
+
+def _normalize_dns(hostname):
+    """
+    Lowercase (and IDNA-encode) a hostname without its trailing dot, or return
+    None if it is invalid.
+    """
+    if not hostname.isascii():
+        try:
+            hostname = hostname.encode("idna").decode("ascii")
+        except UnicodeError:
+            return None
+    # a trailing dot only marks the name as fully qualified
+    hostname = hostname.lower().rstrip(".")
+    if not _VALID_DNS.fullmatch(hostname):
+        return None
+    return hostname
+
+
+def _parse_network(target):
+    """Parse an IP address or network, ignoring host bits. None if it is neither."""
+    try:
+        if "/" in target:
+            return ipaddress.ip_network(target, strict=False)
+        return ipaddress.ip_address(target)
+    except ValueError:
+        return None
+
+
+def _fold_ranges(ranges):
+    """
+    Fold (start, end, provider name) ranges nested inside another range into the
+    outermost one. CIDRs either nest or are disjoint, so after sorting by start
+    (widest first) each range is either inside the last kept one or after it.
+    Returns sorted (start, end, names) tuples.
+    """
+    folded = []
+    for start, end, name in sorted(ranges, key=lambda r: (r[0], -r[1])):
+        if folded and start <= folded[-1][1]:
+            folded[-1][2].add(name)
+        else:
+            folded.append((start, end, {name}))
+    return folded
+
+
+def _needs_extension(feature):
+    return NotImplementedError(
+        f"{feature} needs the compiled extension; the pure-Python engine does not "
+        "support it"
+    )
+
+
+class _Index:
+    """
+    The lookup tables built from one load of the signature data. A reload
+    builds a new one and swaps it in whole, so a lookup never sees a mix of
+    old and new tables.
+    """
+
+    def __init__(self, providers_data, loaded_at):
+        self.loaded_at = loaded_at
+        providers = {}
+        ipv4_ranges = []
+        ipv6_ranges = []
+        domains = []
+        for provider in providers_data.values():
+            name = provider["name"]
+            providers[name] = {
+                "name": name,
+                "tags": list(provider["tags"]),
+                "short_description": provider.get("short_description", ""),
+                "long_description": provider.get("long_description", ""),
+            }
+            for cidr in provider["cidrs"]:
+                network = _parse_network(cidr)
+                if network is None:
+                    continue
+                if isinstance(network, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+                    network = ipaddress.ip_network(network)
+                start = int(network.network_address)
+                end = int(network.broadcast_address)
+                ranges = ipv4_ranges if network.version == 4 else ipv6_ranges
+                ranges.append((start, end, name))
+            for domain in provider["domains"]:
+                domain = _normalize_dns(domain)
+                if domain:
+                    domains.append((domain, name))
+
+        # each distinct set of providers is stored once and shared by entries
+        sets = {}
+
+        def set_id(names):
+            key = tuple(sorted(names))
+            if key not in sets:
+                sets[key] = len(sets)
+            return sets[key]
+
+        self.ipv4_starts = array("L")
+        self.ipv4_ends = array("L")
+        self.ipv4_sets = array("I")
+        for start, end, names in _fold_ranges(ipv4_ranges):
+            self.ipv4_starts.append(start)
+            self.ipv4_ends.append(end)
+            self.ipv4_sets.append(set_id(names))
+        # 128-bit integers do not fit in an array, so IPv6 uses lists
+        self.ipv6_starts = []
+        self.ipv6_ends = []
+        self.ipv6_sets = []
+        for start, end, names in _fold_ranges(ipv6_ranges):
+            self.ipv6_starts.append(start)
+            self.ipv6_ends.append(end)
+            self.ipv6_sets.append(set_id(names))
+
+        # insert the shortest domains first, so a domain under an existing one
+        # is folded into it instead of getting its own entry
+        domain_names = {}
+        for domain, name in domains:
+            domain_names.setdefault(domain, set()).add(name)
+        trie = {}
+        for domain in sorted(domain_names, key=lambda d: d.count(".")):
+            node = trie
+            for label in reversed(domain.split(".")):
+                if _LEAF in node:
+                    break
+                node = node.setdefault(label, {})
+            if _LEAF in node:
+                node[_LEAF] |= domain_names[domain]
+            else:
+                node[_LEAF] = set(domain_names[domain])
+        leaves = [trie]
+        while leaves:
+            node = leaves.pop()
+            for label, child in node.items():
+                if label == _LEAF:
+                    node[_LEAF] = set_id(child)
+                else:
+                    leaves.append(child)
+        self.domains = trie
+
+        self.sets = [
+            tuple(providers[name] for name in names)
+            for names, _ in sorted(sets.items(), key=lambda item: item[1])
+        ]
+        self.provider_names = sorted(providers)
+        self.tag_names = sorted({tag for p in providers.values() for tag in p["tags"]})
+
+    def find(self, target):
+        network = _parse_network(target)
+        if network is None:
+            hostname = _normalize_dns(target)
+            if not hostname:
+                return None
+            node = self.domains
+            for label in reversed(hostname.split(".")):
+                node = node.get(label)
+                if node is None:
+                    return None
+                if _LEAF in node:
+                    return node[_LEAF]
+            return None
+
+        if isinstance(network, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+            start = end = int(network)
+        else:
+            start = int(network.network_address)
+            end = int(network.broadcast_address)
+        if network.version == 4:
+            starts, ends, set_ids = self.ipv4_starts, self.ipv4_ends, self.ipv4_sets
+        else:
+            starts, ends, set_ids = self.ipv6_starts, self.ipv6_ends, self.ipv6_sets
+        # the last entry starting at or before the target is the only candidate
+        i = bisect_right(starts, start) - 1
+        if i >= 0 and end <= ends[i]:
+            return set_ids[i]
+        return None
+
+
+class PureCloudCheck:
+    """
+    Pure-Python drop-in for CloudCheck with the same lookup API (lookup,
+    lookup_many, their _sync variants, provider_names and tag_names) and the
+    same results, at a fraction of the speed. It takes the same arguments as
+    the extension: path=, data=, url=, offline= and ttl= work the same way;
+    options only the extension supports raise NotImplementedError, as do its
+    methods that have no pure-Python version. As in the extension, failing to
+    load the data raises RuntimeError. The data is loaded on first use and,
+    for the default and url= sources, reloaded once it is older than the TTL.
+    """
+
+    def __init__(
+        self,
+        result_type="dict",
+        cache_size=0,
+        ttl=None,
+        path=None,
+        data=None,
+        url=None,
+        index_path=None,
+        offline=False,
+        tags=None,
+        providers=None,
+    ):
+        if result_type not in ("dict", "provider"):
+            raise ValueError(
+                f"Invalid result_type '{result_type}', expected 'dict' or 'provider'"
+            )
+        unsupported = {
+            "result_type='provider'": result_type == "provider",
+            "cache_size": cache_size,
+            "index_path": index_path is not None,
+            "tags": tags is not None,
+            "providers": providers is not None,
+        }
+        for option, given in unsupported.items():
+            if given:
+                raise _needs_extension(option)
+        if ttl is not None and ttl < 0:
+            raise ValueError(f"Invalid ttl: {ttl}")
+        if sum(option is not None for option in (path, data, url)) > 1:
+            raise ValueError("Only one of path, data or url can be given")
+        self._source = {"path": path, "data": data, "url": url, "offline": offline}
+        self._ttl = CACHE_TTL if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._index = None
+
+    def _expired(self, index):
+        static = self._source["path"] is not None or self._source["data"] is not None
+        return not (
+            static
+            or self._source["offline"]
+            or time.time() - index.loaded_at < self._ttl
+        )
+
+    def _needs_load(self):
+        index = self._index
+        return index is None or self._expired(index)
+
+    def _ensure_loaded(self):
+        """The current index, loading it first (or again, once expired)."""
+        if not self._needs_load():
+            return self._index
+        with self._lock:
+            # another thread may have loaded it while this one waited
+            if not self._needs_load():
+                return self._index
+            try:
+                index = _Index(_load_json(**self._source, ttl=self._ttl), time.time())
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                raise RuntimeError(f"CloudCheck error: {e}") from e
+            self._index = index
+            return index
+
+    @staticmethod
+    def _lookup(index, target):
+        set_id = index.find(target)
+        if set_id is None:
+            return []
+        return [dict(p, tags=list(p["tags"])) for p in index.sets[set_id]]
+
+    def lookup_sync(self, target):
+        return self._lookup(self._ensure_loaded(), target)
+
+    def lookup_many_sync(self, targets):
+        index = self._ensure_loaded()
+        return [self._lookup(index, target) for target in targets]
+
+    async def lookup(self, target):
+        # loading (or reloading) fetches and parses, so it runs off the loop
+        if self._needs_load():
+            await asyncio.to_thread(self._ensure_loaded)
+        return self.lookup_sync(target)
+
+    async def lookup_many(self, targets):
+        # a whole batch would block the event loop, so it runs in a thread
+        return await asyncio.to_thread(self.lookup_many_sync, list(targets))
+
+    def provider_names(self):
+        return list(self._ensure_loaded().provider_names)
+
+    def tag_names(self):
+        return list(self._ensure_loaded().tag_names)
+
+    def cache_stats(self):
+        """Always None: the pure-Python engine has no lookup cache."""
+        return None
+
+    def stats(self):
+        raise _needs_extension("stats()")
+
+    def publish_index(self, path):
+        raise _needs_extension("publish_index()")
+
+    async def lookup_range(self, cidr):
+        raise _needs_extension("lookup_range()")
+
+    async def lookup_ranges(self, cidrs):
+        raise _needs_extension("lookup_ranges()")
+
+    def lookup_range_sync(self, cidr):
+        raise _needs_extension("lookup_range_sync()")
+
+    def lookup_ranges_sync(self, cidrs):
+        raise _needs_extension("lookup_ranges_sync()")
+
+    def lookup_stream(self, targets, concurrency=4, chunk_size=1000):
+        """See CloudCheck.lookup_stream()."""
+        return lookup_stream(self, targets, concurrency, chunk_size)
+
+    def classify(
+        self, source, batch_size=1000, window=100_000, only_hits=True, **kwargs
+    ):
+        """See CloudCheck.classify()."""
+        return classify(self, source, batch_size, window, only_hits, **kwargs)
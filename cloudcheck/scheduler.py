@@ -0,0 +1,194 @@
+import email.utils
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from urllib.parse import urlsplit
+
+from .helpers import request
+
+# status codes that mean "slow down and try again"
+RETRY_STATUSES = (429, 503)
+
+
+class _TokenBucket:
+    """Allows `rate` requests per second on average, in bursts of up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # set from Retry-After; nothing is sent to the host before this
+        self.blocked_until = 0.0
+
+    def wait_time(self, now):
+        """Seconds until a request may be sent (0 if one may be sent now)."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class _Job:
+    def __init__(self, key, host, args, kwargs):
+        self.key = key
+        self.host = host
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.attempts = 0
+
+
+def _retry_after(response, attempt):
+    """Seconds to wait before retrying, from the Retry-After header if there is one."""
+    value = response.headers.get("Retry-After", "").strip()
+    if value.isdigit():
+        return float(value)
+    if value:
+        try:
+            return max(
+                0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+            )
+        except (TypeError, ValueError):
+            pass
+    return float(min(2**attempt, 60))
+
+
+class RequestScheduler:
+    """
+    Runs every HTTP request of an update through one place:
+
+    - at most `max_concurrency` requests are in flight at a time, in total
+    - each host has a token bucket of `rate` requests per second (bursts of
+      `burst`); `host_limits` overrides this per host as {host: (rate, burst)}
+    - a 429 or 503 response blocks its host for the Retry-After time (or an
+      exponential backoff) and the request is retried, up to `max_retries` times
+    - requests are queued per key (the provider name), and the queues are
+      served round-robin, so one provider with hundreds of requests cannot
+      starve the others
+
+    Callers block on request() or collect the futures returned by submit(),
+    so no caller needs threads of its own to parallelize requests.
+    """
+
+    def __init__(
+        self, max_concurrency=8, rate=10.0, burst=10, host_limits=None, max_retries=5
+    ):
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.burst = burst
+        self.host_limits = dict(host_limits or {})
+        self.max_retries = max_retries
+        self._condition = threading.Condition()
+        self._queues = OrderedDict()
+        self._buckets = {}
+        self._workers = []
+
+    def submit(self, url, *args, key=None, **kwargs):
+        """Queue a GET request (see helpers.request) and return a Future of the response."""
+        job = _Job(key, urlsplit(url).netloc, (url,) + args, kwargs)
+        with self._condition:
+            self._queues.setdefault(key, deque()).append(job)
+            if len(self._workers) < self.max_concurrency:
+                worker = threading.Thread(target=self._work, daemon=True)
+                self._workers.append(worker)
+                worker.start()
+            self._condition.notify()
+        return job.future
+
+    def request(self, url, *args, key=None, **kwargs):
+        """Send a GET request through the scheduler and wait for the response."""
+        return self.submit(url, *args, key=key, **kwargs).result()
+
+    def _bucket(self, host):
+        if host not in self._buckets:
+            rate, burst = self.host_limits.get(host, (self.rate, self.burst))
+            self._buckets[host] = _TokenBucket(rate, burst)
+        return self._buckets[host]
+
+    def _next_job(self):
+        """
+        Take the first job, round-robin over the queues, whose host may be sent
+        a request now. Waits if there is none.
+        """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                wait = None
+                for key, queue in self._queues.items():
+                    job = queue[0]
+                    bucket = self._bucket(job.host)
+                    host_wait = bucket.wait_time(now)
+                    if host_wait == 0:
+                        bucket.tokens -= 1
+                        queue.popleft()
+                        # this queue goes to the back of the line
+                        del self._queues[key]
+                        if queue:
+                            self._queues[key] = queue
+                        return job
+                    wait = host_wait if wait is None else min(wait, host_wait)
+                self._condition.wait(timeout=wait)
+
+    def _requeue(self, job, delay):
+        with self._condition:
+            bucket = self._bucket(job.host)
+            bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + delay)
+            queue = self._queues.setdefault(job.key, deque())
+            queue.appendleft(job)
+            self._condition.notify_all()
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            try:
+                response = request(*job.args, **job.kwargs)
+            except BaseException as e:
+                job.future.set_exception(e)
+                continue
+            if (
+                response.status_code in RETRY_STATUSES
+                and job.attempts < self.max_retries
+            ):
+                delay = _retry_after(response, job.attempts)
+                job.attempts += 1
+                print(
+                    f"{job.args[0]} -> {response.status_code}, retrying in {delay:.1f}s"
+                )
+                # the future is already running, so hand it a fresh one to wait on
+                retry = _Job(job.key, job.host, job.args, job.kwargs)
+                retry.attempts = job.attempts
+                retry.future.add_done_callback(
+                    lambda f, job=job: _forward(f, job.future)
+                )
+                self._requeue(retry, delay)
+                continue
+            job.future.set_result(response)
+
+
+def _forward(source, target):
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """The scheduler shared by every provider."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler()
+        return _scheduler
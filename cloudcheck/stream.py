@@ -0,0 +1,53 @@
+import asyncio
+from collections import deque
+
+
+async def _chunks(targets, chunk_size):
+    """Lazily group a sync or async iterable into lists of at most chunk_size."""
+    chunk = []
+    if hasattr(targets, "__aiter__"):
+        async for target in targets:
+            chunk.append(target.strip())
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    else:
+        for target in targets:
+            chunk.append(target.strip())
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+async def lookup_stream(cloudcheck, targets, concurrency=4, chunk_size=1000):
+    """
+    Look up targets from a (possibly endless) sync or async iterable.
+
+    Inputs are pulled lazily and looked up in chunks of chunk_size with
+    lookup_many(). At most `concurrency` chunks are in flight at a time, and
+    nothing more is pulled until the caller consumes the oldest chunk, so
+    memory stays bounded no matter how large the input is.
+
+    Yields (target, providers) tuples in input order.
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    pending = deque()
+    try:
+        async for chunk in _chunks(targets, chunk_size):
+            pending.append(
+                (chunk, asyncio.ensure_future(cloudcheck.lookup_many(chunk)))
+            )
+            while len(pending) >= concurrency:
+                chunk, future = pending.popleft()
+                for target, providers in zip(chunk, await future):
+                    yield target, providers
+        while pending:
+            chunk, future = pending.popleft()
+            for target, providers in zip(chunk, await future):
+                yield target, providers
+    finally:
+        for _, future in pending:
+            future.cancel()
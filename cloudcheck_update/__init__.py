@@ -4,6 +4,7 @@ import traceback
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+from cloudcheck.compact import content_hash, pack
 from cloudcheck.providers import load_provider_classes
 
 # Set up logging
@@ -13,6 +14,9 @@ log = logging.getLogger("cloudcheck")
 
 project_root = Path(__file__).parent.parent
 json_path = project_root / "cloud_providers_v2.json"
+# compact distribution format (see cloudcheck.compact), and its content hash
+pack_path = project_root / "cloud_providers_v2.pack"
+pack_hash_path = project_root / "cloud_providers_v2.pack.sha256"
 
 
 def _update_provider(provider_class):
@@ -33,6 +37,8 @@ def update():
     providers = {}
     errors = []
 
+    # these threads mostly wait on responses; the requests themselves are
+    # rate-limited and capped by the shared scheduler (cloudcheck.scheduler)
     with ThreadPoolExecutor() as executor:
         futures = {
             executor.submit(_update_provider, provider_class): provider_class
@@ -59,4 +65,12 @@ def update():
 
     with open(json_path, "w") as f:
         json.dump(existing_json, f, indent=1, sort_keys=True)
+    write_pack(existing_json)
     return errors
+
+
+def write_pack(providers, path=None, hash_path=None):
+    """Write the compact version of the signatures, and its content hash."""
+    data = pack(providers)
+    Path(path or pack_path).write_bytes(data)
+    Path(hash_path or pack_hash_path).write_text(content_hash(data) + "\n")
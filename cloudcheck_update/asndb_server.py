@@ -0,0 +1,142 @@
+"""
+A local stand-in for ASNDB, for testing and benchmarking the updater offline:
+
+    python -m cloudcheck_update.asndb_server --port 8765 --latency 0.05
+    ASNDB_URL=http://127.0.0.1:8765/v1 uv run cloudcheck_update/cli.py
+
+It serves GET /v1/org/{org_id}, GET /v1/asn/{asn} and (unless --no-bulk) the
+bulk endpoint GET /v1/bulk/{org|asn}?ids=a,b,c. Every request waits --latency
+seconds, to make round trips visible. The records come from a JSON file
+({"org": {org_id: record}, "asn": {asn: record}}), or are made up for the
+org IDs of every provider.
+"""
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+def synthetic_records(org_ids, asns_per_org=3):
+    """Made-up records for some org IDs: a few ASNs each, with two subnets per ASN."""
+    records = {"org": {}, "asn": {}}
+    asn = 64512
+    for org_id in sorted(set(org_ids)):
+        org_asns = []
+        for _ in range(asns_per_org):
+            asn += 1
+            org_asns.append(asn)
+            n = asn - 64512
+            records["asn"][str(asn)] = {
+                "asn": asn,
+                "subnets": [f"10.{n // 256}.{n % 256}.0/24", f"fd00:{n:x}::/48"],
+            }
+        records["org"][org_id] = {"org_id": org_id, "asns": org_asns}
+    return records
+
+
+class ASNDBServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, records, bulk=True, latency=0.0):
+        super().__init__(address, _Handler)
+        self.records = records
+        self.bulk = bulk
+        self.latency = latency
+        self.lock = threading.Lock()
+        # requests served, by path without the query
+        self.requests = []
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        url = urlsplit(self.path)
+        with server.lock:
+            server.requests.append(url.path)
+        if server.latency:
+            time.sleep(server.latency)
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+        if len(parts) == 3 and parts[0] == "v1" and parts[1] in server.records:
+            record = server.records[parts[1]].get(parts[2])
+            if record is None:
+                return self._send(404, {"detail": "Not found"})
+            return self._send(200, record)
+        if (
+            server.bulk
+            and len(parts) == 3
+            and parts[:2] == ["v1", "bulk"]
+            and parts[2] in server.records
+        ):
+            ids = ",".join(parse_qs(url.query).get("ids", [])).split(",")
+            records = server.records[parts[2]]
+            results = {i: records[i] for i in ids if i in records}
+            return self._send(200, {"results": results})
+        self._send(404, {"detail": "Not found"})
+
+    def _send(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(records, bulk=True, latency=0.0, host="127.0.0.1", port=0):
+    """Start a stand-in server in a background thread; stop it with .shutdown()."""
+    server = ASNDBServer((host, port), records, bulk=bulk, latency=latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in ASNDB server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--data", help="JSON file of records (default: made up)")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds per request"
+    )
+    parser.add_argument(
+        "--no-bulk", action="store_true", help="disable the bulk endpoint"
+    )
+    args = parser.parse_args(argv)
+
+    if args.data:
+        with open(args.data) as f:
+            records = json.load(f)
+    else:
+        from cloudcheck.providers import load_provider_classes
+
+        org_ids = [
+            org_id
+            for provider_class in load_provider_classes().values()
+            for org_id in provider_class.model_fields["org_ids"].default
+        ]
+        records = synthetic_records(org_ids)
+
+    server = ASNDBServer(
+        (args.host, args.port), records, bulk=not args.no_bulk, latency=args.latency
+    )
+    print(
+        f"Serving {len(records['org'])} orgs and {len(records['asn'])} ASNs at {server.url}"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,85 @@
 Test script for cloudcheck functionality.
 """
 
+import gzip
+import json
 import sys
 import ipaddress
 from pathlib import Path
 
+import pytest
+
 # Add the current directory to Python path
 sys.path.insert(0, str(Path(__file__).parent))
 
 from cloudcheck.providers.amazon import Amazon
 from cloudcheck.helpers import defrag_cidrs, cidrs_to_strings, strings_to_cidrs
+from cloudcheck.compact import content_hash, pack, unpack
+
+
+@pytest.fixture
+def http_server():
+    """
+    Start local HTTP servers from a route table, shut down after the test:
+
+        server = http_server({"/v1/asn/1": lambda request: (200, {"asn": 1})})
+
+    Each route maps a path (without the query, or "*" for any other path) to a
+    function of the request handler that returns (status, body) or (status,
+    body, headers). A body that isn't bytes is sent as JSON. server.url is the
+    base URL, and server.requests the path, headers and client address of
+    every request served (handlers are reused across kept-alive requests).
+    """
+    import threading
+    from types import SimpleNamespace
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlsplit
+
+    servers = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            server = self.server
+            with server.lock:
+                server.requests.append(
+                    SimpleNamespace(
+                        path=self.path,
+                        headers=self.headers,
+                        client_address=self.client_address,
+                    )
+                )
+            path = urlsplit(self.path).path
+            route = server.routes.get(path, server.routes.get("*"))
+            status, body, *headers = route(self) if route else (404, b"")
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode()
+            self.send_response(status)
+            for name, value in (headers[0] if headers else {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    def start(routes):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        server.daemon_threads = True
+        server.routes = routes
+        server.lock = threading.Lock()
+        server.requests = []
+        server.url = f"http://127.0.0.1:{server.server_port}"
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
 
 
 def test_v2fly_domains():
@@ -281,3 +351,266 @@ def test_cidr_defragmentation_mixed_ipv4_ipv6():
     )
 
     print("Mixed IPv4/IPv6 CIDR defragmentation test passed!")
+
+
+def test_compact_pack(tmp_path):
+    """The compact artifact holds the same data as the JSON, in far fewer bytes."""
+    from cloudcheck_update import write_pack
+
+    json_path = Path(__file__).parent.parent / "cloud_providers_v2.json"
+    providers = json.loads(json_path.read_text())
+    pack_path = tmp_path / "cloud_providers_v2.pack"
+    hash_path = tmp_path / "cloud_providers_v2.pack.sha256"
+    write_pack(providers, pack_path, hash_path)
+
+    data = pack_path.read_bytes()
+    assert len(data) < json_path.stat().st_size / 4
+    assert hash_path.read_text().strip() == content_hash(data)
+
+    unpacked = unpack(data)
+    assert set(unpacked) == set(providers)
+    for name, provider in providers.items():
+        expected = dict(provider)
+        cidrs = expected.pop("cidrs")
+        actual = dict(unpacked[name])
+        assert set(actual.pop("cidrs")) == {
+            str(ipaddress.ip_network(cidr, strict=False)) for cidr in cidrs
+        }
+        assert actual == expected
+
+    # output is reproducible, and corruption is detected
+    write_pack(providers, tmp_path / "again.pack", tmp_path / "again.sha256")
+    assert (tmp_path / "again.pack").read_bytes() == data
+    corrupt = bytearray(gzip.decompress(data))
+    corrupt[-1] ^= 1
+    with pytest.raises(ValueError):
+        unpack(gzip.compress(bytes(corrupt)))
+
+    # a malformed CIDR is left out instead of failing after the JSON is written
+    data = pack({"Test": {"cidrs": ["1.2.3.0/24", "not-a-cidr", "1.2.3.4/33"]}})
+    assert unpack(data) == {"Test": {"cidrs": ["1.2.3.0/24"]}}
+
+
+def test_request_scheduler(http_server):
+    """Requests are capped globally, served fairly, and retried after a 429."""
+    import threading
+    import time
+
+    from cloudcheck.scheduler import RequestScheduler
+
+    lock = threading.Lock()
+    state = {"active": 0, "max_active": 0, "order": [], "throttled": False}
+
+    def throttled(request):
+        with lock:
+            if not state["throttled"]:
+                state["throttled"] = True
+                return 429, b"", {"Retry-After": "1"}
+        return ok(request)
+
+    def ok(request):
+        with lock:
+            state["active"] += 1
+            state["max_active"] = max(state["max_active"], state["active"])
+            state["order"].append(request.path)
+        time.sleep(0.02)
+        with lock:
+            state["active"] -= 1
+        return 200, b"ok"
+
+    server = http_server({"/throttled": throttled, "*": ok})
+    base = server.url
+    # a single worker makes the queueing order observable
+    scheduler = RequestScheduler(max_concurrency=1, rate=1000, burst=1000)
+    futures = [scheduler.submit(f"{base}/a{i}", key="a") for i in range(4)]
+    futures += [scheduler.submit(f"{base}/b{i}", key="b") for i in range(2)]
+    assert all(f.result(timeout=10).status_code == 200 for f in futures)
+    # the first request of "a" may start before "b" is queued
+    assert state["order"][-3:] in (["/b1", "/a2", "/a3"], ["/a2", "/b1", "/a3"])
+    assert state["order"].index("/b0") <= 2
+
+    state["order"].clear()
+    scheduler = RequestScheduler(max_concurrency=3, rate=1000, burst=1000)
+    futures = [scheduler.submit(f"{base}/c{i}", key=i % 2) for i in range(12)]
+    assert all(f.result(timeout=10).status_code == 200 for f in futures)
+    assert 1 < state["max_active"] <= 3
+
+    # per-host token bucket: 20 requests per second, in bursts of 1
+    scheduler = RequestScheduler(
+        host_limits={f"127.0.0.1:{server.server_port}": (20, 1)}
+    )
+    start = time.monotonic()
+    for f in [scheduler.submit(f"{base}/d{i}") for i in range(5)]:
+        f.result(timeout=10)
+    assert time.monotonic() - start >= 0.15
+
+    # the 429 blocks the host for Retry-After, then the request succeeds
+    start = time.monotonic()
+    response = scheduler.request(f"{base}/throttled")
+    assert response.status_code == 200
+    assert time.monotonic() - start >= 0.9
+
+
+def test_request_session(http_server):
+    """helpers.request pools connections, retries 5xx errors and times out."""
+    import threading
+    import time
+
+    import requests
+
+    from cloudcheck.helpers import get_session, request
+
+    def ok(request):
+        body = gzip.compress(b'{"ok": true}')
+        return 200, body, {"Content-Encoding": "gzip"}
+
+    def flaky(request):
+        if len(server.requests) == 1:
+            return 502, b""
+        return ok(request)
+
+    def slow(request):
+        time.sleep(1)
+        return ok(request)
+
+    server = http_server({"/flaky": flaky, "/slow": slow, "/ok": ok})
+    base = server.url
+    assert request(f"{base}/flaky").json() == {"ok": True}
+    assert len(server.requests) == 2
+    for _ in range(3):
+        assert request(f"{base}/ok").json() == {"ok": True}
+    # every request went over one kept-alive connection, and the default
+    # Accept-Encoding of requests (gzip among others) was left alone
+    assert len({r.client_address[1] for r in server.requests}) == 1
+    encodings = {r.headers.get("Accept-Encoding") for r in server.requests}
+    assert len(encodings) == 1
+    assert "gzip" in encodings.pop()
+
+    # each thread has its own session, all sharing the pooled adapter
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(get_session()))
+    thread.start()
+    thread.join()
+    assert sessions[0] is not get_session()
+    assert sessions[0].get_adapter(base) is get_session().get_adapter(base)
+
+    # a hung response gives up after the read timeout (and its retries)
+    start = time.monotonic()
+    with pytest.raises(requests.exceptions.RequestException):
+        request(f"{base}/slow", timeout=(1, 0.2))
+    assert time.monotonic() - start < 5
+
+
+def test_asndb_cache(http_server, tmp_path):
+    """ASNDB lookups are deduplicated within a run and cached across runs."""
+    from cloudcheck.asndb import ASNDB
+
+    def asn(request):
+        if request.headers.get("If-None-Match") == '"v1"':
+            return 304, b""
+        return 200, {"asn": 1, "subnets": ["10.0.0.0/8"]}, {"ETag": '"v1"'}
+
+    server = http_server({"/v1/asn/1": asn})
+    url = f"{server.url}/v1"
+
+    def hits():
+        return [(r.path, r.headers.get("If-None-Match")) for r in server.requests]
+
+    asndb = ASNDB(url, cache_dir=tmp_path)
+    futures = [asndb.asn(1, key=f"provider{i}") for i in range(10)]
+    assert all(f.result(timeout=10)["subnets"] == ["10.0.0.0/8"] for f in futures)
+    assert hits() == [("/v1/asn/1", None)]
+
+    # a new run reuses the fresh response on disk
+    assert ASNDB(url, cache_dir=tmp_path).asn(1).result(timeout=10)["asn"] == 1
+    assert len(hits()) == 1
+
+    # a stale response is revalidated with its ETag
+    stale = ASNDB(url, cache_dir=tmp_path, ttl=0)
+    assert stale.asn(1).result(timeout=10)["subnets"] == ["10.0.0.0/8"]
+    assert hits()[1:] == [("/v1/asn/1", '"v1"')]
+
+
+@pytest.mark.parametrize("bulk", [True, False])
+def test_asndb_bulk(bulk, tmp_path, monkeypatch):
+    """Org IDs and ASNs resolve in bulk, or one by one without a bulk endpoint."""
+    import cloudcheck.asndb
+    from cloudcheck.asndb import ASNDB
+    from cloudcheck.providers.base import BaseProvider
+    from cloudcheck_update.asndb_server import start_server, synthetic_records
+
+    records = synthetic_records(["A-ARIN", "B-RIPE", "C-APNIC"], asns_per_org=2)
+    server = start_server(records, bulk=bulk)
+    try:
+        asndb = ASNDB(server.url, cache_dir=tmp_path / "asndb", bulk=True)
+        futures = asndb.lookup_many("org", ["A-ARIN", "B-RIPE", "NOPE-ARIN"])
+        assert futures["A-ARIN"].result(timeout=10)["asns"] == [64513, 64514]
+        assert futures["B-RIPE"].result(timeout=10)["asns"] == [64515, 64516]
+        # unknown values fall back to a single lookup, which gets ASNDB's 404
+        assert "asns" not in futures["NOPE-ARIN"].result(timeout=10)
+        if bulk:
+            assert server.requests == ["/v1/bulk/org", "/v1/org/NOPE-ARIN"]
+        else:
+            assert sorted(server.requests) == [
+                "/v1/bulk/org",
+                "/v1/org/A-ARIN",
+                "/v1/org/B-RIPE",
+                "/v1/org/NOPE-ARIN",
+            ]
+            # the missing bulk endpoint is not tried again
+            server.requests.clear()
+            asndb.lookup_many("org", ["C-APNIC", "A-ARIN", "B-RIPE"])
+            assert asndb.org("C-APNIC").result(timeout=10)["asns"] == [64517, 64518]
+            assert server.requests == ["/v1/org/C-APNIC"]
+
+        # providers resolve their org IDs and ASNs through the same client
+        monkeypatch.setenv("HOME", str(tmp_path))
+        monkeypatch.setenv("ASNDB_URL", server.url)
+        monkeypatch.setattr(cloudcheck.asndb, "ASNDB_BULK", True)
+
+        class Example(BaseProvider):
+            org_ids: list = ["A-ARIN", "C-APNIC"]
+
+        server.requests.clear()
+        cidrs, asns, errors = Example().fetch_org_ids()
+        assert not errors
+        assert asns == {64513, 64514, 64517, 64518}
+        assert len(cidrs) == 8
+        if bulk:
+            assert server.requests == ["/v1/bulk/org", "/v1/bulk/asn"]
+    finally:
+        server.shutdown()
+
+
+@pytest.mark.parametrize(
+    "response",
+    [(500, {"detail": "error"}), (403, {"detail": "forbidden"}), (200, b"<html>")],
+)
+def test_asndb_bulk_opt_in(response, http_server, tmp_path):
+    """Bulk lookups are off by default, and turned off by any bad response."""
+    from cloudcheck.asndb import ASNDB
+
+    def org(request):
+        return 200, {"asns": [int(request.path.rsplit("-", 1)[1])]}
+
+    server = http_server({"/v1/bulk/org": lambda request: response, "*": org})
+    url = f"{server.url}/v1"
+
+    futures = ASNDB(url, cache_dir=tmp_path / "default").lookup_many(
+        "org", ["ORG-1", "ORG-2"]
+    )
+    assert futures["ORG-1"].result(timeout=10) == {"asns": [1]}
+    assert futures["ORG-2"].result(timeout=10) == {"asns": [2]}
+    assert sorted(r.path for r in server.requests) == ["/v1/org/ORG-1", "/v1/org/ORG-2"]
+
+    server.requests.clear()
+    asndb = ASNDB(url, cache_dir=tmp_path / "bulk", bulk=True)
+    futures = asndb.lookup_many("org", ["ORG-1", "ORG-2"])
+    assert futures["ORG-1"].result(timeout=10) == {"asns": [1]}
+    assert futures["ORG-2"].result(timeout=10) == {"asns": [2]}
+    assert server.requests[0].path == "/v1/bulk/org?ids=ORG-1%2CORG-2"
+    # the bulk endpoint is not tried again after it failed
+    server.requests.clear()
+    for future in asndb.lookup_many("org", ["ORG-3", "ORG-4"]).values():
+        future.result(timeout=10)
+    assert sorted(r.path for r in server.requests) == ["/v1/org/ORG-3", "/v1/org/ORG-4"]
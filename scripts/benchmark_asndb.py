@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Compare bulk and one-by-one ASNDB resolution against the local stand-in server"""
+
+import argparse
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cloudcheck.asndb import ASNDB
+from cloudcheck.providers import load_provider_classes
+from cloudcheck_update.asndb_server import start_server, synthetic_records
+
+
+def resolve(asndb: ASNDB, org_ids: dict) -> int:
+    """Resolve every provider's org IDs and their ASNs, like the updater does"""
+
+    def resolve_provider(name):
+        orgs = asndb.lookup_many("org", org_ids[name], key=name)
+        asns = sorted({asn for f in orgs.values() for asn in f.result()["asns"]})
+        subnets = asndb.lookup_many("asn", asns, key=name)
+        return sum(len(f.result()["subnets"]) for f in subnets.values())
+
+    with ThreadPoolExecutor() as executor:
+        return sum(executor.map(resolve_provider, org_ids))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="seconds per request"
+    )
+    args = parser.parse_args()
+
+    org_ids = {
+        name: provider_class.model_fields["org_ids"].default
+        for name, provider_class in load_provider_classes().items()
+    }
+    org_ids = {name: ids for name, ids in org_ids.items() if ids}
+    records = synthetic_records([i for ids in org_ids.values() for i in ids])
+    print(
+        f"{len(org_ids)} providers, {len(records['org'])} org IDs, "
+        f"{len(records['asn'])} ASNs, {args.latency * 1000:.0f}ms per request"
+    )
+
+    for bulk in (False, True):
+        server = start_server(records, bulk=bulk, latency=args.latency)
+        try:
+            with tempfile.TemporaryDirectory() as cache_dir:
+                asndb = ASNDB(server.url, cache_dir=cache_dir, bulk=bulk)
+                start = time.perf_counter()
+                subnets = resolve(asndb, org_ids)
+                elapsed = time.perf_counter() - start
+        finally:
+            server.shutdown()
+        label = "bulk" if bulk else "one by one"
+        print(
+            f"{label:>10}: {elapsed:6.2f}s, {len(server.requests):4d} requests, "
+            f"{subnets} subnets"
+        )
+
+
+if __name__ == "__main__":
+    main()
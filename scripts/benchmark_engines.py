@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Compare lookup throughput of the Rust extension and the pure-Python engine"""
+
+import ipaddress
+import json
+import random
+import time
+from pathlib import Path
+
+from cloudcheck import Provider, PureCloudCheck
+
+JSON_PATH = Path(__file__).parent.parent / "cloud_providers_v2.json"
+
+
+def make_targets(count: int) -> list:
+    """Generate a mix of hits and misses: IPv4, IPv6 and hostnames"""
+    random.seed(0)
+    with open(JSON_PATH) as f:
+        providers = json.load(f)
+    networks = []
+    domains = []
+    for provider in providers.values():
+        for cidr in provider["cidrs"]:
+            try:
+                networks.append(ipaddress.ip_network(cidr, strict=False))
+            except ValueError:
+                pass
+        domains.extend(provider["domains"])
+
+    targets = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            network = random.choice(networks)
+            address = int(network.network_address) + random.randrange(
+                network.num_addresses
+            )
+            targets.append(str(ipaddress.ip_address(address)))
+        elif kind == 1:
+            targets.append(str(ipaddress.IPv4Address(random.getrandbits(32))))
+        elif kind == 2:
+            targets.append(f"www{i}.{random.choice(domains)}")
+        else:
+            targets.append(f"www{i}.example.com")
+    return targets
+
+
+def benchmark(name: str, cloudcheck, targets: list):
+    """Time the first load, single lookups and a batch lookup"""
+    start = time.perf_counter()
+    cloudcheck.lookup_sync(targets[0])
+    load = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for target in targets:
+        cloudcheck.lookup_sync(target)
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cloudcheck.lookup_many_sync(targets)
+    batch = time.perf_counter() - start
+
+    print(
+        f"{name:<8} load {load * 1000:8.1f} ms   "
+        f"lookup_sync {len(targets) / single:12,.0f}/s   "
+        f"lookup_many_sync {len(targets) / batch:12,.0f}/s"
+    )
+
+
+def main():
+    targets = make_targets(100_000)
+    benchmark("python", PureCloudCheck(path=JSON_PATH), targets)
+    if Provider is None:
+        print("rust     (compiled extension not available)")
+    else:
+        from cloudcheck import CloudCheck
+
+        benchmark("rust", CloudCheck(path=JSON_PATH), targets)
+
+
+if __name__ == "__main__":
+    main()
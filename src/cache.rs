@@ -0,0 +1,259 @@
+use crate::index::{Index, fnv1a, normalize_target};
+use std::collections::HashMap;
+use std::sync::Mutex;
+
+/// Counters for the lookup cache.
+#[derive(Debug, Clone, Copy, Default, PartialEq, Eq)]
+pub struct CacheStats {
+    pub hits: u64,
+    pub misses: u64,
+    pub evictions: u64,
+    pub size: usize,
+    pub capacity: usize,
+}
+
+/// Upper bound on the number of shards of a `ShardedCache`.
+const MAX_SHARDS: usize = 16;
+/// Smallest capacity worth giving a shard of its own.
+const MIN_SHARD_CAPACITY: usize = 64;
+
+/// A `LookupCache` split into independently locked shards, picked by the
+/// hash of the key, so threads looking up different targets rarely wait on
+/// each other. Keys are normalized the way `Index::find()` normalizes
+/// targets, so `Example.com.` and `example.com` share an entry.
+pub(crate) struct ShardedCache {
+    shards: Box<[Mutex<LookupCache>]>,
+}
+
+impl ShardedCache {
+    pub(crate) fn new(capacity: usize) -> Self {
+        let count = (capacity / MIN_SHARD_CAPACITY).clamp(1, MAX_SHARDS);
+        let shards = (0..count)
+            .map(|i| {
+                // spread the remainder over the first shards
+                let shard_capacity = capacity / count + usize::from(i < capacity % count);
+                Mutex::new(LookupCache::new(shard_capacity))
+            })
+            .collect();
+        ShardedCache { shards }
+    }
+
+    pub(crate) fn stats(&self) -> CacheStats {
+        let mut total = CacheStats::default();
+        for shard in self.shards.iter() {
+            let stats = shard.lock().unwrap().stats();
+            total.hits += stats.hits;
+            total.misses += stats.misses;
+            total.evictions += stats.evictions;
+            total.size += stats.size;
+            total.capacity += stats.capacity;
+        }
+        total
+    }
+
+    /// Finds a target's provider set in `index`, through the cache. The shard
+    /// lock is not held during the index lookup.
+    pub(crate) fn find(&self, index: &Index, target: &str) -> Option<u32> {
+        let key = normalize_target(target);
+        let shard = &self.shards[fnv1a(key.as_bytes()) as usize % self.shards.len()];
+        let cached = shard.lock().unwrap().get(index.generation, &key);
+        match cached {
+            Some(set) => set,
+            None => {
+                let set = index.find(&key);
+                shard.lock().unwrap().insert(index.generation, &key, set);
+                set
+            }
+        }
+    }
+}
+
+const NIL: usize = usize::MAX;
+
+struct Entry {
+    key: String,
+    /// The matching provider set in the index, if any.
+    value: Option<u32>,
+    prev: usize,
+    next: usize,
+}
+
+/// A size-bounded LRU cache of lookup results, including misses, keyed by
+/// normalized target. Results are stored as provider set ids of the index they
+/// were found in. Entries live in a slab linked in recency order, so every
+/// operation is O(1).
+///
+/// Each cache belongs to one index generation. Asking for a different
+/// generation drops every entry, so results never outlive the data they came
+/// from.
+struct LookupCache {
+    capacity: usize,
+    generation: u64,
+    slots: HashMap<String, usize>,
+    entries: Vec<Entry>,
+    /// Most recently used entry.
+    head: usize,
+    /// Least recently used entry, evicted first.
+    tail: usize,
+    hits: u64,
+    misses: u64,
+    evictions: u64,
+}
+
+impl LookupCache {
+    fn new(capacity: usize) -> Self {
+        LookupCache {
+            capacity,
+            generation: 0,
+            slots: HashMap::with_capacity(capacity),
+            entries: Vec::with_capacity(capacity),
+            head: NIL,
+            tail: NIL,
+            hits: 0,
+            misses: 0,
+            evictions: 0,
+        }
+    }
+
+    fn stats(&self) -> CacheStats {
+        CacheStats {
+            hits: self.hits,
+            misses: self.misses,
+            evictions: self.evictions,
+            size: self.entries.len(),
+            capacity: self.capacity,
+        }
+    }
+
+    /// Drops every entry if `generation` differs from the cached one.
+    fn sync_generation(&mut self, generation: u64) {
+        if generation != self.generation {
+            self.slots.clear();
+            self.entries.clear();
+            self.head = NIL;
+            self.tail = NIL;
+            self.generation = generation;
+        }
+    }
+
+    fn get(&mut self, generation: u64, key: &str) -> Option<Option<u32>> {
+        self.sync_generation(generation);
+        match self.slots.get(key) {
+            Some(&slot) => {
+                self.hits += 1;
+                self.unlink(slot);
+                self.push_front(slot);
+                Some(self.entries[slot].value)
+            }
+            None => {
+                self.misses += 1;
+                None
+            }
+        }
+    }
+
+    fn insert(&mut self, generation: u64, key: &str, value: Option<u32>) {
+        // a result computed against an older index is not worth keeping
+        if generation != self.generation || self.capacity == 0 {
+            return;
+        }
+        if let Some(&slot) = self.slots.get(key) {
+            self.entries[slot].value = value;
+            self.unlink(slot);
+            self.push_front(slot);
+            return;
+        }
+        let key = key.to_string();
+        let slot = if self.entries.len() < self.capacity {
+            self.entries.push(Entry {
+                key: key.clone(),
+                value,
+                prev: NIL,
+                next: NIL,
+            });
+            self.entries.len() - 1
+        } else {
+            let slot = self.tail;
+            self.unlink(slot);
+            let entry = &mut self.entries[slot];
+            self.slots.remove(&entry.key);
+            entry.key.clone_from(&key);
+            entry.value = value;
+            self.evictions += 1;
+            slot
+        };
+        self.slots.insert(key, slot);
+        self.push_front(slot);
+    }
+
+    fn unlink(&mut self, slot: usize) {
+        let (prev, next) = (self.entries[slot].prev, self.entries[slot].next);
+        match prev {
+            NIL => self.head = next,
+            prev => self.entries[prev].next = next,
+        }
+        match next {
+            NIL => self.tail = prev,
+            next => self.entries[next].prev = prev,
+        }
+    }
+
+    fn push_front(&mut self, slot: usize) {
+        self.entries[slot].prev = NIL;
+        self.entries[slot].next = self.head;
+        match self.head {
+            NIL => self.tail = slot,
+            head => self.entries[head].prev = slot,
+        }
+        self.head = slot;
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_lru_eviction_order() {
+        let mut cache = LookupCache::new(2);
+        assert_eq!(cache.get(1, "a.com"), None);
+        cache.insert(1, "a.com", Some(0));
+        cache.insert(1, "b.com", None);
+        // touching a.com makes b.com the least recently used entry
+        assert_eq!(cache.get(1, "a.com"), Some(Some(0)));
+        cache.insert(1, "c.com", Some(2));
+        assert_eq!(cache.get(1, "b.com"), None);
+        assert_eq!(cache.get(1, "a.com"), Some(Some(0)));
+        assert_eq!(cache.get(1, "c.com"), Some(Some(2)));
+        assert_eq!(
+            cache.stats(),
+            CacheStats {
+                hits: 3,
+                misses: 2,
+                evictions: 1,
+                size: 2,
+                capacity: 2,
+            }
+        );
+    }
+
+    #[test]
+    fn test_new_generation_invalidates() {
+        let mut cache = LookupCache::new(4);
+        cache.get(1, "a.com");
+        cache.insert(1, "a.com", Some(0));
+        assert_eq!(cache.get(2, "a.com"), None);
+        assert_eq!(cache.stats().size, 0);
+        // results computed against the old index are dropped
+        cache.insert(1, "a.com", Some(0));
+        assert_eq!(cache.get(2, "a.com"), None);
+    }
+
+    #[test]
+    fn test_shards_split_capacity() {
+        let cache = ShardedCache::new(1000);
+        assert_eq!(cache.shards.len(), MAX_SHARDS - 1);
+        assert_eq!(cache.stats().capacity, 1000);
+        assert_eq!(ShardedCache::new(2).shards.len(), 1);
+    }
+}
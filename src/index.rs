@@ -0,0 +1,1341 @@
+//! The lookup index, stored as one flat binary blob.
+//!
+//! The radix tree is only used while building: once every CIDR and domain has
+//! been inserted in ACL mode, the surviving entries no longer overlap, so they
+//! can be laid out as sorted IPv4/IPv6 range tables and a hash table of
+//! domains. Lookups read those tables straight from the blob, which is either
+//! built in memory or memory-mapped from a snapshot file, so both paths share
+//! one lookup implementation.
+//!
+//! ACL mode folds a prefix nested inside another one into it, which is what a
+//! lookup wants but loses which provider owns which prefix. Range queries use
+//! separate prefix tables with every provider's own CIDRs instead.
+//!
+//! Layout (all integers little-endian):
+//!
+//! ```text
+//! header     80 bytes: magic, version, source hash and section sizes
+//! meta       JSON: the provider table and the distinct provider sets
+//! ipv4       ipv4_count x (start u32, end u32, set u32), sorted by start
+//! ipv6       ipv6_count x (start u128, end u128, set u32), sorted by start
+//! domains    domain_slots x (hash u64, string offset u32, set u32), open addressing
+//! strings    domain names, each prefixed with its length as a u16
+//! prefixes4  prefix4_count x (start u32, end u32, set u32), unfolded
+//! prefixes6  prefix6_count x (start u128, end u128, set u32), unfolded
+//! ```
+//!
+//! The prefix tables are sorted by start, and by size (largest first) among
+//! prefixes with the same start.
+
+use crate::stats::HitCounts;
+use crate::{CloudProvider, Error, PARALLEL_BATCH_THRESHOLD, ProvidersMap, RangeOverlap};
+use log::debug;
+use radixtarget::RadixTarget;
+use radixtarget::utils::normalize_dns;
+use serde::{Deserialize, Serialize};
+use std::borrow::Cow;
+use std::cmp::Reverse;
+use std::collections::{BTreeSet, HashMap};
+use std::net::{IpAddr, Ipv4Addr, Ipv6Addr};
+use std::ops::{Deref, Range};
+use std::path::Path;
+use std::sync::atomic::{AtomicU64, Ordering};
+
+const MAGIC: &[u8; 8] = b"CCINDEX\0";
+/// Bump whenever the layout changes, so stale snapshots are rebuilt.
+const VERSION: u32 = 3;
+const HEADER_LEN: usize = 80;
+const IPV4_RECORD_LEN: usize = 12;
+const IPV6_RECORD_LEN: usize = 36;
+const DOMAIN_SLOT_LEN: usize = 16;
+const EMPTY_SLOT: u32 = u32::MAX;
+
+/// Source of `Index::generation` values.
+static NEXT_GENERATION: AtomicU64 = AtomicU64::new(1);
+
+/// 64-bit FNV-1a. Used for domain slots and to key snapshots on their source
+/// JSON; unlike `DefaultHasher` it is stable across Rust releases.
+pub(crate) fn fnv1a(bytes: &[u8]) -> u64 {
+    let mut hash: u64 = 0xcbf29ce484222325;
+    for &b in bytes {
+        hash ^= b as u64;
+        hash = hash.wrapping_mul(0x100000001b3);
+    }
+    hash
+}
+
+/// The provider table and provider sets, stored as JSON since they are tiny
+/// compared to the range and domain tables.
+#[derive(Serialize, Deserialize)]
+struct Meta {
+    /// Sorted by name. A provider's id is its position plus one.
+    providers: Vec<CloudProvider>,
+    /// Distinct sets of provider positions that entries point to.
+    sets: Vec<Vec<u32>>,
+}
+
+/// IDNA-encodes a hostname and strips any trailing dot, so `Example.com.`
+/// and `example.com` are the same target.
+fn normalize_hostname(hostname: &str) -> Option<String> {
+    let mut hostname = normalize_dns(hostname).ok()?;
+    hostname.truncate(hostname.trim_end_matches('.').len());
+    Some(hostname)
+}
+
+/// The form of a target that `Index::find()` searches for: IP addresses and
+/// networks are kept as they are, hostnames are normalized. Targets that are
+/// neither match nothing and are kept as they are too.
+pub(crate) fn normalize_target(target: &str) -> Cow<'_, str> {
+    if parse_ip_range(target).is_some() {
+        return Cow::Borrowed(target);
+    }
+    match normalize_hostname(target) {
+        Some(hostname) if hostname != target => Cow::Owned(hostname),
+        _ => Cow::Borrowed(target),
+    }
+}
+
+/// Parses an IP address or network the way `RadixTarget` does, returning the
+/// first and last address it covers. Host bits of a network are ignored.
+fn parse_ip_range(value: &str) -> Option<IpRange> {
+    let (addr, prefix) = match value.split_once('/') {
+        Some((addr, prefix)) => (addr.parse::<IpAddr>().ok()?, prefix.parse::<u8>().ok()?),
+        None => {
+            let addr = value.parse::<IpAddr>().ok()?;
+            (addr, if addr.is_ipv4() { 32 } else { 128 })
+        }
+    };
+    match addr {
+        IpAddr::V4(addr) if prefix <= 32 => {
+            let mask = u32::MAX.checked_shl(32 - prefix as u32).unwrap_or(0);
+            let start = u32::from(addr) & mask;
+            Some(IpRange::V4(start, start | !mask))
+        }
+        IpAddr::V6(addr) if prefix <= 128 => {
+            let mask = u128::MAX.checked_shl(128 - prefix as u32).unwrap_or(0);
+            let start = u128::from(addr) & mask;
+            Some(IpRange::V6(start, start | !mask))
+        }
+        _ => None,
+    }
+}
+
+/// A provider prefix overlapping a queried range (see `Index::find_overlaps`),
+/// with the ids of its providers rather than copies of them.
+#[derive(Debug, Clone, PartialEq)]
+pub(crate) struct Overlap {
+    pub(crate) prefix: String,
+    /// Sorted provider ids.
+    pub(crate) ids: Vec<u32>,
+    pub(crate) covered: u128,
+}
+
+#[derive(Debug, Clone, Copy, PartialEq, Eq, Hash)]
+enum IpRange {
+    V4(u32, u32),
+    V6(u128, u128),
+}
+
+impl IpRange {
+    fn of(addr: IpAddr) -> Self {
+        match addr {
+            IpAddr::V4(addr) => IpRange::V4(u32::from(addr), u32::from(addr)),
+            IpAddr::V6(addr) => IpRange::V6(u128::from(addr), u128::from(addr)),
+        }
+    }
+}
+
+/// Every provider's own IP networks, before the radix tree folds nested ones
+/// into their parents, with the sorted ids of the providers that list each.
+#[derive(Default)]
+pub(crate) struct Prefixes(HashMap<IpRange, Vec<u32>>);
+
+impl Prefixes {
+    /// Adds a provider's CIDR. Anything that is not an IP network is ignored.
+    pub(crate) fn add(&mut self, cidr: &str, id: u32) {
+        if let Some(range) = parse_ip_range(cidr) {
+            crate::add_provider_id(self.0.entry(range).or_default(), id);
+        }
+    }
+}
+
+/// Distinct provider sets, numbered in order of first use.
+#[derive(Default)]
+struct SetTable {
+    sets: Vec<Vec<u32>>,
+    ids: HashMap<Vec<u32>, u32>,
+}
+
+impl SetTable {
+    fn id(&mut self, set: &[u32]) -> u32 {
+        if let Some(&id) = self.ids.get(set) {
+            return id;
+        }
+        self.sets.push(set.to_vec());
+        self.ids.insert(set.to_vec(), self.sets.len() as u32 - 1);
+        self.sets.len() as u32 - 1
+    }
+}
+
+/// Serializes the entries of a radix tree built in ACL mode (see
+/// `CloudCheck::build_data_structures`), and the unfolded `prefixes`, into
+/// the binary index format. `providers_map` and `prefixes` hold ids into
+/// `providers`.
+pub(crate) fn serialize(
+    radix: &RadixTarget,
+    providers: Vec<CloudProvider>,
+    providers_map: &ProvidersMap,
+    prefixes: &Prefixes,
+    source_hash: u64,
+) -> Vec<u8> {
+    let mut sets = SetTable::default();
+    let mut ipv4: Vec<(u32, u32, u32)> = Vec::new();
+    let mut ipv6: Vec<(u128, u128, u32)> = Vec::new();
+    let mut domains: Vec<(String, u32)> = Vec::new();
+
+    // only the entries still in the tree are reachable; keys that were
+    // swallowed by a parent entry are left behind in providers_map
+    for host in radix.hosts() {
+        let Some(set) = providers_map.get(&host) else {
+            continue;
+        };
+        let set_id = sets.id(set);
+        match parse_ip_range(&host) {
+            Some(IpRange::V4(start, end)) => ipv4.push((start, end, set_id)),
+            Some(IpRange::V6(start, end)) => ipv6.push((start, end, set_id)),
+            None => domains.push((host, set_id)),
+        }
+    }
+    ipv4.sort_unstable();
+    ipv6.sort_unstable();
+    domains.sort_unstable();
+
+    let mut prefixes4: Vec<(u32, u32, u32)> = Vec::new();
+    let mut prefixes6: Vec<(u128, u128, u32)> = Vec::new();
+    for (range, ids) in &prefixes.0 {
+        match *range {
+            IpRange::V4(start, end) => prefixes4.push((start, end, sets.id(ids))),
+            IpRange::V6(start, end) => prefixes6.push((start, end, sets.id(ids))),
+        }
+    }
+    prefixes4.sort_unstable_by_key(|&(start, end, _)| (start, Reverse(end)));
+    prefixes6.sort_unstable_by_key(|&(start, end, _)| (start, Reverse(end)));
+    let sets = sets.sets;
+
+    let meta = serde_json::to_vec(&Meta { providers, sets }).expect("index meta is serializable");
+
+    // keep the domain table at most half full
+    let domain_slots = (domains.len() * 2).next_power_of_two();
+    let mut slots = vec![(0u64, 0u32, EMPTY_SLOT); domain_slots];
+    let mut strings: Vec<u8> = Vec::new();
+    for (domain, set_id) in &domains {
+        // a hostname has at most 253 characters, so this is not one
+        let Ok(len) = u16::try_from(domain.len()) else {
+            debug!("Skipping {}-byte domain", domain.len());
+            continue;
+        };
+        let hash = fnv1a(domain.as_bytes());
+        let mut slot = hash as usize & (domain_slots - 1);
+        while slots[slot].2 != EMPTY_SLOT {
+            slot = (slot + 1) & (domain_slots - 1);
+        }
+        slots[slot] = (hash, strings.len() as u32, *set_id);
+        strings.extend_from_slice(&len.to_le_bytes());
+        strings.extend_from_slice(domain.as_bytes());
+    }
+
+    let mut out = Vec::with_capacity(
+        HEADER_LEN
+            + meta.len()
+            + ipv4.len() * IPV4_RECORD_LEN
+            + ipv6.len() * IPV6_RECORD_LEN
+            + domain_slots * DOMAIN_SLOT_LEN
+            + strings.len()
+            + prefixes4.len() * IPV4_RECORD_LEN
+            + prefixes6.len() * IPV6_RECORD_LEN,
+    );
+    out.extend_from_slice(MAGIC);
+    out.extend_from_slice(&VERSION.to_le_bytes());
+    out.extend_from_slice(&0u32.to_le_bytes());
+    out.extend_from_slice(&source_hash.to_le_bytes());
+    for len in [
+        meta.len(),
+        ipv4.len(),
+        ipv6.len(),
+        domain_slots,
+        strings.len(),
+        prefixes4.len(),
+        prefixes6.len(),
+    ] {
+        out.extend_from_slice(&(len as u64).to_le_bytes());
+    }
+    out.resize(HEADER_LEN, 0);
+    out.extend_from_slice(&meta);
+    write_v4_records(&mut out, &ipv4);
+    write_v6_records(&mut out, &ipv6);
+    for (hash, offset, set_id) in slots {
+        out.extend_from_slice(&hash.to_le_bytes());
+        out.extend_from_slice(&offset.to_le_bytes());
+        out.extend_from_slice(&set_id.to_le_bytes());
+    }
+    out.extend_from_slice(&strings);
+    write_v4_records(&mut out, &prefixes4);
+    write_v6_records(&mut out, &prefixes6);
+    out
+}
+
+fn write_v4_records(out: &mut Vec<u8>, records: &[(u32, u32, u32)]) {
+    for (start, end, set_id) in records {
+        out.extend_from_slice(&start.to_le_bytes());
+        out.extend_from_slice(&end.to_le_bytes());
+        out.extend_from_slice(&set_id.to_le_bytes());
+    }
+}
+
+fn write_v6_records(out: &mut Vec<u8>, records: &[(u128, u128, u32)]) {
+    for (start, end, set_id) in records {
+        out.extend_from_slice(&start.to_le_bytes());
+        out.extend_from_slice(&end.to_le_bytes());
+        out.extend_from_slice(&set_id.to_le_bytes());
+    }
+}
+
+/// Writes a snapshot atomically, so concurrent readers never see a partial
+/// file and existing memory maps keep pointing at the old one.
+pub(crate) fn write_snapshot(path: &Path, bytes: &[u8]) -> std::io::Result<()> {
+    if let Some(parent) = path.parent() {
+        std::fs::create_dir_all(parent)?;
+    }
+    let tmp_path = path.with_extension(format!("{}.tmp", std::process::id()));
+    std::fs::write(&tmp_path, bytes)?;
+    std::fs::rename(&tmp_path, path).inspect_err(|_| {
+        let _ = std::fs::remove_file(&tmp_path);
+    })
+}
+
+/// The bytes behind an index.
+pub(crate) enum IndexData {
+    Owned(Vec<u8>),
+    Mapped(memmap2::Mmap),
+}
+
+impl Deref for IndexData {
+    type Target = [u8];
+
+    fn deref(&self) -> &[u8] {
+        match self {
+            IndexData::Owned(bytes) => bytes,
+            IndexData::Mapped(mmap) => mmap,
+        }
+    }
+}
+
+fn read_u16(bytes: &[u8], at: usize) -> u16 {
+    u16::from_le_bytes(bytes[at..at + 2].try_into().unwrap())
+}
+
+fn read_u32(bytes: &[u8], at: usize) -> u32 {
+    u32::from_le_bytes(bytes[at..at + 4].try_into().unwrap())
+}
+
+fn read_u64(bytes: &[u8], at: usize) -> u64 {
+    u64::from_le_bytes(bytes[at..at + 8].try_into().unwrap())
+}
+
+fn read_u128(bytes: &[u8], at: usize) -> u128 {
+    u128::from_le_bytes(bytes[at..at + 16].try_into().unwrap())
+}
+
+/// A loaded index. Lookups hold an `Arc` to this for as long as they need it,
+/// so a refresh never invalidates an in-flight batch.
+pub(crate) struct Index {
+    /// Unique per loaded index, so caches can tell when the data was swapped.
+    pub(crate) generation: u64,
+    data: IndexData,
+    ipv4: Range<usize>,
+    ipv6: Range<usize>,
+    domains: Range<usize>,
+    strings: Range<usize>,
+    prefixes4: Range<usize>,
+    prefixes6: Range<usize>,
+    /// Every provider, sorted by name. A provider's id is its position.
+    providers: Vec<CloudProvider>,
+    /// Sorted provider ids of each set.
+    sets: Vec<Vec<u32>>,
+    /// (lowest provider id, tag mask) for each set.
+    summaries: Vec<(u32, u64)>,
+    /// Lookups answered by this index, and how many of them matched each set.
+    lookups: AtomicU64,
+    set_hits: Vec<AtomicU64>,
+    /// Sorted provider names. A provider's id is its position plus one.
+    pub(crate) provider_names: Vec<String>,
+    /// Sorted tag names. A tag's bit in a tag mask is its position.
+    pub(crate) tag_names: Vec<String>,
+}
+
+impl Index {
+    /// Validates the header and section sizes and loads the provider table.
+    /// If `source_hash` is given, the index must have been built from it.
+    pub(crate) fn from_data(data: IndexData, source_hash: Option<u64>) -> Result<Self, Error> {
+        if data.len() < HEADER_LEN || &data[..8] != MAGIC {
+            return Err("Not a cloudcheck index".into());
+        }
+        let version = read_u32(&data, 8);
+        if version != VERSION {
+            return Err(format!("Unsupported index version {}", version).into());
+        }
+        if let Some(expected) = source_hash
+            && read_u64(&data, 16) != expected
+        {
+            return Err("Index was built from different data".into());
+        }
+        let section_len = |i: usize| read_u64(&data, 24 + 8 * i) as usize;
+        let (meta_len, ipv4_count, ipv6_count, domain_slots, strings_len) = (
+            section_len(0),
+            section_len(1),
+            section_len(2),
+            section_len(3),
+            section_len(4),
+        );
+        let (prefix4_count, prefix6_count) = (section_len(5), section_len(6));
+        if !domain_slots.is_power_of_two() {
+            return Err("Corrupt index: bad domain table size".into());
+        }
+        let mut offset = HEADER_LEN;
+        let mut section = |len: usize| {
+            let range = offset..offset.saturating_add(len);
+            offset = range.end;
+            range
+        };
+        let meta = section(meta_len);
+        let ipv4 = section(ipv4_count.saturating_mul(IPV4_RECORD_LEN));
+        let ipv6 = section(ipv6_count.saturating_mul(IPV6_RECORD_LEN));
+        let domains = section(domain_slots.saturating_mul(DOMAIN_SLOT_LEN));
+        let strings = section(strings_len);
+        let prefixes4 = section(prefix4_count.saturating_mul(IPV4_RECORD_LEN));
+        let prefixes6 = section(prefix6_count.saturating_mul(IPV6_RECORD_LEN));
+        if prefixes6.end != data.len() {
+            return Err("Corrupt index: size mismatch".into());
+        }
+
+        let meta: Meta = serde_json::from_slice(&data[meta])?;
+        let tag_names: Vec<String> = meta
+            .providers
+            .iter()
+            .flat_map(|p| p.tags.iter().cloned())
+            .collect::<BTreeSet<_>>()
+            .into_iter()
+            .collect();
+        if tag_names.len() > 64 {
+            debug!("More than 64 tags, tag masks will only cover the first 64");
+        }
+        let mut summaries = Vec::with_capacity(meta.sets.len());
+        for set in &meta.sets {
+            let mut tag_mask = 0u64;
+            for &pos in set {
+                let provider = meta
+                    .providers
+                    .get(pos as usize)
+                    .ok_or("Corrupt index: bad provider id")?;
+                for tag in &provider.tags {
+                    if let Ok(bit) = tag_names.binary_search(tag) {
+                        tag_mask |= 1u64.checked_shl(bit as u32).unwrap_or(0);
+                    }
+                }
+            }
+            // sets are sorted, so the first entry has the lowest id
+            let provider_id = set.first().map_or(0, |&pos| pos + 1);
+            summaries.push((provider_id, tag_mask));
+        }
+
+        let index = Index {
+            generation: NEXT_GENERATION.fetch_add(1, Ordering::Relaxed),
+            data,
+            ipv4,
+            ipv6,
+            domains,
+            strings,
+            prefixes4,
+            prefixes6,
+            set_hits: meta.sets.iter().map(|_| AtomicU64::new(0)).collect(),
+            lookups: AtomicU64::new(0),
+            summaries,
+            provider_names: meta.providers.iter().map(|p| p.name.clone()).collect(),
+            tag_names,
+            providers: meta.providers,
+            sets: meta.sets,
+        };
+        index.validate()?;
+        Ok(index)
+    }
+
+    /// Checks every set id and string offset, that the ranges are sorted and
+    /// disjoint, and that the prefix tables hold sorted, distinct CIDRs, once
+    /// up front, so lookups can index into the tables without returning errors.
+    fn validate(&self) -> Result<(), Error> {
+        let sets = self.sets.len() as u32;
+        let corrupt = || -> Error { "Corrupt index: bad record".into() };
+        let mut previous = None;
+        for i in 0..self.ipv4.len() / IPV4_RECORD_LEN {
+            let (start, end, set) = self.ipv4_record(&self.ipv4, i);
+            if start > end || set >= sets || previous.is_some_and(|prev| start <= prev) {
+                return Err(corrupt());
+            }
+            previous = Some(end);
+        }
+        let mut previous = None;
+        for i in 0..self.ipv6.len() / IPV6_RECORD_LEN {
+            let (start, end, set) = self.ipv6_record(&self.ipv6, i);
+            if start > end || set >= sets || previous.is_some_and(|prev| start <= prev) {
+                return Err(corrupt());
+            }
+            previous = Some(end);
+        }
+        let mut previous = None;
+        for i in 0..self.prefixes4.len() / IPV4_RECORD_LEN {
+            let (start, end, set) = self.ipv4_record(&self.prefixes4, i);
+            let span = end.wrapping_sub(start);
+            let key = (start, Reverse(end));
+            if start > end
+                || span & span.wrapping_add(1) != 0
+                || start & span != 0
+                || set >= sets
+                || previous.is_some_and(|prev| key <= prev)
+            {
+                return Err(corrupt());
+            }
+            previous = Some(key);
+        }
+        let mut previous = None;
+        for i in 0..self.prefixes6.len() / IPV6_RECORD_LEN {
+            let (start, end, set) = self.ipv6_record(&self.prefixes6, i);
+            let span = end.wrapping_sub(start);
+            let key = (start, Reverse(end));
+            if start > end
+                || span & span.wrapping_add(1) != 0
+                || start & span != 0
+                || set >= sets
+                || previous.is_some_and(|prev| key <= prev)
+            {
+                return Err(corrupt());
+            }
+            previous = Some(key);
+        }
+        let strings = &self.data[self.strings.clone()];
+        for slot in 0..self.domain_slots() {
+            let (_, offset, set) = self.domain_slot(slot);
+            if set == EMPTY_SLOT {
+                continue;
+            }
+            let offset = offset as usize;
+            if set >= sets
+                || offset + 2 > strings.len()
+                || offset + 2 + read_u16(strings, offset) as usize > strings.len()
+            {
+                return Err(corrupt());
+            }
+        }
+        Ok(())
+    }
+
+    /// Loads a snapshot file by memory-mapping it. The map is a read-only
+    /// shared mapping backed by the page cache, so every process that maps the
+    /// same file shares one copy of it.
+    pub(crate) fn open(path: &Path, source_hash: Option<u64>) -> Result<Self, Error> {
+        let file = std::fs::File::open(path)?;
+        // SAFETY: snapshots are only ever replaced by atomic renames (see
+        // write_snapshot), never modified in place, so the mapped file does not
+        // change underneath us.
+        let mmap = unsafe { memmap2::Mmap::map(&file)? };
+        Self::from_data(IndexData::Mapped(mmap), source_hash)
+    }
+
+    /// The serialized index, as written to snapshots.
+    pub(crate) fn bytes(&self) -> &[u8] {
+        &self.data
+    }
+
+    /// Size of the index data in bytes.
+    pub(crate) fn size(&self) -> usize {
+        self.data.len()
+    }
+
+    /// Whether the index data is memory-mapped from a file rather than owned.
+    pub(crate) fn is_mapped(&self) -> bool {
+        matches!(self.data, IndexData::Mapped(_))
+    }
+
+    /// Approximate memory used by the index: its data plus the decoded
+    /// provider table and sets.
+    pub(crate) fn memory_usage(&self) -> usize {
+        let providers: usize = self
+            .providers
+            .iter()
+            .map(|p| {
+                std::mem::size_of::<CloudProvider>()
+                    + p.name.len()
+                    + p.short_description.len()
+                    + p.long_description.len()
+                    + p.tags.iter().map(|t| t.len() + 24).sum::<usize>()
+            })
+            .sum();
+        let sets: usize = self.sets.iter().map(|set| 24 + set.len() * 4).sum();
+        self.data.len() + providers + sets + self.summaries.len() * 24
+    }
+
+    /// Returns the number of lookups answered by this index, and how many of
+    /// them matched any provider, each provider and each tag.
+    pub(crate) fn hit_counts(&self) -> HitCounts {
+        let mut counts = HitCounts {
+            lookups: self.lookups.load(Ordering::Relaxed),
+            ..HitCounts::default()
+        };
+        for (set, counter) in self.set_hits.iter().enumerate() {
+            let hits = counter.load(Ordering::Relaxed);
+            if hits == 0 {
+                continue;
+            }
+            counts.hits += hits;
+            for provider in self.members(Some(set as u32)) {
+                *counts.by_provider.entry(provider.name.clone()).or_default() += hits;
+            }
+            let tag_mask = self.summaries[set].1;
+            for (bit, tag) in self.tag_names.iter().enumerate().take(64) {
+                if tag_mask & (1 << bit) != 0 {
+                    *counts.by_tag.entry(tag.clone()).or_default() += hits;
+                }
+            }
+        }
+        counts
+    }
+
+    /// Reads record `i` of an IPv4 table (`ipv4` or `prefixes4`).
+    fn ipv4_record(&self, table: &Range<usize>, i: usize) -> (u32, u32, u32) {
+        let at = table.start + i * IPV4_RECORD_LEN;
+        (
+            read_u32(&self.data, at),
+            read_u32(&self.data, at + 4),
+            read_u32(&self.data, at + 8),
+        )
+    }
+
+    /// Reads record `i` of an IPv6 table (`ipv6` or `prefixes6`).
+    fn ipv6_record(&self, table: &Range<usize>, i: usize) -> (u128, u128, u32) {
+        let at = table.start + i * IPV6_RECORD_LEN;
+        (
+            read_u128(&self.data, at),
+            read_u128(&self.data, at + 16),
+            read_u32(&self.data, at + 32),
+        )
+    }
+
+    fn domain_slots(&self) -> usize {
+        self.domains.len() / DOMAIN_SLOT_LEN
+    }
+
+    fn domain_slot(&self, slot: usize) -> (u64, u32, u32) {
+        let at = self.domains.start + slot * DOMAIN_SLOT_LEN;
+        (
+            read_u64(&self.data, at),
+            read_u32(&self.data, at + 8),
+            read_u32(&self.data, at + 12),
+        )
+    }
+
+    /// Finds the entry that fully contains the given range. Entries never
+    /// overlap, so this is the last entry starting at or before `start`.
+    fn find_range(&self, range: IpRange) -> Option<u32> {
+        match range {
+            IpRange::V4(start, end) => {
+                let count = self.ipv4.len() / IPV4_RECORD_LEN;
+                let pos = partition_point(count, |i| self.ipv4_record(&self.ipv4, i).0 <= start);
+                let (_, entry_end, set) = self.ipv4_record(&self.ipv4, pos.checked_sub(1)?);
+                (end <= entry_end).then_some(set)
+            }
+            IpRange::V6(start, end) => {
+                let count = self.ipv6.len() / IPV6_RECORD_LEN;
+                let pos = partition_point(count, |i| self.ipv6_record(&self.ipv6, i).0 <= start);
+                let (_, entry_end, set) = self.ipv6_record(&self.ipv6, pos.checked_sub(1)?);
+                (end <= entry_end).then_some(set)
+            }
+        }
+    }
+
+    /// Returns every provider prefix overlapping the given IP address or
+    /// network, in address order (outer prefixes before the ones nested in
+    /// them). These are the providers' own CIDRs, so a prefix nested inside
+    /// another provider's is reported separately, with only its own providers.
+    /// Returns None if `cidr` is not an IP address or network.
+    ///
+    /// A prefix overlapping the range either starts inside it, and those are
+    /// found with a binary search, or contains its first address. There is at
+    /// most one of the latter per prefix length, so each is looked up exactly.
+    pub(crate) fn find_overlaps(&self, cidr: &str) -> Option<Vec<Overlap>> {
+        let mut overlaps = Vec::new();
+        match parse_ip_range(cidr)? {
+            IpRange::V4(start, end) => {
+                let table = &self.prefixes4;
+                let count = table.len() / IPV4_RECORD_LEN;
+                let key = |i| {
+                    let (entry_start, entry_end, _) = self.ipv4_record(table, i);
+                    (entry_start, Reverse(entry_end))
+                };
+                let mut records = Vec::new();
+                for prefix_len in 0..32 {
+                    let mask = u32::MAX.checked_shl(32 - prefix_len).unwrap_or(0);
+                    if start & mask == start {
+                        break;
+                    }
+                    let wanted = (start & mask, Reverse(start | !mask));
+                    let i = partition_point(count, |i| key(i) < wanted);
+                    if i < count && key(i) == wanted {
+                        records.push(i);
+                    }
+                }
+                let first = partition_point(count, |i| key(i).0 < start);
+                records.extend((first..count).take_while(|&i| key(i).0 <= end));
+                for i in records {
+                    let (entry_start, entry_end, set) = self.ipv4_record(table, i);
+                    let prefix_len = 32 - (entry_end - entry_start).count_ones();
+                    overlaps.push(Overlap {
+                        prefix: format!("{}/{}", Ipv4Addr::from(entry_start), prefix_len),
+                        ids: self.member_ids(Some(set)).to_vec(),
+                        covered: (entry_end.min(end) - entry_start.max(start)) as u128 + 1,
+                    });
+                }
+            }
+            IpRange::V6(start, end) => {
+                let table = &self.prefixes6;
+                let count = table.len() / IPV6_RECORD_LEN;
+                let key = |i| {
+                    let (entry_start, entry_end, _) = self.ipv6_record(table, i);
+                    (entry_start, Reverse(entry_end))
+                };
+                let mut records = Vec::new();
+                for prefix_len in 0..128 {
+                    let mask = u128::MAX.checked_shl(128 - prefix_len).unwrap_or(0);
+                    if start & mask == start {
+                        break;
+                    }
+                    let wanted = (start & mask, Reverse(start | !mask));
+                    let i = partition_point(count, |i| key(i) < wanted);
+                    if i < count && key(i) == wanted {
+                        records.push(i);
+                    }
+                }
+                let first = partition_point(count, |i| key(i).0 < start);
+                records.extend((first..count).take_while(|&i| key(i).0 <= end));
+                for i in records {
+                    let (entry_start, entry_end, set) = self.ipv6_record(table, i);
+                    let prefix_len = 128 - (entry_end - entry_start).count_ones();
+                    overlaps.push(Overlap {
+                        prefix: format!("{}/{}", Ipv6Addr::from(entry_start), prefix_len),
+                        ids: self.member_ids(Some(set)).to_vec(),
+                        // saturates only for ::/0 against ::/0
+                        covered: (entry_end.min(end) - entry_start.max(start)).saturating_add(1),
+                    });
+                }
+            }
+        }
+        Some(overlaps)
+    }
+
+    fn find_domain_exact(&self, domain: &str) -> Option<u32> {
+        let slots = self.domain_slots();
+        if slots == 0 {
+            return None;
+        }
+        let hash = fnv1a(domain.as_bytes());
+        let strings = &self.data[self.strings.clone()];
+        let mut slot = hash as usize & (slots - 1);
+        for _ in 0..slots {
+            let (slot_hash, offset, set) = self.domain_slot(slot);
+            if set == EMPTY_SLOT {
+                return None;
+            }
+            if slot_hash == hash {
+                let offset = offset as usize;
+                let len = read_u16(strings, offset) as usize;
+                if &strings[offset + 2..offset + 2 + len] == domain.as_bytes() {
+                    return Some(set);
+                }
+            }
+            slot = (slot + 1) & (slots - 1);
+        }
+        None
+    }
+
+    /// Finds the entry for a hostname or any of its parent domains.
+    fn find_domain(&self, hostname: &str) -> Option<u32> {
+        if let Some(set) = self.find_domain_exact(hostname) {
+            return Some(set);
+        }
+        hostname
+            .match_indices('.')
+            .find_map(|(i, _)| self.find_domain_exact(&hostname[i + 1..]))
+    }
+
+    /// Returns the id of the provider set matching a target, if any.
+    pub(crate) fn find(&self, target: &str) -> Option<u32> {
+        match parse_ip_range(target) {
+            Some(range) => self.find_range(range),
+            None => self.find_domain(&normalize_hostname(target)?),
+        }
+    }
+
+    /// Every provider, sorted by name. A provider's id is its position.
+    #[cfg_attr(not(feature = "py"), allow(dead_code))]
+    pub(crate) fn provider_table(&self) -> &[CloudProvider] {
+        &self.providers
+    }
+
+    /// The sorted provider ids of a set returned by `find()`.
+    pub(crate) fn member_ids(&self, set: Option<u32>) -> &[u32] {
+        match set {
+            Some(set) => &self.sets[set as usize],
+            None => &[],
+        }
+    }
+
+    /// The providers in a set returned by `find()`, borrowed from the
+    /// provider table.
+    pub(crate) fn members(&self, set: Option<u32>) -> impl Iterator<Item = &CloudProvider> {
+        self.member_ids(set)
+            .iter()
+            .map(|&id| &self.providers[id as usize])
+    }
+
+    /// Converts an `Overlap` into a `RangeOverlap` with copies of its providers.
+    pub(crate) fn range_overlap(&self, overlap: Overlap) -> RangeOverlap {
+        RangeOverlap {
+            providers: overlap
+                .ids
+                .iter()
+                .map(|&id| self.providers[id as usize].clone())
+                .collect(),
+            prefix: overlap.prefix,
+            covered: overlap.covered,
+        }
+    }
+
+    /// Owned copies of the providers in a set returned by `find()`.
+    pub(crate) fn providers(&self, set: Option<u32>) -> Vec<CloudProvider> {
+        self.members(set).cloned().collect()
+    }
+
+    /// Counts one lookup and its result towards the hit counters.
+    pub(crate) fn record(&self, set: Option<u32>) {
+        self.lookups.fetch_add(1, Ordering::Relaxed);
+        if let Some(set) = set {
+            self.set_hits[set as usize].fetch_add(1, Ordering::Relaxed);
+        }
+    }
+
+    /// Adds counts collected by a `LocalHits` to the hit counters.
+    fn record_local(&self, local: LocalHits) {
+        self.lookups.fetch_add(local.lookups, Ordering::Relaxed);
+        for (counter, &hits) in self.set_hits.iter().zip(&local.sets) {
+            if hits > 0 {
+                counter.fetch_add(hits, Ordering::Relaxed);
+            }
+        }
+    }
+
+    /// Finds the set of every target with `find` (`Index::find()` or a cached
+    /// version of it), splitting the batch into one chunk per core. Results
+    /// are returned in input order.
+    pub(crate) fn find_parallel<F>(&self, targets: &[String], find: F) -> Vec<Option<u32>>
+    where
+        F: Fn(&Index, &str) -> Option<u32> + Sync,
+    {
+        let find = &find;
+        let chunk_size = parallel_chunk_size(targets.len());
+        std::thread::scope(|scope| {
+            let handles: Vec<_> = targets
+                .chunks(chunk_size)
+                .map(|chunk| {
+                    scope.spawn(move || {
+                        let mut hits = LocalHits::new(self);
+                        let results = chunk
+                            .iter()
+                            .map(|target| hits.add(find(self, target)))
+                            .collect::<Vec<_>>();
+                        self.record_local(hits);
+                        results
+                    })
+                })
+                .collect();
+            handles
+                .into_iter()
+                .flat_map(|handle| handle.join().expect("lookup thread panicked"))
+                .collect()
+        })
+    }
+
+    fn summarize_ips<A: Copy>(
+        &self,
+        addresses: &[A],
+        to_ip: fn(A) -> IpAddr,
+        provider_ids: &mut [u32],
+        mut tag_masks: Option<&mut [u64]>,
+    ) {
+        let mut hits = LocalHits::new(self);
+        for (i, &address) in addresses.iter().enumerate() {
+            // returns (provider id, tag mask), or (0, 0) if no provider matches
+            let (provider_id, tag_mask) = hits
+                .add(self.find_range(IpRange::of(to_ip(address))))
+                .map_or((0, 0), |set| self.summaries[set as usize]);
+            provider_ids[i] = provider_id;
+            if let Some(tag_masks) = tag_masks.as_deref_mut() {
+                tag_masks[i] = tag_mask;
+            }
+        }
+        self.record_local(hits);
+    }
+
+    /// Fills `provider_ids` (and `tag_masks`, if given) for packed addresses,
+    /// splitting large arrays across threads.
+    pub(crate) fn summarize_ips_parallel<A: Copy + Sync>(
+        &self,
+        addresses: &[A],
+        to_ip: fn(A) -> IpAddr,
+        provider_ids: &mut [u32],
+        tag_masks: Option<&mut [u64]>,
+    ) {
+        if addresses.len() < PARALLEL_BATCH_THRESHOLD {
+            self.summarize_ips(addresses, to_ip, provider_ids, tag_masks);
+            return;
+        }
+        let chunk_size = parallel_chunk_size(addresses.len());
+        let mut tag_chunks: Vec<Option<&mut [u64]>> = match tag_masks {
+            Some(tag_masks) => tag_masks.chunks_mut(chunk_size).map(Some).collect(),
+            None => Vec::new(),
+        };
+        tag_chunks.resize_with(addresses.len().div_ceil(chunk_size), || None);
+        std::thread::scope(|scope| {
+            for ((addresses, provider_ids), tag_masks) in addresses
+                .chunks(chunk_size)
+                .zip(provider_ids.chunks_mut(chunk_size))
+                .zip(tag_chunks)
+            {
+                scope.spawn(move || self.summarize_ips(addresses, to_ip, provider_ids, tag_masks));
+            }
+        });
+    }
+}
+
+/// Hit counts collected by one thread, so batch lookups do not contend on the
+/// shared counters for every target.
+struct LocalHits {
+    lookups: u64,
+    sets: Vec<u64>,
+}
+
+impl LocalHits {
+    fn new(index: &Index) -> Self {
+        LocalHits {
+            lookups: 0,
+            sets: vec![0; index.set_hits.len()],
+        }
+    }
+
+    fn add(&mut self, set: Option<u32>) -> Option<u32> {
+        self.lookups += 1;
+        if let Some(set) = set {
+            self.sets[set as usize] += 1;
+        }
+        set
+    }
+}
+
+/// Splits `len` items into one chunk per core, but not into tiny chunks.
+fn parallel_chunk_size(len: usize) -> usize {
+    let threads = std::thread::available_parallelism()
+        .map(|n| n.get())
+        .unwrap_or(1);
+    len.div_ceil(threads).max(PARALLEL_BATCH_THRESHOLD / 4)
+}
+
+/// `slice::partition_point` over indexes instead of a slice.
+fn partition_point(len: usize, pred: impl Fn(usize) -> bool) -> usize {
+    let (mut low, mut high) = (0, len);
+    while low < high {
+        let mid = low + (high - low) / 2;
+        if pred(mid) {
+            low = mid + 1;
+        } else {
+            high = mid;
+        }
+    }
+    low
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use crate::CloudCheck;
+
+    const TEST_JSON: &str = r#"{
+        "Amazon": {"name": "Amazon", "tags": ["cloud"], "cidrs": ["3.0.0.0/8", "2600:1f00::/24"], "domains": ["amazonaws.com"]},
+        "CloudFront": {"name": "CloudFront", "tags": ["cdn"], "cidrs": ["3.160.0.0/16", "9.9.9.9/32"], "domains": []},
+        "Microsoft": {"name": "Microsoft", "tags": ["cloud"], "cidrs": [], "domains": ["windows.net"]},
+        "GitHub": {"name": "GitHub", "tags": ["cdn"], "cidrs": [], "domains": ["blob.core.windows.net", "github.com"]}
+    }"#;
+
+    fn test_index() -> Index {
+        let (radix, providers, providers_map, prefixes) =
+            CloudCheck::build_data_structures(&serde_json::from_str(TEST_JSON).unwrap()).unwrap();
+        let bytes = serialize(&radix, providers, &providers_map, &prefixes, 42);
+        Index::from_data(IndexData::Owned(bytes), Some(42)).unwrap()
+    }
+
+    fn names(index: &Index, target: &str) -> Vec<String> {
+        index
+            .members(index.find(target))
+            .map(|p| p.name.clone())
+            .collect()
+    }
+
+    #[test]
+    fn test_lookups() {
+        let index = test_index();
+        assert_eq!(names(&index, "3.1.2.3"), ["Amazon", "CloudFront"]);
+        assert_eq!(names(&index, "3.0.0.0/9"), ["Amazon", "CloudFront"]);
+        assert_eq!(names(&index, "9.9.9.9"), ["CloudFront"]);
+        assert!(names(&index, "9.9.9.8").is_empty());
+        assert!(names(&index, "2.255.255.255").is_empty());
+        assert!(names(&index, "4.0.0.0").is_empty());
+        assert!(names(&index, "2.0.0.0/7").is_empty());
+        assert_eq!(names(&index, "2600:1f00::1"), ["Amazon"]);
+        assert!(names(&index, "2600:1e00::1").is_empty());
+        assert_eq!(names(&index, "asdf.amazonaws.com"), ["Amazon"]);
+        assert_eq!(names(&index, "AMAZONAWS.COM"), ["Amazon"]);
+        assert!(names(&index, "amazonaws.com.evil.com").is_empty());
+        assert!(names(&index, "notamazonaws.com").is_empty());
+        assert_eq!(names(&index, "x.windows.net"), ["GitHub", "Microsoft"]);
+        assert_eq!(names(&index, "github.com"), ["GitHub"]);
+        assert!(names(&index, "not a hostname").is_empty());
+        assert!(names(&index, "").is_empty());
+    }
+
+    #[test]
+    fn test_find_overlaps() {
+        let index = test_index();
+        let summary = |cidr: &str| -> Vec<(String, Vec<String>, u128)> {
+            index
+                .find_overlaps(cidr)
+                .unwrap()
+                .into_iter()
+                .map(|o| {
+                    let names = o
+                        .ids
+                        .iter()
+                        .map(|&id| index.providers[id as usize].name.clone());
+                    (o.prefix, names.collect(), o.covered)
+                })
+                .collect()
+        };
+        let overlap = |prefix: &str, names: &[&str], covered: u128| {
+            let names = names.iter().map(|name| name.to_string()).collect();
+            (prefix.to_string(), names, covered)
+        };
+        // CloudFront's prefix is reported on its own, although lookups fold it
+        // into Amazon's 3.0.0.0/8
+        assert_eq!(
+            summary("3.160.0.0/12"),
+            [
+                overlap("3.0.0.0/8", &["Amazon"], 1 << 20),
+                overlap("3.160.0.0/16", &["CloudFront"], 1 << 16),
+            ]
+        );
+        assert_eq!(
+            summary("3.160.1.2"),
+            [
+                overlap("3.0.0.0/8", &["Amazon"], 1),
+                overlap("3.160.0.0/16", &["CloudFront"], 1),
+            ]
+        );
+        assert_eq!(
+            summary("3.161.0.0/16"),
+            [overlap("3.0.0.0/8", &["Amazon"], 1 << 16)]
+        );
+        assert_eq!(
+            summary("0.0.0.0/0"),
+            [
+                overlap("3.0.0.0/8", &["Amazon"], 1 << 24),
+                overlap("3.160.0.0/16", &["CloudFront"], 1 << 16),
+                overlap("9.9.9.9/32", &["CloudFront"], 1),
+            ]
+        );
+        assert_eq!(
+            summary("2600::/12"),
+            [overlap("2600:1f00::/24", &["Amazon"], 1 << 104)]
+        );
+        assert_eq!(summary("::/0").len(), 1);
+
+        assert!(summary("4.0.0.0/8").is_empty());
+        assert!(summary("2.255.255.255").is_empty());
+        assert!(index.find_overlaps("amazonaws.com").is_none());
+    }
+
+    #[test]
+    fn test_find_overlaps_nested() {
+        let index = index_of(
+            r#"{
+            "A": {"name": "A", "tags": [], "cidrs": ["10.0.0.0/8", "2600::/16"], "domains": []},
+            "B": {"name": "B", "tags": [], "cidrs": ["10.1.0.0/16", "10.0.0.0/8", "2600:1::/32"], "domains": []},
+            "C": {"name": "C", "tags": [], "cidrs": ["10.1.2.0/24", "10.1.2.4/32"], "domains": []}
+        }"#,
+        );
+        let summary = |cidr: &str| -> Vec<(String, Vec<u32>, u128)> {
+            let overlaps = index.find_overlaps(cidr).unwrap();
+            overlaps
+                .into_iter()
+                .map(|o| (o.prefix, o.ids, o.covered))
+                .collect()
+        };
+        // every enclosing prefix, outermost first, then the ones inside
+        assert_eq!(
+            summary("10.1.2.0/30"),
+            [
+                ("10.0.0.0/8".to_string(), vec![0, 1], 4),
+                ("10.1.0.0/16".to_string(), vec![1], 4),
+                ("10.1.2.0/24".to_string(), vec![2], 4),
+            ]
+        );
+        assert_eq!(
+            summary("10.1.2.0/29"),
+            [
+                ("10.0.0.0/8".to_string(), vec![0, 1], 8),
+                ("10.1.0.0/16".to_string(), vec![1], 8),
+                ("10.1.2.0/24".to_string(), vec![2], 8),
+                ("10.1.2.4/32".to_string(), vec![2], 1),
+            ]
+        );
+        assert_eq!(summary("10.0.0.0/7").len(), 4);
+        assert_eq!(
+            summary("10.2.0.0/16"),
+            [("10.0.0.0/8".to_string(), vec![0, 1], 1 << 16)]
+        );
+        assert_eq!(
+            summary("2600:1:ffff::/48"),
+            [
+                ("2600::/16".to_string(), vec![0], 1 << 80),
+                ("2600:1::/32".to_string(), vec![1], 1 << 80),
+            ]
+        );
+        assert!(summary("11.0.0.0/8").is_empty());
+    }
+
+    #[test]
+    fn test_snapshot_roundtrip() {
+        let (radix, providers, providers_map, prefixes) =
+            CloudCheck::build_data_structures(&serde_json::from_str(TEST_JSON).unwrap()).unwrap();
+        let bytes = serialize(&radix, providers, &providers_map, &prefixes, 42);
+        let dir = std::env::temp_dir().join(format!("cloudcheck-test-{}", std::process::id()));
+        let path = dir.join("index.idx");
+        write_snapshot(&path, &bytes).unwrap();
+
+        let index = Index::open(&path, Some(42)).unwrap();
+        assert_eq!(names(&index, "3.1.2.3"), ["Amazon", "CloudFront"]);
+        assert_eq!(index.size(), bytes.len());
+        assert!(Index::open(&path, Some(43)).is_err());
+
+        // truncated or garbage data is rejected instead of read out of bounds
+        let truncated = bytes[..bytes.len() - 1].to_vec();
+        assert!(Index::from_data(IndexData::Owned(truncated), None).is_err());
+        assert!(Index::from_data(IndexData::Owned(b"garbage".to_vec()), None).is_err());
+        std::fs::remove_dir_all(dir).unwrap();
+    }
+
+    fn index_of(json: &str) -> Index {
+        let (radix, providers, providers_map, prefixes) =
+            CloudCheck::build_data_structures(&serde_json::from_str(json).unwrap()).unwrap();
+        let bytes = serialize(&radix, providers, &providers_map, &prefixes, 0);
+        Index::from_data(IndexData::Owned(bytes), None).unwrap()
+    }
+
+    #[test]
+    fn test_nested_and_overlapping_prefixes() {
+        let index = index_of(
+            r#"{
+            "A": {"name": "A", "tags": [], "cidrs": ["10.0.0.0/8"], "domains": []},
+            "B": {"name": "B", "tags": [], "cidrs": ["10.1.0.0/16", "11.0.0.0/8"], "domains": []},
+            "C": {"name": "C", "tags": [], "cidrs": ["10.1.2.0/24", "192.168.0.0/16"], "domains": []},
+            "D": {"name": "D", "tags": [], "cidrs": ["192.168.0.0/16", "192.169.0.0/16"], "domains": []}
+        }"#,
+        );
+        // nested prefixes are folded into the outermost one
+        for target in ["10.0.0.0", "10.1.2.3", "10.255.255.255", "10.1.0.0/16"] {
+            assert_eq!(names(&index, target), ["A", "B", "C"], "target: {}", target);
+        }
+        // adjacent prefixes of different providers stay apart
+        assert_eq!(names(&index, "11.0.0.0"), ["B"]);
+        assert!(names(&index, "9.255.255.255").is_empty());
+        assert!(names(&index, "12.0.0.0").is_empty());
+        // the same prefix in two providers belongs to both
+        assert_eq!(names(&index, "192.168.1.1"), ["C", "D"]);
+        assert_eq!(names(&index, "192.169.0.0"), ["D"]);
+        // a network spanning entries of different providers matches neither
+        assert!(names(&index, "10.0.0.0/7").is_empty());
+        assert!(names(&index, "192.168.0.0/15").is_empty());
+    }
+
+    #[test]
+    fn test_ipv6_edges() {
+        let index = index_of(
+            r#"{
+            "A": {"name": "A", "tags": [], "cidrs": ["::1/128", "1.2.3.4/32", "2600:1f00::/24"], "domains": []},
+            "B": {"name": "B", "tags": [], "cidrs": ["ffff:ffff:ffff:ffff:ffff:ffff:ffff:ff00/120", "2600:1f00:1::/48"], "domains": []}
+        }"#,
+        );
+        assert_eq!(names(&index, "::1"), ["A"]);
+        assert!(names(&index, "::").is_empty());
+        assert!(names(&index, "::2").is_empty());
+        assert_eq!(
+            names(&index, "ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff"),
+            ["B"]
+        );
+        assert!(names(&index, "ffff:ffff:ffff:ffff:ffff:ffff:ffff:feff").is_empty());
+        // any spelling of an address, and host bits of a network, are ignored
+        assert_eq!(names(&index, "2600:1F00:0:0:0:0:0:1"), ["A", "B"]);
+        assert_eq!(names(&index, "2600:1f00::1/24"), ["A", "B"]);
+        assert_eq!(
+            names(&index, "2600:1fff:ffff:ffff:ffff:ffff:ffff:ffff"),
+            ["A", "B"]
+        );
+        assert!(names(&index, "2600:2000::").is_empty());
+        // IPv4 and IPv6 are separate address spaces
+        assert!(names(&index, "::ffff:1.2.3.4").is_empty());
+        assert!(names(&index, "::1.2.3.4").is_empty());
+        assert_eq!(names(&index, "1.2.3.4"), ["A"]);
+        assert!(names(&index, "::/0").is_empty());
+        assert!(index.find("2600:1f00::/129").is_none());
+    }
+
+    #[test]
+    fn test_corrupt_snapshots_are_rejected() {
+        let (radix, providers, providers_map, prefixes) =
+            CloudCheck::build_data_structures(&serde_json::from_str(TEST_JSON).unwrap()).unwrap();
+        let bytes = serialize(&radix, providers, &providers_map, &prefixes, 42);
+        let load = |bytes: Vec<u8>| Index::from_data(IndexData::Owned(bytes), None);
+        let patched = |at: usize, value: &[u8]| {
+            let mut bytes = bytes.clone();
+            bytes[at..at + value.len()].copy_from_slice(value);
+            load(bytes)
+        };
+        assert!(load(bytes.clone()).is_ok());
+
+        // every truncation, and trailing garbage
+        for len in 0..bytes.len() {
+            assert!(load(bytes[..len].to_vec()).is_err(), "length {}", len);
+        }
+        let mut extended = bytes.clone();
+        extended.push(0);
+        assert!(load(extended).is_err());
+
+        // section sizes that do not add up, or overflow
+        assert!(patched(24, &u64::MAX.to_le_bytes()).is_err());
+        assert!(patched(32, &(u64::MAX / 2).to_le_bytes()).is_err());
+        // a domain table size that is not a power of two
+        assert!(patched(48, &3u64.to_le_bytes()).is_err());
+
+        let meta_len = read_u64(&bytes, 24) as usize;
+        let ipv4 = HEADER_LEN + meta_len;
+        // broken provider table
+        assert!(patched(HEADER_LEN, b"[").is_err());
+        // a set id past the set table
+        assert!(patched(ipv4 + 8, &u32::MAX.to_le_bytes()).is_err());
+        // a range that ends before it starts
+        assert!(patched(ipv4 + 4, &0u32.to_le_bytes()).is_err());
+        // ranges out of order: the second record starts inside the first
+        assert!(
+            patched(
+                ipv4 + IPV4_RECORD_LEN,
+                &read_u32(&bytes, ipv4).to_le_bytes()
+            )
+            .is_err()
+        );
+
+        // a domain string offset past the string table
+        let ipv4_count = read_u64(&bytes, 32) as usize;
+        let ipv6_count = read_u64(&bytes, 40) as usize;
+        let domains = ipv4 + ipv4_count * IPV4_RECORD_LEN + ipv6_count * IPV6_RECORD_LEN;
+        let slots = read_u64(&bytes, 48) as usize;
+        let slot = (0..slots)
+            .map(|i| domains + i * DOMAIN_SLOT_LEN)
+            .find(|&at| read_u32(&bytes, at + 12) != EMPTY_SLOT)
+            .unwrap();
+        assert!(patched(slot + 8, &u32::MAX.to_le_bytes()).is_err());
+        // a domain string length past the string table
+        let strings = domains + slots * DOMAIN_SLOT_LEN;
+        let offset = read_u32(&bytes, slot + 8) as usize;
+        assert!(patched(strings + offset, &u16::MAX.to_le_bytes()).is_err());
+
+        // a prefix record that is not a CIDR, or a duplicate one
+        let prefixes4 = strings + read_u64(&bytes, 56) as usize;
+        let first_start = read_u32(&bytes, prefixes4);
+        assert!(patched(prefixes4, &(first_start + 1).to_le_bytes()).is_err());
+        let first = &bytes[prefixes4..prefixes4 + IPV4_RECORD_LEN];
+        assert!(patched(prefixes4 + IPV4_RECORD_LEN, first).is_err());
+    }
+
+    #[test]
+    fn test_long_domains() {
+        let long = format!("{}.com", "a".repeat(300));
+        let index = index_of(&format!(
+            r#"{{"A": {{"name": "A", "tags": [], "cidrs": [], "domains": ["{}", "example.com"]}}}}"#,
+            long
+        ));
+        // stored with its full length rather than a truncated one
+        assert_eq!(names(&index, &long), ["A"]);
+        assert_eq!(names(&index, &format!("www.{}", long)), ["A"]);
+        assert_eq!(names(&index, "example.com"), ["A"]);
+    }
+
+    /// The flat index must answer exactly like the radix tree it was built from.
+    #[test]
+    fn test_matches_radix_tree() {
+        let json = include_str!("../cloud_providers_v2.json");
+        let (radix, providers, providers_map, prefixes) =
+            CloudCheck::build_data_structures(&serde_json::from_str(json).unwrap()).unwrap();
+        let names_by_id: Vec<String> = providers.iter().map(|p| p.name.clone()).collect();
+        let bytes = serialize(&radix, providers, &providers_map, &prefixes, 0);
+        let index = Index::from_data(IndexData::Owned(bytes), None).unwrap();
+
+        let mut targets = Vec::new();
+        for host in radix.hosts() {
+            match parse_ip_range(&host) {
+                Some(IpRange::V4(start, end)) => {
+                    for addr in [start, end, start.wrapping_sub(1), end.wrapping_add(1)] {
+                        targets.push(std::net::Ipv4Addr::from(addr).to_string());
+                    }
+                }
+                Some(IpRange::V6(start, end)) => {
+                    for addr in [start, end, start.wrapping_sub(1), end.wrapping_add(1)] {
+                        targets.push(std::net::Ipv6Addr::from(addr).to_string());
+                    }
+                }
+                None => {
+                    targets.push(host.clone());
+                    targets.push(format!("asdf.{}", host));
+                    targets.push(format!("asdf{}", host));
+                }
+            }
+            targets.push(host);
+        }
+        for target in targets {
+            let mut expected: Vec<String> = radix
+                .get(&target)
+                .and_then(|n| providers_map.get(&n))
+                .map(|ids| {
+                    ids.iter()
+                        .map(|&id| names_by_id[id as usize].clone())
+                        .collect()
+                })
+                .unwrap_or_default();
+            expected.sort();
+            assert_eq!(names(&index, &target), expected, "target: {}", target);
+        }
+    }
+}
@@ -2,17 +2,28 @@ use log::debug;
 use radixtarget::{RadixTarget, ScopeMode};
 use serde::{Deserialize, Serialize};
 use std::collections::HashMap;
-use std::path::PathBuf;
+use std::net::{IpAddr, Ipv4Addr, Ipv6Addr};
+use std::path::{Path, PathBuf};
 use std::sync::Arc;
-use std::time::{Duration, SystemTime};
-use tokio::sync::{Mutex, RwLock};
+use std::sync::atomic::{AtomicBool, AtomicU64, Ordering};
+use std::time::{Duration, Instant, SystemTime};
+use tokio::sync::Mutex;
 
+mod cache;
+mod index;
 #[cfg(feature = "py")]
 mod python;
+mod stats;
+
+pub use cache::CacheStats;
+use cache::ShardedCache;
+use index::{Index, IndexData, Overlap, Prefixes};
+use stats::Metrics;
+pub use stats::{LoadTimings, Stats};
 
 const CLOUDCHECK_SIGNATURE_URL: &str = "https://raw.githubusercontent.com/blacklanternsecurity/cloudcheck/refs/heads/stable/cloud_providers_v2.json";
 
-#[derive(Debug, Clone, Serialize, Deserialize)]
+#[derive(Debug, Clone, PartialEq, Serialize, Deserialize)]
 pub struct CloudProvider {
     pub name: String,
     pub tags: Vec<String>,
@@ -22,6 +33,16 @@ pub struct CloudProvider {
     pub long_description: String,
 }
 
+/// A provider prefix overlapping a queried range (see `lookup_range()`).
+#[derive(Debug, Clone, PartialEq, Serialize)]
+pub struct RangeOverlap {
+    /// The provider prefix, e.g. "3.0.0.0/8".
+    pub prefix: String,
+    pub providers: Vec<CloudProvider>,
+    /// How many addresses are in both the queried range and the prefix.
+    pub covered: u128,
+}
+
 #[derive(Debug, Deserialize)]
 struct ProviderData {
     name: String,
@@ -34,14 +55,176 @@ struct ProviderData {
     long_description: String,
 }
 
-type ProvidersMap = HashMap<String, Vec<CloudProvider>>;
+/// Validators of the cached data, for conditional requests.
+#[derive(Debug, Default, Serialize, Deserialize)]
+struct CacheValidators {
+    etag: Option<String>,
+    last_modified: Option<String>,
+}
+
+/// Normalized CIDR or domain -> sorted ids of the providers it belongs to.
+type ProvidersMap = HashMap<String, Vec<u32>>;
 type Error = Box<dyn std::error::Error + Send + Sync>;
 
+/// Adds a provider id to a sorted id list, unless it is already there.
+fn add_provider_id(ids: &mut Vec<u32>, id: u32) {
+    if let Err(pos) = ids.binary_search(&id) {
+        ids.insert(pos, id);
+    }
+}
+
+/// Finds a target's provider set through `cache`, if there is one. Used by
+/// single lookups and by every thread of a parallel batch alike.
+fn find_with(cache: Option<&ShardedCache>, index: &Index, target: &str) -> Option<u32> {
+    match cache {
+        Some(cache) => cache.find(index, target),
+        None => index.find(target),
+    }
+}
+
+/// Batches smaller than this are looked up inline; larger ones are split
+/// across threads.
+const PARALLEL_BATCH_THRESHOLD: usize = 4096;
+
+/// How long fetched data is considered fresh by default.
+const DEFAULT_TTL: Duration = Duration::from_secs(24 * 60 * 60);
+
+/// How long to wait before retrying a failed background refresh.
+const REFRESH_RETRY_DELAY: Duration = Duration::from_secs(5 * 60);
+
+fn unix_now() -> u64 {
+    SystemTime::now()
+        .duration_since(SystemTime::UNIX_EPOCH)
+        .map_or(0, |d| d.as_secs())
+}
+
+fn check_packed_lengths(
+    addresses: usize,
+    provider_ids: usize,
+    tag_masks: Option<usize>,
+) -> Result<(), Error> {
+    if provider_ids != addresses || tag_masks.is_some_and(|n| n != addresses) {
+        return Err(format!(
+            "Output arrays must have one element per address ({} addresses)",
+            addresses
+        )
+        .into());
+    }
+    Ok(())
+}
+
+/// Where the signature data comes from.
+#[derive(Debug, Clone, PartialEq)]
+pub enum DataSource {
+    /// Fetched from a URL and cached in `~/.cache/cloudcheck`. This is the
+    /// default, using `CLOUDCHECK_SIGNATURE_URL` or the upstream URL.
+    Url(String),
+    /// A local JSON file. Never touches the network or the cache directory.
+    File(PathBuf),
+    /// JSON held in memory. Never touches the network or the filesystem.
+    Json(Arc<String>),
+    /// An index file written by `publish_index()`, memory-mapped read-only.
+    /// Every process attached to the same file shares one copy of it in the
+    /// page cache. The file is re-opened once the TTL expires, so a republished
+    /// index is picked up without restarting.
+    Index(PathBuf),
+}
+
+impl Default for DataSource {
+    fn default() -> Self {
+        DataSource::Url(CloudCheck::get_signature_url())
+    }
+}
+
+/// Restricts which providers are put into the index. A provider is kept if
+/// it has any of the tags (when tags are given) and is one of the named
+/// providers (when names are given). Names and tags are case-insensitive.
+#[derive(Debug, Clone, Default, PartialEq)]
+struct ProviderFilter {
+    tags: Vec<String>,
+    providers: Vec<String>,
+}
+
+impl ProviderFilter {
+    fn is_empty(&self) -> bool {
+        self.tags.is_empty() && self.providers.is_empty()
+    }
+
+    /// Identifies the filter in snapshot names and hashes; 0 when empty, so
+    /// unfiltered snapshots keep the hash of the JSON alone.
+    fn key(&self) -> u64 {
+        if self.is_empty() {
+            return 0;
+        }
+        let key = format!("tags={:?};providers={:?}", self.tags, self.providers);
+        index::fnv1a(key.as_bytes())
+    }
+
+    /// Drops the providers that do not pass the filter. Unknown tags or
+    /// provider names are an error, since they would silently match nothing.
+    fn apply(&self, providers_data: &mut HashMap<String, ProviderData>) -> Result<(), Error> {
+        if self.is_empty() {
+            return Ok(());
+        }
+        for tag in &self.tags {
+            if !providers_data
+                .values()
+                .any(|p| p.tags.iter().any(|t| t.eq_ignore_ascii_case(tag)))
+            {
+                return Err(format!("Unknown tag '{}'", tag).into());
+            }
+        }
+        for name in &self.providers {
+            if !providers_data
+                .values()
+                .any(|p| p.name.eq_ignore_ascii_case(name))
+            {
+                return Err(format!("Unknown provider '{}'", name).into());
+            }
+        }
+        providers_data.retain(|_, provider| {
+            let tag_match = self.tags.is_empty()
+                || provider
+                    .tags
+                    .iter()
+                    .any(|t| self.tags.iter().any(|tag| t.eq_ignore_ascii_case(tag)));
+            let name_match = self.providers.is_empty()
+                || self
+                    .providers
+                    .iter()
+                    .any(|name| provider.name.eq_ignore_ascii_case(name));
+            tag_match && name_match
+        });
+        debug!("Filtered index to {} providers", providers_data.len());
+        Ok(())
+    }
+}
+
+/// A loaded index and when its data was fetched.
+#[derive(Clone)]
+struct Loaded {
+    index: Arc<Index>,
+    fetched_at: SystemTime,
+}
+
 #[derive(Clone)]
 pub struct CloudCheck {
-    radix: Arc<RwLock<Option<RadixTarget>>>,
-    providers: Arc<RwLock<Option<ProvidersMap>>>,
-    last_fetch: Arc<Mutex<Option<SystemTime>>>,
+    /// The current index. Readers only hold the lock long enough to clone the
+    /// `Arc` and writers only to swap it, so lookups never wait on a load.
+    index: Arc<std::sync::RwLock<Option<Loaded>>>,
+    /// Serializes the initial load, so concurrent first lookups load once.
+    load_lock: Arc<Mutex<()>>,
+    /// Set while a background refresh is running.
+    refreshing: Arc<AtomicBool>,
+    /// Unix time (in seconds) before which a failed refresh is not retried.
+    retry_at: Arc<AtomicU64>,
+    ttl: Duration,
+    metrics: Arc<Metrics>,
+    filter: ProviderFilter,
+    source: DataSource,
+    /// Never fetch from the network, only read the cache file.
+    offline: bool,
+    cache: Option<Arc<ShardedCache>>,
 }
 
 impl Default for CloudCheck {
@@ -53,30 +236,166 @@ impl Default for CloudCheck {
 impl CloudCheck {
     pub fn new() -> Self {
         CloudCheck {
-            radix: Arc::new(RwLock::new(None)),
-            providers: Arc::new(RwLock::new(None)),
-            last_fetch: Arc::new(Mutex::new(None)),
+            index: Arc::new(std::sync::RwLock::new(None)),
+            load_lock: Arc::new(Mutex::new(())),
+            refreshing: Arc::new(AtomicBool::new(false)),
+            retry_at: Arc::new(AtomicU64::new(0)),
+            ttl: DEFAULT_TTL,
+            metrics: Arc::new(Metrics::new()),
+            filter: ProviderFilter::default(),
+            source: DataSource::default(),
+            offline: false,
+            cache: None,
         }
     }
 
+    /// Sets how long fetched data is considered fresh (24 hours by default).
+    /// Once it expires, lookups keep using the current data while a refresh
+    /// runs in the background.
+    pub fn with_ttl(mut self, ttl: Duration) -> Self {
+        self.ttl = ttl;
+        self
+    }
+
+    /// Sets where the data is loaded from. File and in-memory sources are
+    /// loaded once and never refreshed in the background.
+    pub fn with_source(mut self, source: DataSource) -> Self {
+        self.source = source;
+        self
+    }
+
+    /// Only indexes providers with at least one of these tags (e.g. "cdn"),
+    /// which makes loading faster and the index smaller. Does not apply to a
+    /// `DataSource::Index`, which is used as published.
+    pub fn with_tags<S: Into<String>>(mut self, tags: impl IntoIterator<Item = S>) -> Self {
+        self.filter.tags = tags.into_iter().map(Into::into).collect();
+        self
+    }
+
+    /// Only indexes the named providers (e.g. "Amazon"). Combined with
+    /// `with_tags()`, a provider must pass both.
+    pub fn with_providers<S: Into<String>>(
+        mut self,
+        providers: impl IntoIterator<Item = S>,
+    ) -> Self {
+        self.filter.providers = providers.into_iter().map(Into::into).collect();
+        self
+    }
+
+    /// Disables network access. A URL source is then only read from the cache
+    /// file, and loading fails if there is none.
+    pub fn with_offline(mut self, offline: bool) -> Self {
+        self.offline = offline;
+        self
+    }
+
+    /// Enables an LRU cache of up to `capacity` lookup results (hits and
+    /// misses) in front of the index. The cache is emptied whenever a
+    /// refresh swaps in new data.
+    pub fn with_cache(mut self, capacity: usize) -> Self {
+        self.cache = (capacity > 0).then(|| Arc::new(ShardedCache::new(capacity)));
+        self
+    }
+
+    /// Returns the cache counters, or None if caching is disabled.
+    pub fn cache_stats(&self) -> Option<CacheStats> {
+        self.cache.as_ref().map(|cache| cache.stats())
+    }
+
+    /// Finds a target's provider set through the cache, if enabled, and counts
+    /// the lookup.
+    fn cached_find(&self, index: &Index, target: &str) -> Option<u32> {
+        let set = find_with(self.cache.as_deref(), index, target);
+        index.record(set);
+        set
+    }
+
     fn get_signature_url() -> String {
         std::env::var("CLOUDCHECK_SIGNATURE_URL")
             .unwrap_or_else(|_| CLOUDCHECK_SIGNATURE_URL.to_string())
     }
 
-    fn get_cache_path() -> Result<PathBuf, Error> {
+    /// Each URL has its own cache file (and validators and snapshots next to
+    /// it), so data fetched from one URL is never served for another. The
+    /// upstream URL keeps the plain file name.
+    fn get_cache_path(url: &str) -> Result<PathBuf, Error> {
         let home = std::env::var("HOME")?;
         let mut path = PathBuf::from(home);
         path.push(".cache");
         path.push("cloudcheck");
-        path.push("cloud_providers_v2.json");
+        if url == CLOUDCHECK_SIGNATURE_URL {
+            path.push("cloud_providers_v2.json");
+        } else {
+            path.push(format!(
+                "cloud_providers_v2.{:016x}.json",
+                index::fnv1a(url.as_bytes())
+            ));
+        }
         Ok(path)
     }
 
-    async fn fetch_and_cache(cache_path: &PathBuf) -> Result<String, Error> {
-        let url = Self::get_signature_url();
+    /// The binary index snapshot lives next to the cached JSON it was built
+    /// from. Filtered indexes get their own snapshot per filter.
+    fn get_snapshot_path(&self, cache_path: &Path) -> PathBuf {
+        match self.filter.key() {
+            0 => cache_path.with_extension("idx"),
+            key => cache_path.with_extension(format!("{:016x}.idx", key)),
+        }
+    }
+
+    /// The ETag and Last-Modified values of the cached data live next to it.
+    fn get_validators_path(cache_path: &Path) -> PathBuf {
+        cache_path.with_extension("meta")
+    }
+
+    /// Fetches the data, or revalidates the cache file if there is one: the
+    /// request is conditional on the cached ETag / Last-Modified, and if the
+    /// server answers 304 Not Modified only the cache file's modification
+    /// time (its freshness) is updated. Responses may be gzip-compressed.
+    async fn fetch_and_cache(url: &str, cache_path: &PathBuf) -> Result<String, Error> {
         debug!("Fetching data from URL: {}", url);
-        let response = reqwest::get(&url).await?;
+        let validators_path = Self::get_validators_path(cache_path);
+        let validators: CacheValidators = match tokio::fs::try_exists(cache_path).await {
+            Ok(true) => tokio::fs::read(&validators_path)
+                .await
+                .ok()
+                .and_then(|data| serde_json::from_slice(&data).ok())
+                .unwrap_or_default(),
+            _ => CacheValidators::default(),
+        };
+        let mut request = reqwest::Client::new().get(url);
+        if let Some(etag) = &validators.etag {
+            request = request.header(reqwest::header::IF_NONE_MATCH, etag);
+        }
+        if let Some(last_modified) = &validators.last_modified {
+            request = request.header(reqwest::header::IF_MODIFIED_SINCE, last_modified);
+        }
+        let response = request.send().await?;
+
+        if response.status() == reqwest::StatusCode::NOT_MODIFIED {
+            debug!("Cached data is still current, refreshing its timestamp");
+            let path = cache_path.clone();
+            let json_data = tokio::task::spawn_blocking(move || -> Result<String, Error> {
+                let file = std::fs::File::options().write(true).open(&path)?;
+                file.set_modified(SystemTime::now())?;
+                Ok(std::fs::read_to_string(&path)?)
+            })
+            .await??;
+            return Ok(json_data);
+        }
+
+        let response = response.error_for_status()?;
+        let header = |name: reqwest::header::HeaderName| {
+            response
+                .headers()
+                .get(name)
+                .and_then(|value| value.to_str().ok())
+                .map(str::to_string)
+        };
+        let validators = CacheValidators {
+            etag: header(reqwest::header::ETAG),
+            last_modified: header(reqwest::header::LAST_MODIFIED),
+        };
         let json_data = response.text().await?;
         debug!("Fetched {} bytes from network", json_data.len());
 
@@ -86,99 +405,53 @@ impl CloudCheck {
         }
         debug!("Writing cache file: {:?}", cache_path);
         tokio::fs::write(cache_path, &json_data).await?;
+        if validators.etag.is_some() || validators.last_modified.is_some() {
+            tokio::fs::write(&validators_path, serde_json::to_vec(&validators)?).await?;
+        } else {
+            let _ = tokio::fs::remove_file(&validators_path).await;
+        }
         debug!("Cache file written successfully");
 
         Ok(json_data)
     }
 
-    /// Gets the last fetch time, checking in-memory timestamp first.
-    /// If no in-memory timestamp exists (first run), falls back to checking
-    /// the cache file's modification time. Returns None if file doesn't exist.
-    async fn get_last_fetch_time(&self, cache_path: &PathBuf) -> Result<Option<SystemTime>, Error> {
-        let last_fetch = self.last_fetch.lock().await;
-        match *last_fetch {
-            Some(time) => {
-                debug!("Using in-memory last_fetch timestamp: {:?}", time);
-                Ok(Some(time))
-            }
-            None => {
-                // No in-memory timestamp - check file modification time
-                drop(last_fetch);
-                debug!(
-                    "No in-memory timestamp, checking cache file modification time: {:?}",
-                    cache_path
-                );
-                match tokio::fs::metadata(cache_path).await {
-                    Ok(metadata) => {
-                        if let Ok(modified) = metadata.modified() {
-                            debug!("Cache file modification time: {:?}", modified);
-                            Ok(Some(modified))
-                        } else {
-                            debug!("Cache file exists but modification time unavailable");
-                            Ok(None)
-                        }
-                    }
-                    Err(_) => {
-                        debug!("Cache file does not exist: {:?}", cache_path);
-                        Ok(None)
-                    }
-                }
-            }
-        }
-    }
-
-    /// Loads JSON data either from network (if refresh needed) or from cache file.
-    /// Returns (json_data, fetched_fresh) where fetched_fresh indicates if we
-    /// fetched from network. Sets last_fetch timestamp on first cache load to
-    /// track process runtime. Falls back to network fetch if cache read fails.
-    async fn load_json_data(
-        &self,
-        cache_path: &PathBuf,
-        needs_refresh: bool,
-    ) -> Result<(String, bool), Error> {
-        if needs_refresh {
-            debug!("Refresh needed, fetching from network");
-            let data = Self::fetch_and_cache(cache_path).await?;
-            Ok((data, true))
-        } else {
-            debug!("No refresh needed, loading from cache: {:?}", cache_path);
-            match tokio::fs::read_to_string(cache_path).await {
-                Ok(data) => {
-                    debug!("Successfully loaded {} bytes from cache", data.len());
-                    // First load from cache - set timestamp to track process runtime
-                    let now = SystemTime::now();
-                    let mut last_fetch = self.last_fetch.lock().await;
-                    if last_fetch.is_none() {
-                        debug!("Setting in-memory last_fetch timestamp to current time");
-                        *last_fetch = Some(now);
-                    } else {
-                        debug!(
-                            "In-memory last_fetch timestamp already set, keeping existing value"
-                        );
-                    }
-                    Ok((data, false))
-                }
-                Err(e) => {
-                    debug!(
-                        "Failed to read cache file ({}), falling back to network fetch",
-                        e
-                    );
-                    // Cache file was deleted between stat and read, fetch fresh
-                    let data = Self::fetch_and_cache(cache_path).await?;
-                    Ok((data, true))
-                }
-            }
-        }
+    /// Reads the cache file and its modification time, which is when the data
+    /// in it was fetched.
+    async fn read_cache(cache_path: &PathBuf) -> Result<(String, SystemTime), Error> {
+        let modified = tokio::fs::metadata(cache_path).await?.modified()?;
+        let data = tokio::fs::read_to_string(cache_path).await?;
+        debug!(
+            "Loaded {} bytes from cache, modified {:?}",
+            data.len(),
+            modified
+        );
+        Ok((data, modified))
     }
 
-    /// Parses JSON and builds the radix tree and providers map.
-    /// For each provider, inserts all CIDRs and domains into the radix tree,
-    /// normalizing them in the process. Maps normalized values to provider lists.
-    fn build_data_structures(json_data: &str) -> Result<(RadixTarget, ProvidersMap), Error> {
-        let providers_data: HashMap<String, ProviderData> = serde_json::from_str(json_data)?;
-
+    /// Builds the radix tree, provider table and providers map from the parsed
+    /// JSON. Each provider is stored once in the table (sorted by name, so a
+    /// provider's id is its position), and for each provider, all CIDRs and
+    /// domains are inserted into the radix tree, normalizing them in the
+    /// process. Maps normalized values to sorted lists of provider ids. The
+    /// CIDRs are also collected unfolded, for range queries.
+    fn build_data_structures(
+        providers_data: &HashMap<String, ProviderData>,
+    ) -> Result<(RadixTarget, Vec<CloudProvider>, ProvidersMap, Prefixes), Error> {
         let mut radix = RadixTarget::new(&[], ScopeMode::Acl)?;
         let mut providers_map: ProvidersMap = HashMap::new();
+        let mut prefixes = Prefixes::default();
+
+        let mut sorted: Vec<&ProviderData> = providers_data.values().collect();
+        sorted.sort_by(|a, b| a.name.cmp(&b.name));
+        let providers: Vec<CloudProvider> = sorted
+            .iter()
+            .map(|provider| CloudProvider {
+                name: provider.name.clone(),
+                tags: provider.tags.clone(),
+                short_description: provider.short_description.clone(),
+                long_description: provider.long_description.clone(),
+            })
+            .collect();
 
         // here, we iterate twice to ensure similar domains get grouped together regardless of insert order
         // this exists for a specific reason. a real world example is when github has a domain of
@@ -187,16 +460,12 @@ impl CloudCheck {
         // iterating twice ensures that on the second pass, a .get() for blob.core.windows.net will return the
         // parent domain, allowing us to nest both cloud providers under the same key of windows.net.
         for _ in 0..2 {
-            for provider in providers_data.values() {
-                let cloud_provider = CloudProvider {
-                    name: provider.name.clone(),
-                    tags: provider.tags.clone(),
-                    short_description: provider.short_description.clone(),
-                    long_description: provider.long_description.clone(),
-                };
+            for (id, provider) in sorted.iter().enumerate() {
+                let id = id as u32;
 
                 // Insert all CIDRs for this provider
                 for cidr in &provider.cidrs {
+                    prefixes.add(cidr, id);
                     let normalized = match radix.get(cidr) {
                         Some(n) => n,
                         None => match radix.insert(cidr) {
@@ -208,10 +477,7 @@ impl CloudCheck {
                             }
                         },
                     };
-                    let providers_list = providers_map.entry(normalized.clone()).or_default();
-                    if !providers_list.iter().any(|p| p.name == cloud_provider.name) {
-                        providers_list.push(cloud_provider.clone());
-                    }
+                    add_provider_id(providers_map.entry(normalized).or_default(), id);
                 }
 
                 // Insert all domains for this provider
@@ -227,105 +493,446 @@ impl CloudCheck {
                             }
                         },
                     };
-                    let providers_list = providers_map.entry(normalized.clone()).or_default();
-                    if !providers_list.iter().any(|p| p.name == cloud_provider.name) {
-                        providers_list.push(cloud_provider.clone());
-                    }
+                    add_provider_id(providers_map.entry(normalized).or_default(), id);
                 }
             }
         }
 
-        Ok((radix, providers_map))
+        Ok((radix, providers, providers_map, prefixes))
     }
 
-    /// Ensures data is loaded and fresh. Checks if refresh is needed based on
-    /// 24-hour process runtime. Returns early if data is already loaded and fresh.
-    /// Otherwise loads data (from network or cache), builds structures, and updates
-    /// the in-memory timestamp if we fetched fresh data.
-    async fn ensure_loaded(&self) -> Result<(), Error> {
-        let cache_valid_duration = Duration::from_secs(24 * 60 * 60);
-        let now = SystemTime::now();
-        let cache_path = Self::get_cache_path()?;
+    /// Loads the index snapshot for `json_data` if there is a valid one, and
+    /// otherwise builds the index and writes a new snapshot. Snapshots are keyed
+    /// by a hash of the JSON, so a changed dataset is never served from a stale
+    /// snapshot. Failing to write the snapshot is not an error, it only means
+    /// the next process has to build the index again.
+    fn load_or_build(
+        json_data: &str,
+        filter: &ProviderFilter,
+        snapshot_path: &Path,
+        timings: &mut LoadTimings,
+    ) -> Result<Index, Error> {
+        let source_hash = index::fnv1a(json_data.as_bytes()) ^ filter.key();
+        match Index::open(snapshot_path, Some(source_hash)) {
+            Ok(index) => {
+                debug!("Loaded index snapshot: {:?}", snapshot_path);
+                timings.from_snapshot = true;
+                return Ok(index);
+            }
+            Err(e) => debug!("No usable index snapshot ({}), building index", e),
+        }
+        let bytes = Self::build_index_bytes(json_data, filter, source_hash, timings)?;
+        match index::write_snapshot(snapshot_path, &bytes) {
+            // map the snapshot we just wrote rather than keeping a private copy,
+            // so this process shares its pages with every other one using it
+            Ok(()) => match Index::open(snapshot_path, Some(source_hash)) {
+                Ok(index) => {
+                    debug!("Wrote and mapped index snapshot: {:?}", snapshot_path);
+                    return Ok(index);
+                }
+                Err(e) => debug!("Failed to map new index snapshot: {}", e),
+            },
+            Err(e) => debug!("Failed to write index snapshot {:?}: {}", snapshot_path, e),
+        }
+        Index::from_data(IndexData::Owned(bytes), None)
+    }
+
+    /// Parses JSON and serializes the index built from it, timing both steps.
+    fn build_index_bytes(
+        json_data: &str,
+        filter: &ProviderFilter,
+        source_hash: u64,
+        timings: &mut LoadTimings,
+    ) -> Result<Vec<u8>, Error> {
+        let start = Instant::now();
+        let mut providers_data: HashMap<String, ProviderData> = serde_json::from_str(json_data)?;
+        timings.parse = start.elapsed();
+        let start = Instant::now();
+        filter.apply(&mut providers_data)?;
+        let (radix, providers, providers_map, prefixes) =
+            Self::build_data_structures(&providers_data)?;
+        let bytes = index::serialize(&radix, providers, &providers_map, &prefixes, source_hash);
+        timings.build = start.elapsed();
+        Ok(bytes)
+    }
+
+    fn current(&self) -> Option<Loaded> {
+        self.index.read().unwrap().clone()
+    }
+
+    fn store(&self, loaded: Loaded) {
+        let old = self.index.write().unwrap().replace(loaded);
+        if let Some(old) = old {
+            self.metrics.retire(old.index.hit_counts());
+        }
+    }
+
+    fn is_stale(&self, loaded: &Loaded) -> bool {
+        // only a URL source with network access or a published index file can
+        // bring in newer data
+        let refreshable = match self.source {
+            DataSource::Url(_) => !self.offline,
+            DataSource::Index(_) => true,
+            DataSource::File(_) | DataSource::Json(_) => false,
+        };
+        if !refreshable {
+            return false;
+        }
+        let expired = loaded
+            .fetched_at
+            .elapsed()
+            .map(|age| age >= self.ttl)
+            .unwrap_or(true);
+        expired && unix_now() >= self.retry_at.load(Ordering::Relaxed)
+    }
+
+    /// Builds an index from JSON on the blocking thread pool, going through an
+    /// index snapshot if a path for one is given.
+    async fn build_index(
+        &self,
+        json_data: String,
+        snapshot_path: Option<PathBuf>,
+    ) -> Result<Arc<Index>, Error> {
+        let start = Instant::now();
+        let filter = self.filter.clone();
+        let (index, mut timings) = tokio::task::spawn_blocking(move || {
+            let mut timings = LoadTimings::default();
+            let index = match snapshot_path {
+                Some(snapshot_path) => {
+                    Self::load_or_build(&json_data, &filter, &snapshot_path, &mut timings)
+                }
+                None => {
+                    let source_hash = index::fnv1a(json_data.as_bytes()) ^ filter.key();
+                    Self::build_index_bytes(&json_data, &filter, source_hash, &mut timings)
+                        .and_then(|bytes| Index::from_data(IndexData::Owned(bytes), None))
+                }
+            };
+            index.map(|index| (index, timings))
+        })
+        .await??;
+        timings.total = start.elapsed();
+        self.metrics.record_load(timings);
         debug!(
-            "ensure_loaded: cache_valid_duration={:?}, cache_path={:?}",
-            cache_valid_duration, cache_path
+            "Loaded index ({} bytes) in {:?}",
+            index.size(),
+            timings.total
         );
+        Ok(Arc::new(index))
+    }
 
-        // Check if we need refresh (uses in-memory timestamp, falls back to file stat)
-        let last_fetch_time = self.get_last_fetch_time(&cache_path).await?;
-        let needs_refresh = match last_fetch_time {
-            Some(fetch_time) => {
-                let elapsed = now.duration_since(fetch_time).ok();
-                let needs = elapsed.map(|e| e >= cache_valid_duration).unwrap_or(true);
-                if let Some(e) = elapsed {
-                    debug!("Time since last fetch: {:?}, needs_refresh={}", e, needs);
+    /// Loads the data from the configured source. For a URL source, `fetch`
+    /// chooses between fetching fresh data and reading the cache file; the
+    /// other one is used as a fallback unless the network is disabled.
+    async fn load_source(&self, fetch: bool) -> Result<Loaded, Error> {
+        let (json_data, fetched_at, snapshot_path) = match &self.source {
+            DataSource::Index(path) => {
+                debug!("Attaching to published index: {:?}", path);
+                let path = path.clone();
+                let start = Instant::now();
+                let index = tokio::task::spawn_blocking(move || {
+                    Index::open(&path, None)
+                        .map_err(|e| Error::from(format!("Failed to open index {:?}: {}", path, e)))
+                })
+                .await??;
+                self.metrics.record_load(LoadTimings {
+                    total: start.elapsed(),
+                    from_snapshot: true,
+                    ..LoadTimings::default()
+                });
+                return Ok(Loaded {
+                    index: Arc::new(index),
+                    fetched_at: SystemTime::now(),
+                });
+            }
+            DataSource::File(path) => {
+                debug!("Loading data from file: {:?}", path);
+                let data = tokio::fs::read_to_string(path)
+                    .await
+                    .map_err(|e| format!("Failed to read {:?}: {}", path, e))?;
+                (data, SystemTime::now(), None)
+            }
+            DataSource::Json(data) => (data.as_ref().clone(), SystemTime::now(), None),
+            DataSource::Url(url) => {
+                let cache_path = Self::get_cache_path(url)?;
+                let snapshot_path = Some(self.get_snapshot_path(&cache_path));
+                if fetch && !self.offline {
+                    let data = Self::fetch_and_cache(url, &cache_path).await?;
+                    (data, SystemTime::now(), snapshot_path)
                 } else {
-                    debug!("Could not calculate duration since last fetch, needs_refresh=true");
+                    match Self::read_cache(&cache_path).await {
+                        Ok((data, modified)) => (data, modified, snapshot_path),
+                        Err(e) if self.offline => {
+                            return Err(format!(
+                                "Failed to read cache file {:?} and network access is disabled: {}",
+                                cache_path, e
+                            )
+                            .into());
+                        }
+                        Err(e) => {
+                            debug!("Failed to read cache file ({}), fetching from network", e);
+                            let data = Self::fetch_and_cache(url, &cache_path).await?;
+                            (data, SystemTime::now(), snapshot_path)
+                        }
+                    }
                 }
-                needs
-            }
-            None => {
-                debug!("No last_fetch_time available, needs_refresh=true");
-                true
             }
         };
+        Ok(Loaded {
+            index: self.build_index(json_data, snapshot_path).await?,
+            fetched_at,
+        })
+    }
 
-        // Early return if data is already loaded and fresh
-        {
-            let radix_guard = self.radix.read().await;
-            if radix_guard.is_some() && !needs_refresh {
-                debug!("Data already loaded and fresh, returning early");
-                return Ok(());
-            }
-            debug!("Data not loaded or needs refresh, proceeding to load");
+    /// Loads the first index. For a URL source the cache file is used if there
+    /// is one, even if it is stale, since a refresh is started right after.
+    async fn load_initial(&self) -> Result<Loaded, Error> {
+        let _guard = self.load_lock.lock().await;
+        if let Some(loaded) = self.current() {
+            debug!("Index was loaded while waiting");
+            return Ok(loaded);
         }
+        let loaded = self.load_source(false).await?;
+        self.store(loaded.clone());
+        Ok(loaded)
+    }
 
-        // Load JSON data and build structures
-        let (json_data, fetched_fresh) = self.load_json_data(&cache_path, needs_refresh).await?;
-        debug!(
-            "Loaded JSON data, fetched_fresh={}, building data structures",
-            fetched_fresh
-        );
-        let (radix, providers_map) =
-            tokio::task::spawn_blocking(move || Self::build_data_structures(&json_data)).await??;
-        debug!("Built data structures: radix tree and providers map");
-
-        // Update in-memory data structures
-        {
-            let mut radix_guard = self.radix.write().await;
-            *radix_guard = Some(radix);
-            debug!("Updated radix tree in memory");
+    /// Reloads the data from the source, builds a new index from it and swaps
+    /// it in. Lookups keep using the current index until the new one is ready.
+    pub async fn refresh(&self) -> Result<(), Error> {
+        let loaded = self.load_source(true).await?;
+        self.store(loaded);
+        debug!("Swapped in refreshed index");
+        Ok(())
+    }
+
+    /// Starts a background refresh unless one is already running. If it
+    /// fails, the current data is kept and the refresh is retried later.
+    fn spawn_refresh(&self) {
+        if self.refreshing.swap(true, Ordering::AcqRel) {
+            return;
         }
-        {
-            let mut providers_guard = self.providers.write().await;
-            *providers_guard = Some(providers_map);
-            debug!("Updated providers map in memory");
+        debug!("Data is stale, refreshing in the background");
+        let cloudcheck = self.clone();
+        tokio::spawn(async move {
+            if let Err(e) = cloudcheck.refresh().await {
+                debug!("Background refresh failed, keeping stale data: {}", e);
+                let retry_delay = cloudcheck.ttl.min(REFRESH_RETRY_DELAY).as_secs();
+                cloudcheck
+                    .retry_at
+                    .store(unix_now() + retry_delay, Ordering::Relaxed);
+            }
+            cloudcheck.refreshing.store(false, Ordering::Release);
+        });
+    }
+
+    /// Returns the current index, loading it on first use. Stale data is
+    /// returned as-is and refreshed in the background (stale-while-revalidate),
+    /// so only the very first load ever waits.
+    async fn ensure_loaded(&self) -> Result<Arc<Index>, Error> {
+        let loaded = match self.current() {
+            Some(loaded) => loaded,
+            None => self.load_initial().await?,
+        };
+        if self.is_stale(&loaded) {
+            self.spawn_refresh();
         }
+        Ok(loaded.index)
+    }
+
+    pub async fn lookup(&self, target: &str) -> Result<Vec<CloudProvider>, Error> {
+        let (index, set) = self.find(target).await?;
+        Ok(index.providers(set))
+    }
+
+    /// Like `lookup()`, but returns the provider set instead of copies of the
+    /// providers, for callers that only need to borrow them (see
+    /// `Index::members`).
+    pub(crate) async fn find(&self, target: &str) -> Result<(Arc<Index>, Option<u32>), Error> {
+        let start = Instant::now();
+        let index = self.ensure_loaded().await?;
+        let set = self.cached_find(&index, target);
+        self.metrics.lookup_latency.record(start.elapsed());
+        Ok((index, set))
+    }
 
-        // Update timestamp if we fetched fresh data
-        if fetched_fresh {
-            let mut last_fetch = self.last_fetch.lock().await;
-            *last_fetch = Some(now);
-            debug!("Updated in-memory last_fetch timestamp to {:?}", now);
+    /// Returns a snapshot of the runtime metrics: lookup and hit counts,
+    /// latency histograms, index load timings, and the age and size of the
+    /// current data.
+    pub fn stats(&self) -> Stats {
+        let current = self.current();
+        let mut stats = self
+            .metrics
+            .snapshot(current.as_ref().map(|loaded| loaded.index.hit_counts()));
+        if let Some(loaded) = current {
+            stats.dataset_age = loaded.fetched_at.elapsed().ok();
+            stats.index_memory = loaded.index.memory_usage();
+            stats.index_mapped = loaded.index.is_mapped();
         }
+        stats
+    }
+
+    /// Looks up many targets at once. Freshness is checked a single time and the
+    /// same index is used for the whole batch. Large batches are spread across
+    /// all cores. Results are returned in input order.
+    pub async fn lookup_many(
+        &self,
+        targets: Vec<String>,
+    ) -> Result<Vec<Vec<CloudProvider>>, Error> {
+        let (index, sets) = self.find_many(targets).await?;
+        Ok(sets.into_iter().map(|set| index.providers(set)).collect())
+    }
+
+    /// Like `lookup_many()`, but returns provider sets (see `find()`).
+    pub(crate) async fn find_many(
+        &self,
+        targets: Vec<String>,
+    ) -> Result<(Arc<Index>, Vec<Option<u32>>), Error> {
+        let start = Instant::now();
+        let index = self.ensure_loaded().await?;
+        let sets = if targets.len() < PARALLEL_BATCH_THRESHOLD {
+            targets
+                .iter()
+                .map(|t| self.cached_find(&index, t))
+                .collect()
+        } else {
+            debug!("Looking up {} targets in parallel", targets.len());
+            let index = index.clone();
+            let cache = self.cache.clone();
+            tokio::task::spawn_blocking(move || {
+                index.find_parallel(&targets, |index, target| {
+                    find_with(cache.as_deref(), index, target)
+                })
+            })
+            .await?
+        };
+        self.metrics.batch_latency.record(start.elapsed());
+        Ok((index, sets))
+    }
 
+    /// Returns every provider prefix that overlaps an IP network (or address),
+    /// in address order, with how many of its addresses fall in the network.
+    /// Prefixes are the providers' own CIDRs: one nested inside another
+    /// provider's prefix is reported on its own, with its own providers. Host
+    /// bits of the network are ignored.
+    pub async fn lookup_range(&self, cidr: &str) -> Result<Vec<RangeOverlap>, Error> {
+        let (index, mut overlaps) = self.find_overlaps(vec![cidr.to_string()]).await?;
+        let overlaps = overlaps.pop().unwrap_or_default();
+        Ok(overlaps
+            .into_iter()
+            .map(|overlap| index.range_overlap(overlap))
+            .collect())
+    }
+
+    /// Same as `lookup_range()` for many networks, using the same index for
+    /// the whole batch. Results are returned in input order.
+    pub async fn lookup_ranges(&self, cidrs: Vec<String>) -> Result<Vec<Vec<RangeOverlap>>, Error> {
+        let (index, results) = self.find_overlaps(cidrs).await?;
+        Ok(results
+            .into_iter()
+            .map(|overlaps| {
+                overlaps
+                    .into_iter()
+                    .map(|overlap| index.range_overlap(overlap))
+                    .collect()
+            })
+            .collect())
+    }
+
+    /// Like `lookup_ranges()`, but returns provider ids instead of copies of
+    /// the providers (see `find()`).
+    pub(crate) async fn find_overlaps(
+        &self,
+        cidrs: Vec<String>,
+    ) -> Result<(Arc<Index>, Vec<Vec<Overlap>>), Error> {
+        let index = self.ensure_loaded().await?;
+        let search = index.clone();
+        let results = tokio::task::spawn_blocking(move || {
+            cidrs
+                .iter()
+                .map(|cidr| {
+                    search
+                        .find_overlaps(cidr)
+                        .ok_or_else(|| format!("Invalid IP network: '{}'", cidr).into())
+                })
+                .collect::<Result<Vec<_>, Error>>()
+        })
+        .await??;
+        Ok((index, results))
+    }
+
+    /// Writes the current index (loading it first if needed) to `path`, for
+    /// other processes to attach to with `DataSource::Index`. The file is
+    /// replaced atomically, so attached processes never see a partial index.
+    /// For prefork servers, publish once in the parent to a file on a tmpfs
+    /// such as `/dev/shm`, and every worker maps the same memory.
+    pub async fn publish_index(&self, path: impl AsRef<Path>) -> Result<(), Error> {
+        let index = self.ensure_loaded().await?;
+        let path = path.as_ref().to_path_buf();
+        tokio::task::spawn_blocking(move || index::write_snapshot(&path, index.bytes())).await??;
         Ok(())
     }
 
-    pub async fn lookup(&self, target: &str) -> Result<Vec<CloudProvider>, Error> {
-        self.ensure_loaded().await?;
+    /// Returns every provider name, sorted. The provider id used by the packed
+    /// lookups is the position in this list plus one (0 means no match).
+    pub async fn provider_names(&self) -> Result<Vec<String>, Error> {
+        Ok(self.ensure_loaded().await?.provider_names.clone())
+    }
 
-        let radix_guard = self.radix.read().await;
-        let providers_guard = self.providers.read().await;
+    /// Returns every tag name, sorted. Tag `i` is bit `1 << i` in a tag mask.
+    pub async fn tag_names(&self) -> Result<Vec<String>, Error> {
+        Ok(self.ensure_loaded().await?.tag_names.clone())
+    }
 
-        let radix = radix_guard.as_ref().unwrap();
-        let providers = providers_guard.as_ref().unwrap();
+    /// Looks up IPv4 addresses given as integers (e.g. `u32::from(Ipv4Addr)`).
+    /// Writes the matching provider id (see `provider_names()`) for each address
+    /// into `provider_ids`, and the union of the matching providers' tags into
+    /// `tag_masks` if given. When several providers match, the lowest id wins.
+    pub async fn lookup_ipv4_packed(
+        &self,
+        addresses: &[u32],
+        provider_ids: &mut [u32],
+        tag_masks: Option<&mut [u64]>,
+    ) -> Result<(), Error> {
+        check_packed_lengths(
+            addresses.len(),
+            provider_ids.len(),
+            tag_masks.as_ref().map(|t| t.len()),
+        )?;
+        let start = Instant::now();
+        let index = self.ensure_loaded().await?;
+        index.summarize_ips_parallel(
+            addresses,
+            |a| IpAddr::V4(Ipv4Addr::from(a)),
+            provider_ids,
+            tag_masks,
+        );
+        self.metrics.batch_latency.record(start.elapsed());
+        Ok(())
+    }
 
-        if let Some(normalized) = radix.get(target) {
-            Ok(providers.get(&normalized).cloned().unwrap_or_default())
-        } else {
-            Ok(Vec::new())
-        }
+    /// Same as `lookup_ipv4_packed()`, for IPv6 addresses given as
+    /// `[high 64 bits, low 64 bits]` pairs.
+    pub async fn lookup_ipv6_packed(
+        &self,
+        addresses: &[[u64; 2]],
+        provider_ids: &mut [u32],
+        tag_masks: Option<&mut [u64]>,
+    ) -> Result<(), Error> {
+        check_packed_lengths(
+            addresses.len(),
+            provider_ids.len(),
+            tag_masks.as_ref().map(|t| t.len()),
+        )?;
+        let start = Instant::now();
+        let index = self.ensure_loaded().await?;
+        index.summarize_ips_parallel(
+            addresses,
+            |[high, low]| IpAddr::V6(Ipv6Addr::from(((high as u128) << 64) | low as u128)),
+            provider_ids,
+            tag_masks,
+        );
+        self.metrics.batch_latency.record(start.elapsed());
+        Ok(())
     }
 }
 
@@ -376,4 +983,485 @@ mod tests {
             names
         );
     }
+
+    #[tokio::test]
+    async fn test_lookup_many() {
+        let cloudcheck = CloudCheck::new();
+        let targets = vec![
+            "8.8.8.8".to_string(),
+            "asdf.amazon.com".to_string(),
+            "not a hostname".to_string(),
+        ];
+        let results = cloudcheck.lookup_many(targets).await.unwrap();
+        assert_eq!(results.len(), 3);
+        assert!(results[0].iter().any(|p| p.name == "Google"));
+        assert!(results[1].iter().any(|p| p.name == "Amazon"));
+        assert!(results[2].is_empty());
+    }
+
+    #[tokio::test]
+    async fn test_lookup_many_parallel_preserves_order() {
+        let cloudcheck = CloudCheck::new();
+        let targets: Vec<String> = (0..PARALLEL_BATCH_THRESHOLD * 2)
+            .map(|i| {
+                if i % 2 == 0 {
+                    "8.8.8.8".to_string()
+                } else {
+                    "asdf.amazon.com".to_string()
+                }
+            })
+            .collect();
+        let results = cloudcheck.lookup_many(targets.clone()).await.unwrap();
+        assert_eq!(results.len(), targets.len());
+        for (target, providers) in targets.iter().zip(&results) {
+            assert_eq!(providers, &cloudcheck.lookup(target).await.unwrap());
+        }
+    }
+
+    #[tokio::test]
+    async fn test_lookup_cache() {
+        let cloudcheck = CloudCheck::new().with_cache(2);
+        for _ in 0..3 {
+            let results = cloudcheck.lookup("8.8.8.8").await.unwrap();
+            assert!(results.iter().any(|p| p.name == "Google"));
+        }
+        assert!(cloudcheck.lookup("asdf").await.unwrap().is_empty());
+        assert!(cloudcheck.lookup("asdf").await.unwrap().is_empty());
+        cloudcheck.lookup("asdf.amazon.com").await.unwrap();
+        // keys are normalized like lookups are, so this is the same entry
+        let results = cloudcheck.lookup("ASDF.Amazon.com.").await.unwrap();
+        assert!(results.iter().any(|p| p.name == "Amazon"));
+        let stats = cloudcheck.cache_stats().unwrap();
+        assert_eq!((stats.hits, stats.misses, stats.evictions), (4, 3, 1));
+        assert_eq!(stats.size, 2);
+        assert!(CloudCheck::new().cache_stats().is_none());
+    }
+
+    #[tokio::test]
+    async fn test_parallel_batch_uses_cache() {
+        let json = include_str!("../cloud_providers_v2.json");
+        let cloudcheck = CloudCheck::new()
+            .with_source(DataSource::Json(Arc::new(json.to_string())))
+            .with_cache(1024);
+        let targets: Vec<String> = (0..PARALLEL_BATCH_THRESHOLD * 2)
+            .map(|i| format!("host{}.amazonaws.com", i % 100))
+            .collect();
+        let (_, sets) = cloudcheck.find_many(targets.clone()).await.unwrap();
+        assert!(sets.iter().all(|set| set.is_some()));
+        let stats = cloudcheck.cache_stats().unwrap();
+        assert_eq!(stats.hits + stats.misses, targets.len() as u64);
+        // each distinct target misses once, or a few times if threads race on it
+        assert!(stats.size == 100 && stats.misses < 200);
+        let (_, again) = cloudcheck.find_many(targets).await.unwrap();
+        assert_eq!(again, sets);
+        assert_eq!(cloudcheck.cache_stats().unwrap().misses, stats.misses);
+    }
+
+    #[tokio::test]
+    async fn test_stale_data_is_served_while_refreshing() {
+        // a published index file is a local source that can be refreshed
+        let publish = |name: &str, path: PathBuf| {
+            let json = format!(
+                r#"{{"{0}": {{"name": "{0}", "tags": [], "cidrs": ["1.0.0.0/8"], "domains": []}}}}"#,
+                name
+            );
+            async move {
+                CloudCheck::new()
+                    .with_source(DataSource::Json(Arc::new(json)))
+                    .publish_index(path)
+                    .await
+                    .unwrap();
+            }
+        };
+        let names = |providers: Vec<CloudProvider>| -> Vec<String> {
+            providers.into_iter().map(|p| p.name).collect()
+        };
+        let path =
+            std::env::temp_dir().join(format!("cloudcheck-stale-{}.idx", std::process::id()));
+        publish("Old", path.clone()).await;
+        let fresh = CloudCheck::new().with_source(DataSource::Index(path.clone()));
+        assert_eq!(names(fresh.lookup("1.1.1.1").await.unwrap()), ["Old"]);
+
+        // a zero TTL makes the loaded index stale right away
+        let stale = CloudCheck::new()
+            .with_source(DataSource::Index(path.clone()))
+            .with_ttl(Duration::ZERO);
+        stale.store(fresh.current().unwrap());
+        publish("New", path.clone()).await;
+        let old = stale.ensure_loaded().await.unwrap();
+        assert!(stale.refreshing.load(Ordering::Acquire));
+
+        // lookups are answered from the stale index while the refresh runs
+        assert_eq!(names(stale.lookup("1.1.1.1").await.unwrap()), ["Old"]);
+        while stale.refreshing.load(Ordering::Acquire) {
+            tokio::time::sleep(Duration::from_millis(10)).await;
+        }
+        // then from the new one, once the refresh has swapped it in
+        assert_eq!(stale.retry_at.load(Ordering::Relaxed), 0);
+        assert_ne!(stale.current().unwrap().index.generation, old.generation);
+        assert_eq!(names(stale.lookup("1.1.1.1").await.unwrap()), ["New"]);
+        std::fs::remove_file(&path).unwrap();
+    }
+
+    #[tokio::test]
+    async fn test_lookup_from_json_and_file() {
+        let json = include_str!("../cloud_providers_v2.json");
+        let cloudcheck =
+            CloudCheck::new().with_source(DataSource::Json(Arc::new(json.to_string())));
+        let results = cloudcheck.lookup("8.8.8.8").await.unwrap();
+        assert!(results.iter().any(|p| p.name == "Google"));
+        assert!(!cloudcheck.is_stale(&cloudcheck.current().unwrap()));
+
+        let path = std::env::temp_dir().join(format!("cloudcheck-{}.json", std::process::id()));
+        std::fs::write(&path, json).unwrap();
+        let cloudcheck = CloudCheck::new().with_source(DataSource::File(path.clone()));
+        let results = cloudcheck.lookup("asdf.amazon.com").await.unwrap();
+        assert!(results.iter().any(|p| p.name == "Amazon"));
+        std::fs::remove_file(&path).unwrap();
+
+        let cloudcheck = CloudCheck::new().with_source(DataSource::File(path));
+        assert!(cloudcheck.lookup("8.8.8.8").await.is_err());
+        let cloudcheck = CloudCheck::new().with_source(DataSource::Json(Arc::default()));
+        assert!(cloudcheck.lookup("8.8.8.8").await.is_err());
+    }
+
+    #[tokio::test]
+    async fn test_cache_is_per_url() {
+        use tokio::io::{AsyncReadExt, AsyncWriteExt};
+
+        let listener = tokio::net::TcpListener::bind("127.0.0.1:0").await.unwrap();
+        let addr = listener.local_addr().unwrap();
+        let server = tokio::spawn(async move {
+            for _ in 0..2 {
+                let (mut stream, _) = listener.accept().await.unwrap();
+                let mut request = Vec::new();
+                let mut buf = [0u8; 1024];
+                while !request.ends_with(b"\r\n\r\n") {
+                    let n = stream.read(&mut buf).await.unwrap();
+                    request.extend_from_slice(&buf[..n]);
+                }
+                // GET /<provider name> HTTP/1.1
+                let request = String::from_utf8(request).unwrap();
+                let name = request.split(' ').nth(1).unwrap().trim_start_matches('/');
+                let body = format!(
+                    r#"{{"{0}": {{"name": "{0}", "tags": [], "cidrs": ["1.0.0.0/8"], "domains": []}}}}"#,
+                    name
+                );
+                let response = format!(
+                    "HTTP/1.1 200 OK\r\ncontent-length: {}\r\nconnection: close\r\n\r\n{}",
+                    body.len(),
+                    body
+                );
+                stream.write_all(response.as_bytes()).await.unwrap();
+            }
+        });
+
+        let urls = [
+            format!("http://{}/First", addr),
+            format!("http://{}/Second", addr),
+        ];
+        let cache_paths: Vec<PathBuf> = urls
+            .iter()
+            .map(|url| CloudCheck::get_cache_path(url).unwrap())
+            .collect();
+        assert_ne!(cache_paths[0], cache_paths[1]);
+        assert_eq!(
+            CloudCheck::get_cache_path(CLOUDCHECK_SIGNATURE_URL)
+                .unwrap()
+                .file_name()
+                .unwrap(),
+            "cloud_providers_v2.json"
+        );
+        for path in &cache_paths {
+            let _ = std::fs::remove_file(path);
+        }
+
+        let lookup = |url: &str, offline: bool| {
+            let cloudcheck = CloudCheck::new()
+                .with_source(DataSource::Url(url.to_string()))
+                .with_offline(offline);
+            async move {
+                let providers = cloudcheck.lookup("1.1.1.1").await.unwrap();
+                providers.into_iter().map(|p| p.name).collect::<Vec<_>>()
+            }
+        };
+        assert_eq!(lookup(&urls[0], false).await, ["First"]);
+        assert_eq!(lookup(&urls[1], false).await, ["Second"]);
+        server.await.unwrap();
+        // from the cache now, each URL with its own data
+        assert_eq!(lookup(&urls[0], true).await, ["First"]);
+        assert_eq!(lookup(&urls[1], true).await, ["Second"]);
+
+        for path in &cache_paths {
+            for extension in ["json", "meta", "idx"] {
+                let _ = std::fs::remove_file(path.with_extension(extension));
+            }
+        }
+    }
+
+    #[tokio::test]
+    async fn test_conditional_fetch() {
+        use tokio::io::{AsyncReadExt, AsyncWriteExt};
+
+        let listener = tokio::net::TcpListener::bind("127.0.0.1:0").await.unwrap();
+        let url = format!(
+            "http://{}/cloud_providers_v2.json",
+            listener.local_addr().unwrap()
+        );
+        let server = tokio::spawn(async move {
+            let mut requests = Vec::new();
+            for _ in 0..2 {
+                let (mut stream, _) = listener.accept().await.unwrap();
+                let mut request = Vec::new();
+                let mut buf = [0u8; 1024];
+                while !request.ends_with(b"\r\n\r\n") {
+                    let n = stream.read(&mut buf).await.unwrap();
+                    request.extend_from_slice(&buf[..n]);
+                }
+                let request = String::from_utf8(request).unwrap().to_lowercase();
+                let response = if request.contains("if-none-match: \"v1\"") {
+                    "HTTP/1.1 304 Not Modified\r\netag: \"v1\"\r\nconnection: close\r\n\r\n"
+                        .to_string()
+                } else {
+                    let body = "{}";
+                    format!(
+                        "HTTP/1.1 200 OK\r\netag: \"v1\"\r\ncontent-length: {}\r\nconnection: close\r\n\r\n{}",
+                        body.len(),
+                        body
+                    )
+                };
+                stream.write_all(response.as_bytes()).await.unwrap();
+                requests.push(request);
+            }
+            requests
+        });
+
+        let dir = std::env::temp_dir().join(format!("cloudcheck-fetch-{}", std::process::id()));
+        let cache_path = dir.join("cloud_providers_v2.json");
+        assert_eq!(
+            CloudCheck::fetch_and_cache(&url, &cache_path)
+                .await
+                .unwrap(),
+            "{}"
+        );
+        let day_ago = SystemTime::now() - Duration::from_secs(24 * 60 * 60);
+        std::fs::File::options()
+            .write(true)
+            .open(&cache_path)
+            .unwrap()
+            .set_modified(day_ago)
+            .unwrap();
+
+        // the second request is conditional, and a 304 only refreshes the timestamp
+        assert_eq!(
+            CloudCheck::fetch_and_cache(&url, &cache_path)
+                .await
+                .unwrap(),
+            "{}"
+        );
+        let modified = std::fs::metadata(&cache_path).unwrap().modified().unwrap();
+        assert!(modified > day_ago + Duration::from_secs(60));
+        let requests = server.await.unwrap();
+        assert!(!requests[0].contains("if-none-match"));
+        assert!(requests[1].contains("if-none-match: \"v1\""));
+        std::fs::remove_dir_all(dir).unwrap();
+    }
+
+    #[tokio::test]
+    async fn test_publish_and_attach_index() {
+        let json = include_str!("../cloud_providers_v2.json");
+        let publisher = CloudCheck::new().with_source(DataSource::Json(Arc::new(json.to_string())));
+        let path = std::env::temp_dir().join(format!("cloudcheck-{}.idx", std::process::id()));
+        publisher.publish_index(&path).await.unwrap();
+
+        let worker = CloudCheck::new().with_source(DataSource::Index(path.clone()));
+        for target in [
+            "8.8.8.8",
+            "asdf.amazon.com",
+            "asdf.blob.core.windows.net",
+            "asdf",
+        ] {
+            assert_eq!(
+                worker.lookup(target).await.unwrap(),
+                publisher.lookup(target).await.unwrap()
+            );
+        }
+        assert_eq!(
+            worker.provider_names().await.unwrap(),
+            publisher.provider_names().await.unwrap()
+        );
+        std::fs::remove_file(&path).unwrap();
+
+        // a missing index is an error, not a silent fallback to the network
+        let worker = CloudCheck::new().with_source(DataSource::Index(path));
+        assert!(worker.lookup("8.8.8.8").await.is_err());
+    }
+
+    #[tokio::test]
+    async fn test_stats() {
+        let json = include_str!("../cloud_providers_v2.json");
+        let cloudcheck = CloudCheck::new()
+            .with_source(DataSource::Json(Arc::new(json.to_string())))
+            .with_cache(16);
+        assert_eq!(cloudcheck.stats().lookups, 0);
+        cloudcheck.lookup("8.8.8.8").await.unwrap();
+        cloudcheck.lookup("8.8.8.8").await.unwrap();
+        cloudcheck.lookup("asdf").await.unwrap();
+        cloudcheck
+            .lookup_many(vec!["asdf.amazon.com".to_string()])
+            .await
+            .unwrap();
+
+        let stats = cloudcheck.stats();
+        assert_eq!((stats.lookups, stats.hits), (4, 3));
+        assert_eq!(stats.hits_by_provider["Google"], 2);
+        assert_eq!(stats.hits_by_provider["Amazon"], 1);
+        assert_eq!(stats.hits_by_tag["cloud"], 3);
+        let count = |histogram: &[(Option<Duration>, u64)]| -> u64 {
+            histogram.iter().map(|(_, count)| count).sum()
+        };
+        assert_eq!(count(&stats.lookup_latency), 3);
+        assert_eq!(count(&stats.batch_latency), 1);
+        assert_eq!(stats.index_loads, 1);
+        let last_load = stats.last_load.unwrap();
+        assert!(!last_load.from_snapshot);
+        assert!(last_load.parse > Duration::ZERO && last_load.build > Duration::ZERO);
+        assert!(stats.dataset_age.is_some());
+        assert!(stats.index_memory > 0);
+
+        // counts survive a refresh that swaps in a new index
+        cloudcheck.refresh().await.unwrap();
+        cloudcheck.lookup("8.8.8.8").await.unwrap();
+        let stats = cloudcheck.stats();
+        assert_eq!((stats.lookups, stats.hits), (5, 4));
+        assert_eq!(stats.hits_by_provider["Google"], 3);
+        assert_eq!(stats.index_loads, 2);
+    }
+
+    #[tokio::test]
+    async fn test_filtered_index() {
+        let json = Arc::new(include_str!("../cloud_providers_v2.json").to_string());
+        let cdn = CloudCheck::new()
+            .with_source(DataSource::Json(json.clone()))
+            .with_tags(["CDN"]);
+        assert!(cdn.lookup("8.8.8.8").await.unwrap().is_empty());
+        assert!(cdn.lookup("asdf.amazon.com").await.unwrap().is_empty());
+        let names: Vec<String> = cdn
+            .lookup("asdf.cloudflare.com")
+            .await
+            .unwrap()
+            .into_iter()
+            .map(|p| p.name)
+            .collect();
+        assert_eq!(names, ["Cloudflare"]);
+
+        let amazon = CloudCheck::new()
+            .with_source(DataSource::Json(json.clone()))
+            .with_providers(["amazon"]);
+        let names: Vec<String> = amazon.provider_names().await.unwrap();
+        assert_eq!(names, ["Amazon"]);
+        assert!(amazon.lookup("8.8.8.8").await.unwrap().is_empty());
+        assert!(!amazon.lookup("asdf.amazon.com").await.unwrap().is_empty());
+
+        // a provider must pass both filters
+        let none = CloudCheck::new()
+            .with_source(DataSource::Json(json.clone()))
+            .with_tags(["cdn"])
+            .with_providers(["Google"]);
+        assert!(none.provider_names().await.unwrap().is_empty());
+
+        let typo = CloudCheck::new()
+            .with_source(DataSource::Json(json))
+            .with_providers(["Amazn"]);
+        assert!(typo.lookup("8.8.8.8").await.is_err());
+    }
+
+    #[tokio::test]
+    async fn test_lookup_range() {
+        let cloudcheck = CloudCheck::new();
+        let overlaps = cloudcheck.lookup_range("8.8.0.0/16").await.unwrap();
+        assert!(
+            overlaps
+                .iter()
+                .any(|o| o.prefix.starts_with("8.8.8.") && o.providers[0].name == "Google")
+        );
+        let covered: u128 = overlaps.iter().map(|o| o.covered).sum();
+        assert!(covered > 0 && covered <= 1 << 16);
+
+        let results = cloudcheck
+            .lookup_ranges(vec!["8.8.8.8".to_string(), "127.0.0.0/8".to_string()])
+            .await
+            .unwrap();
+        assert_eq!(results[0].len(), 1);
+        assert_eq!(results[0][0].covered, 1);
+        assert!(results[1].is_empty());
+
+        assert!(cloudcheck.lookup_range("amazon.com").await.is_err());
+        assert!(
+            cloudcheck
+                .lookup_ranges(vec!["8.8.8.8".to_string(), "8.8.8.8/33".to_string()])
+                .await
+                .is_err()
+        );
+    }
+
+    #[tokio::test]
+    async fn test_lookup_packed() {
+        let cloudcheck = CloudCheck::new();
+        let names = cloudcheck.provider_names().await.unwrap();
+        let tags = cloudcheck.tag_names().await.unwrap();
+        let google_id = names.iter().position(|n| n == "Google").unwrap() as u32 + 1;
+        let cloud_bit = 1u64 << tags.iter().position(|t| t == "cloud").unwrap();
+
+        let addresses = [
+            u32::from(Ipv4Addr::new(8, 8, 8, 8)),
+            u32::from(Ipv4Addr::new(127, 0, 0, 1)),
+        ];
+        let mut provider_ids = [0u32; 2];
+        let mut tag_masks = [0u64; 2];
+        cloudcheck
+            .lookup_ipv4_packed(&addresses, &mut provider_ids, Some(&mut tag_masks))
+            .await
+            .unwrap();
+        assert_eq!(provider_ids, [google_id, 0]);
+        assert_eq!(tag_masks[0] & cloud_bit, cloud_bit);
+        assert_eq!(tag_masks[1], 0);
+
+        // a large batch takes the parallel path and must match the sequential one
+        let addresses: Vec<u32> = (0..PARALLEL_BATCH_THRESHOLD as u32 * 2)
+            .map(|i| u32::from(Ipv4Addr::new(8, 8, 0, 0)) + i)
+            .collect();
+        let mut parallel = vec![0u32; addresses.len()];
+        cloudcheck
+            .lookup_ipv4_packed(&addresses, &mut parallel, None)
+            .await
+            .unwrap();
+        let mut sequential = vec![0u32; addresses.len()];
+        cloudcheck
+            .lookup_ipv4_packed(&addresses[..10], &mut sequential[..10], None)
+            .await
+            .unwrap();
+        assert_eq!(parallel[..10], sequential[..10]);
+        assert!(parallel.contains(&google_id));
+
+        let google_v6: Ipv6Addr = "2001:4860:4860::8888".parse().unwrap();
+        let bits = u128::from(google_v6);
+        let mut provider_ids = [0u32; 1];
+        cloudcheck
+            .lookup_ipv6_packed(
+                &[[(bits >> 64) as u64, bits as u64]],
+                &mut provider_ids,
+                None,
+            )
+            .await
+            .unwrap();
+        assert_eq!(provider_ids, [google_id]);
+
+        assert!(
+            cloudcheck
+                .lookup_ipv4_packed(&addresses, &mut provider_ids, None)
+                .await
+                .is_err()
+        );
+    }
 }
@@ -1,49 +1,696 @@
-use crate::CloudCheck as RustCloudCheck;
+use crate::index::{Index, Overlap};
+use crate::{CloudCheck as RustCloudCheck, CloudProvider, DataSource, Error};
+use pyo3::buffer::{Element, PyBuffer};
+use pyo3::exceptions::{PyKeyError, PyRuntimeError, PyValueError};
 use pyo3::prelude::*;
-use pyo3::types::PyDict;
+use pyo3::types::{PyDict, PyString, PyTuple};
+use std::collections::HashMap;
+use std::path::PathBuf;
+use std::sync::{Arc, RwLock};
+use std::time::Duration;
 
 #[pymodule]
 fn cloudcheck(_py: Python, m: &Bound<'_, PyModule>) -> PyResult<()> {
     m.add_class::<CloudCheck>()?;
+    m.add_class::<Provider>()?;
     Ok(())
 }
 
-#[pyclass(name = "CloudCheck")]
+fn to_py_err(e: Error) -> PyErr {
+    PyErr::new::<PyRuntimeError, _>(format!("CloudCheck error: {}", e))
+}
+
+/// An immutable provider record. The same object is returned for every hit on
+/// a provider, so a result costs a reference instead of a new dict.
+#[pyclass(name = "Provider", module = "cloudcheck", frozen)]
+pub struct Provider {
+    #[pyo3(get)]
+    name: Py<PyString>,
+    #[pyo3(get)]
+    tags: Py<PyTuple>,
+    #[pyo3(get)]
+    short_description: Py<PyString>,
+    #[pyo3(get)]
+    long_description: Py<PyString>,
+}
+
+impl Provider {
+    fn new(py: Python<'_>, provider: &CloudProvider) -> PyResult<Self> {
+        let tags = provider.tags.iter().map(|tag| PyString::intern(py, tag));
+        Ok(Provider {
+            name: PyString::intern(py, &provider.name).unbind(),
+            tags: PyTuple::new(py, tags)?.unbind(),
+            short_description: PyString::new(py, &provider.short_description).unbind(),
+            long_description: PyString::new(py, &provider.long_description).unbind(),
+        })
+    }
+
+    /// Whether this object holds exactly the data of `provider`.
+    fn describes(&self, py: Python<'_>, provider: &CloudProvider) -> PyResult<bool> {
+        let tags = self.tags.bind(py);
+        if tags.len() != provider.tags.len() {
+            return Ok(false);
+        }
+        for (tag, expected) in tags.iter().zip(&provider.tags) {
+            if tag.extract::<String>()? != *expected {
+                return Ok(false);
+            }
+        }
+        Ok(self.name.bind(py).to_str()? == provider.name
+            && self.short_description.bind(py).to_str()? == provider.short_description
+            && self.long_description.bind(py).to_str()? == provider.long_description)
+    }
+}
+
+#[pymethods]
+impl Provider {
+    /// Dict-style access, so code written against dict results keeps working.
+    fn __getitem__(&self, py: Python<'_>, key: &str) -> PyResult<Py<PyAny>> {
+        match key {
+            "name" => Ok(self.name.clone_ref(py).into_any()),
+            "tags" => Ok(self.tags.clone_ref(py).into_any()),
+            "short_description" => Ok(self.short_description.clone_ref(py).into_any()),
+            "long_description" => Ok(self.long_description.clone_ref(py).into_any()),
+            _ => Err(PyKeyError::new_err(key.to_string())),
+        }
+    }
+
+    fn __repr__(&self, py: Python<'_>) -> PyResult<String> {
+        Ok(format!(
+            "Provider(name={:?}, tags={})",
+            self.name.bind(py).to_str()?,
+            self.tags.bind(py).repr()?
+        ))
+    }
+}
+
+/// The `Provider` objects of one index, by provider id.
+struct Interned {
+    generation: u64,
+    objects: Arc<[Py<Provider>]>,
+}
+
+/// The `Provider` objects of the most recent index results were built from.
+type ProviderTable = Arc<RwLock<Option<Interned>>>;
+
+/// Controls how lookup results are converted to Python objects.
+#[derive(Clone)]
+enum ResultType {
+    /// A new dict per hit.
+    Dict,
+    /// A shared `Provider` object per provider.
+    Provider(ProviderTable),
+}
+
+impl ResultType {
+    /// Builds the results of one provider set returned by `find()`.
+    fn build(&self, py: Python<'_>, index: &Index, set: Option<u32>) -> PyResult<Vec<Py<PyAny>>> {
+        self.build_ids(py, index, index.member_ids(set))
+    }
+
+    /// Builds the results of a batch straight from the index's provider
+    /// table, without copying the providers first. The `Provider` objects
+    /// are fetched once for the whole batch.
+    fn build_many(
+        &self,
+        py: Python<'_>,
+        index: &Index,
+        sets: Vec<Option<u32>>,
+    ) -> PyResult<Vec<Vec<Py<PyAny>>>> {
+        match self {
+            ResultType::Dict => sets
+                .into_iter()
+                .map(|set| providers_to_dicts(py, index.members(set)))
+                .collect(),
+            ResultType::Provider(table) => {
+                let objects = provider_objects(py, table, index)?;
+                Ok(sets
+                    .into_iter()
+                    .map(|set| interned(py, &objects, index.member_ids(set)))
+                    .collect())
+            }
+        }
+    }
+
+    fn build_ids(&self, py: Python<'_>, index: &Index, ids: &[u32]) -> PyResult<Vec<Py<PyAny>>> {
+        match self {
+            ResultType::Dict => providers_to_dicts(
+                py,
+                ids.iter().map(|&id| &index.provider_table()[id as usize]),
+            ),
+            ResultType::Provider(table) => {
+                Ok(interned(py, &provider_objects(py, table, index)?, ids))
+            }
+        }
+    }
+
+    /// Builds a `{"prefix", "providers", "covered"}` dict per overlap.
+    fn build_overlaps(
+        &self,
+        py: Python<'_>,
+        index: &Index,
+        overlaps: Vec<Overlap>,
+    ) -> PyResult<Vec<Py<PyAny>>> {
+        overlaps
+            .into_iter()
+            .map(|overlap| {
+                let dict = PyDict::new(py);
+                dict.set_item("prefix", overlap.prefix)?;
+                dict.set_item("providers", self.build_ids(py, index, &overlap.ids)?)?;
+                dict.set_item("covered", overlap.covered)?;
+                Ok(dict.unbind().into())
+            })
+            .collect()
+    }
+}
+
+fn providers_to_dicts<'a>(
+    py: Python<'_>,
+    providers: impl IntoIterator<Item = &'a CloudProvider>,
+) -> PyResult<Vec<Py<PyAny>>> {
+    let mut result = Vec::new();
+    for provider in providers {
+        let dict = PyDict::new(py);
+        dict.set_item("name", &provider.name)?;
+        dict.set_item("tags", provider.tags.as_slice())?;
+        dict.set_item("short_description", &provider.short_description)?;
+        dict.set_item("long_description", &provider.long_description)?;
+        result.push(dict.unbind().into());
+    }
+    Ok(result)
+}
+
+fn interned(py: Python<'_>, objects: &[Py<Provider>], ids: &[u32]) -> Vec<Py<PyAny>> {
+    ids.iter()
+        .map(|&id| objects[id as usize].clone_ref(py).into_any())
+        .collect()
+}
+
+/// Returns the shared `Provider` objects of an index, by provider id. They are
+/// created once per index generation: a lookup only compares the generation
+/// and indexes by id. When a refresh swaps in a new index, the table is rebuilt,
+/// reusing the objects of providers whose data did not change. No Python code
+/// runs while the table lock is held.
+fn provider_objects(
+    py: Python<'_>,
+    table: &ProviderTable,
+    index: &Index,
+) -> PyResult<Arc<[Py<Provider>]>> {
+    let previous = match table.read().unwrap().as_ref() {
+        Some(interned) if interned.generation == index.generation => {
+            return Ok(interned.objects.clone());
+        }
+        Some(interned) => Some(interned.objects.clone()),
+        None => None,
+    };
+    let mut reusable: HashMap<String, Py<Provider>> = HashMap::new();
+    if let Some(objects) = &previous {
+        for object in objects.iter() {
+            let name = object.get().name.bind(py).to_str()?.to_string();
+            reusable.insert(name, object.clone_ref(py));
+        }
+    }
+    let mut objects = Vec::with_capacity(index.provider_table().len());
+    for provider in index.provider_table() {
+        let object = match reusable.remove(&provider.name) {
+            Some(object) if object.get().describes(py, provider)? => object,
+            _ => Py::new(py, Provider::new(py, provider)?)?,
+        };
+        objects.push(object);
+    }
+    let objects: Arc<[Py<Provider>]> = objects.into();
+    let mut guard = table.write().unwrap();
+    // an in-flight batch on an older index must not evict a newer table
+    if guard
+        .as_ref()
+        .is_none_or(|interned| interned.generation < index.generation)
+    {
+        let replaced = guard.replace(Interned {
+            generation: index.generation,
+            objects: objects.clone(),
+        });
+        drop(guard);
+        drop(replaced);
+    }
+    Ok(objects)
+}
+
+fn check_buffer<T: Element>(buffer: &PyBuffer<T>, name: &str) -> PyResult<()> {
+    if !buffer.is_c_contiguous() {
+        return Err(PyValueError::new_err(format!(
+            "{} must be a C-contiguous buffer",
+            name
+        )));
+    }
+    if buffer.item_count() > 0 && !(buffer.buf_ptr() as usize).is_multiple_of(align_of::<T>()) {
+        return Err(PyValueError::new_err(format!("{} must be aligned", name)));
+    }
+    Ok(())
+}
+
+/// Borrows a buffer's contents without copying them.
+fn buffer_slice<'a, T: Element>(buffer: &'a PyBuffer<T>, name: &str) -> PyResult<&'a [T]> {
+    check_buffer(buffer, name)?;
+    if buffer.item_count() == 0 {
+        return Ok(&[]);
+    }
+    // SAFETY: the buffer is C-contiguous and aligned, holds item_count() elements
+    // of T, and stays exported for as long as `buffer` is borrowed.
+    Ok(unsafe { std::slice::from_raw_parts(buffer.buf_ptr() as *const T, buffer.item_count()) })
+}
+
+/// Mutably borrows a writable buffer's contents without copying them.
+fn buffer_slice_mut<'a, T: Element>(
+    buffer: &'a mut PyBuffer<T>,
+    name: &str,
+) -> PyResult<&'a mut [T]> {
+    check_buffer(buffer, name)?;
+    if buffer.readonly() {
+        return Err(PyValueError::new_err(format!("{} must be writable", name)));
+    }
+    if buffer.item_count() == 0 {
+        return Ok(&mut []);
+    }
+    // SAFETY: as in buffer_slice(); the buffer is writable and we hold the only
+    // Rust reference to it.
+    Ok(unsafe { std::slice::from_raw_parts_mut(buffer.buf_ptr() as *mut T, buffer.item_count()) })
+}
+
+/// Rejects output buffers that share memory with the input or each other.
+fn check_disjoint(buffers: &[(&str, *const u8, usize)]) -> PyResult<()> {
+    for (i, (name_a, start_a, len_a)) in buffers.iter().enumerate() {
+        for (name_b, start_b, len_b) in &buffers[i + 1..] {
+            let (a, b) = (*start_a as usize, *start_b as usize);
+            if *len_a > 0 && *len_b > 0 && a < b + len_b && b < a + len_a {
+                return Err(PyValueError::new_err(format!(
+                    "{} and {} must not share memory",
+                    name_a, name_b
+                )));
+            }
+        }
+    }
+    Ok(())
+}
+
+fn byte_range<'a, T>(name: &'a str, slice: &[T]) -> (&'a str, *const u8, usize) {
+    (
+        name,
+        slice.as_ptr() as *const u8,
+        std::mem::size_of_val(slice),
+    )
+}
+
+#[pyclass(name = "CloudCheck", subclass)]
 pub struct CloudCheck {
     inner: RustCloudCheck,
+    result_type: ResultType,
 }
 
 #[pymethods]
 impl CloudCheck {
+    /// `result_type` is either "dict" (the default, a new dict per hit) or
+    /// "provider" (shared, immutable `Provider` objects). `cache_size` enables
+    /// an LRU cache of that many lookup results. `ttl` is how many seconds
+    /// fetched data stays fresh; stale data keeps being used while it is
+    /// refreshed in the background.
+    ///
+    /// By default the data is fetched from the network and cached in
+    /// `~/.cache/cloudcheck`. At most one of `path` (a JSON file), `data` (JSON
+    /// as bytes or str), `url` or `index_path` (a file written by
+    /// `publish_index()`, mapped read-only) can be given instead; all but `url`
+    /// never touch the network or need `HOME`. `offline=True` disables network access
+    /// for the default and `url` sources, which then only use the cache file.
+    ///
+    /// `tags` and `providers` restrict the index to providers with one of the
+    /// given tags and/or with one of the given names, for faster startup and a
+    /// smaller index.
     #[new]
-    fn new() -> Self {
-        CloudCheck {
-            inner: RustCloudCheck::new(),
+    #[pyo3(signature = (
+        result_type = "dict",
+        cache_size = 0,
+        ttl = None,
+        path = None,
+        data = None,
+        url = None,
+        index_path = None,
+        offline = false,
+        tags = None,
+        providers = None,
+    ))]
+    #[allow(clippy::too_many_arguments)]
+    fn new(
+        result_type: &str,
+        cache_size: usize,
+        ttl: Option<f64>,
+        path: Option<PathBuf>,
+        data: Option<&Bound<'_, PyAny>>,
+        url: Option<String>,
+        index_path: Option<PathBuf>,
+        offline: bool,
+        tags: Option<Vec<String>>,
+        providers: Option<Vec<String>>,
+    ) -> PyResult<Self> {
+        let result_type = match result_type {
+            "dict" => ResultType::Dict,
+            "provider" => ResultType::Provider(Arc::default()),
+            other => {
+                return Err(PyValueError::new_err(format!(
+                    "Invalid result_type '{}', expected 'dict' or 'provider'",
+                    other
+                )));
+            }
+        };
+        let source = match (path, data, url, index_path) {
+            (None, None, None, None) => DataSource::default(),
+            (Some(path), None, None, None) => DataSource::File(path),
+            (None, Some(data), None, None) => {
+                let data = match data.extract::<String>() {
+                    Ok(data) => data,
+                    Err(_) => String::from_utf8(data.extract::<&[u8]>()?.to_vec())
+                        .map_err(|e| PyValueError::new_err(format!("Invalid data: {}", e)))?,
+                };
+                DataSource::Json(Arc::new(data))
+            }
+            (None, None, Some(url), None) => DataSource::Url(url),
+            (None, None, None, Some(index_path)) => DataSource::Index(index_path),
+            _ => {
+                return Err(PyValueError::new_err(
+                    "Only one of path, data, url or index_path can be given",
+                ));
+            }
+        };
+        let mut inner = RustCloudCheck::new()
+            .with_cache(cache_size)
+            .with_source(source)
+            .with_offline(offline)
+            .with_tags(tags.unwrap_or_default())
+            .with_providers(providers.unwrap_or_default());
+        if let Some(ttl) = ttl {
+            let ttl = Duration::try_from_secs_f64(ttl)
+                .map_err(|e| PyValueError::new_err(format!("Invalid ttl: {}", e)))?;
+            inner = inner.with_ttl(ttl);
+        }
+        Ok(CloudCheck { inner, result_type })
+    }
+
+    /// Returns the lookup cache's hits, misses, evictions, size and capacity,
+    /// or None if caching is disabled.
+    fn cache_stats<'py>(&self, py: Python<'py>) -> PyResult<Option<Bound<'py, PyDict>>> {
+        let Some(stats) = self.inner.cache_stats() else {
+            return Ok(None);
+        };
+        let dict = PyDict::new(py);
+        dict.set_item("hits", stats.hits)?;
+        dict.set_item("misses", stats.misses)?;
+        dict.set_item("evictions", stats.evictions)?;
+        dict.set_item("size", stats.size)?;
+        dict.set_item("capacity", stats.capacity)?;
+        Ok(Some(dict))
+    }
+
+    /// Returns runtime metrics for scraping: lookup and hit counts (overall,
+    /// by provider and by tag), latency histograms as (upper bound in seconds,
+    /// count) buckets, index load counts and timings, and the age and
+    /// approximate memory of the current data. Durations are in seconds.
+    fn stats<'py>(&self, py: Python<'py>) -> PyResult<Bound<'py, PyDict>> {
+        let stats = self.inner.stats();
+        let rate = |hits: u64| {
+            if stats.lookups == 0 {
+                0.0
+            } else {
+                hits as f64 / stats.lookups as f64
+            }
+        };
+        let histogram = |buckets: &[(Option<Duration>, u64)]| -> Vec<(f64, u64)> {
+            buckets
+                .iter()
+                .map(|(bound, count)| (bound.map_or(f64::INFINITY, |b| b.as_secs_f64()), *count))
+                .collect()
+        };
+
+        let dict = PyDict::new(py);
+        dict.set_item("lookups", stats.lookups)?;
+        dict.set_item("hits", stats.hits)?;
+        dict.set_item("hit_rate", rate(stats.hits))?;
+        for (name, counts) in [
+            ("provider", &stats.hits_by_provider),
+            ("tag", &stats.hits_by_tag),
+        ] {
+            let hits = PyDict::new(py);
+            let hit_rates = PyDict::new(py);
+            for (key, count) in counts {
+                hits.set_item(key, count)?;
+                hit_rates.set_item(key, rate(*count))?;
+            }
+            dict.set_item(format!("hits_by_{}", name), hits)?;
+            dict.set_item(format!("hit_rate_by_{}", name), hit_rates)?;
         }
+        dict.set_item("lookup_latency", histogram(&stats.lookup_latency))?;
+        dict.set_item("batch_latency", histogram(&stats.batch_latency))?;
+        dict.set_item("index_loads", stats.index_loads)?;
+        dict.set_item("index_load_seconds", stats.index_load_time.as_secs_f64())?;
+        dict.set_item("json_parse_seconds", stats.json_parse_time.as_secs_f64())?;
+        dict.set_item("index_build_seconds", stats.index_build_time.as_secs_f64())?;
+        let last_load = match stats.last_load {
+            Some(timings) => {
+                let last_load = PyDict::new(py);
+                last_load.set_item("parse_seconds", timings.parse.as_secs_f64())?;
+                last_load.set_item("build_seconds", timings.build.as_secs_f64())?;
+                last_load.set_item("total_seconds", timings.total.as_secs_f64())?;
+                last_load.set_item("from_snapshot", timings.from_snapshot)?;
+                Some(last_load)
+            }
+            None => None,
+        };
+        dict.set_item("last_load", last_load)?;
+        dict.set_item(
+            "dataset_age_seconds",
+            stats.dataset_age.map(|age| age.as_secs_f64()),
+        )?;
+        dict.set_item("index_memory_bytes", stats.index_memory)?;
+        dict.set_item("index_mapped", stats.index_mapped)?;
+        Ok(dict)
     }
 
     fn lookup<'py>(&self, py: Python<'py>, target: &str) -> PyResult<Bound<'py, PyAny>> {
         let inner = self.inner.clone();
+        let result_type = self.result_type.clone();
         let target = target.to_string();
         pyo3_async_runtimes::tokio::future_into_py(py, async move {
-            match inner.lookup(&target).await {
-                Ok(providers) => Python::attach(|py| -> PyResult<Vec<Py<PyAny>>> {
-                    let mut result = Vec::new();
-                    for provider in providers {
-                        let dict = PyDict::new(py);
-                        dict.set_item("name", provider.name)?;
-                        dict.set_item("tags", provider.tags)?;
-                        dict.set_item("short_description", provider.short_description)?;
-                        dict.set_item("long_description", provider.long_description)?;
-                        result.push(dict.unbind().into());
-                    }
-                    Ok(result)
+            match inner.find(&target).await {
+                Ok((index, set)) => Python::attach(|py| result_type.build(py, &index, set)),
+                Err(e) => Err(to_py_err(e)),
+            }
+        })
+    }
+
+    fn lookup_many<'py>(
+        &self,
+        py: Python<'py>,
+        targets: Vec<String>,
+    ) -> PyResult<Bound<'py, PyAny>> {
+        let inner = self.inner.clone();
+        let result_type = self.result_type.clone();
+        pyo3_async_runtimes::tokio::future_into_py(py, async move {
+            match inner.find_many(targets).await {
+                Ok((index, sets)) => Python::attach(|py| result_type.build_many(py, &index, sets)),
+                Err(e) => Err(to_py_err(e)),
+            }
+        })
+    }
+
+    /// Returns every provider prefix overlapping an IP network, as dicts with
+    /// the `prefix`, its `providers` and how many addresses of the network it
+    /// `covered`.
+    fn lookup_range<'py>(&self, py: Python<'py>, cidr: &str) -> PyResult<Bound<'py, PyAny>> {
+        let inner = self.inner.clone();
+        let result_type = self.result_type.clone();
+        let cidr = cidr.to_string();
+        pyo3_async_runtimes::tokio::future_into_py(py, async move {
+            match inner.find_overlaps(vec![cidr]).await {
+                Ok((index, mut results)) => Python::attach(|py| {
+                    result_type.build_overlaps(py, &index, results.pop().unwrap_or_default())
                 }),
-                Err(e) => Err(PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!(
-                    "CloudCheck error: {}",
-                    e
-                ))),
+                Err(e) => Err(to_py_err(e)),
             }
         })
     }
+
+    /// Batch version of `lookup_range()`. Results are in input order.
+    fn lookup_ranges<'py>(
+        &self,
+        py: Python<'py>,
+        cidrs: Vec<String>,
+    ) -> PyResult<Bound<'py, PyAny>> {
+        let inner = self.inner.clone();
+        let result_type = self.result_type.clone();
+        pyo3_async_runtimes::tokio::future_into_py(py, async move {
+            match inner.find_overlaps(cidrs).await {
+                Ok((index, results)) => Python::attach(|py| {
+                    results
+                        .into_iter()
+                        .map(|overlaps| result_type.build_overlaps(py, &index, overlaps))
+                        .collect::<PyResult<Vec<_>>>()
+                }),
+                Err(e) => Err(to_py_err(e)),
+            }
+        })
+    }
+
+    /// Synchronous version of `lookup_range()`, releasing the GIL.
+    fn lookup_range_sync(&self, py: Python<'_>, cidr: &str) -> PyResult<Vec<Py<PyAny>>> {
+        let inner = &self.inner;
+        let (index, mut results) = py
+            .detach(|| {
+                pyo3_async_runtimes::tokio::get_runtime()
+                    .block_on(inner.find_overlaps(vec![cidr.to_string()]))
+            })
+            .map_err(to_py_err)?;
+        self.result_type
+            .build_overlaps(py, &index, results.pop().unwrap_or_default())
+    }
+
+    /// Synchronous version of `lookup_ranges()`, releasing the GIL.
+    fn lookup_ranges_sync(
+        &self,
+        py: Python<'_>,
+        cidrs: Vec<String>,
+    ) -> PyResult<Vec<Vec<Py<PyAny>>>> {
+        let inner = &self.inner;
+        let (index, results) = py
+            .detach(|| {
+                pyo3_async_runtimes::tokio::get_runtime().block_on(inner.find_overlaps(cidrs))
+            })
+            .map_err(to_py_err)?;
+        results
+            .into_iter()
+            .map(|overlaps| self.result_type.build_overlaps(py, &index, overlaps))
+            .collect()
+    }
+
+    /// Synchronous version of `lookup()`. The GIL is released while the data
+    /// is loaded and the index is searched, so it scales across threads.
+    fn lookup_sync(&self, py: Python<'_>, target: &str) -> PyResult<Vec<Py<PyAny>>> {
+        let inner = &self.inner;
+        let (index, set) = py
+            .detach(|| pyo3_async_runtimes::tokio::get_runtime().block_on(inner.find(target)))
+            .map_err(to_py_err)?;
+        self.result_type.build(py, &index, set)
+    }
+
+    /// Synchronous version of `lookup_many()`. The GIL is released for the
+    /// whole batch.
+    fn lookup_many_sync(
+        &self,
+        py: Python<'_>,
+        targets: Vec<String>,
+    ) -> PyResult<Vec<Vec<Py<PyAny>>>> {
+        let inner = &self.inner;
+        let (index, sets) = py
+            .detach(|| pyo3_async_runtimes::tokio::get_runtime().block_on(inner.find_many(targets)))
+            .map_err(to_py_err)?;
+        self.result_type.build_many(py, &index, sets)
+    }
+
+    /// Writes the loaded index to `path` for other processes to attach to with
+    /// `CloudCheck(index_path=path)`. For prefork servers, publish once in the
+    /// parent to a file on a tmpfs such as `/dev/shm`; every worker then maps
+    /// the same memory instead of building its own copy.
+    fn publish_index(&self, py: Python<'_>, path: PathBuf) -> PyResult<()> {
+        let inner = &self.inner;
+        py.detach(|| pyo3_async_runtimes::tokio::get_runtime().block_on(inner.publish_index(path)))
+            .map_err(to_py_err)
+    }
+
+    /// Sorted provider names. The provider ids written by `lookup_ipv4_into()`
+    /// and `lookup_ipv6_into()` are positions in this list plus one.
+    fn provider_names(&self, py: Python<'_>) -> PyResult<Vec<String>> {
+        let inner = &self.inner;
+        py.detach(|| pyo3_async_runtimes::tokio::get_runtime().block_on(inner.provider_names()))
+            .map_err(to_py_err)
+    }
+
+    /// Sorted tag names. Tag `i` is bit `1 << i` in a tag mask.
+    fn tag_names(&self, py: Python<'_>) -> PyResult<Vec<String>> {
+        let inner = &self.inner;
+        py.detach(|| pyo3_async_runtimes::tokio::get_runtime().block_on(inner.tag_names()))
+            .map_err(to_py_err)
+    }
+
+    /// Looks up a buffer of uint32 IPv4 addresses and writes a uint32 provider
+    /// id (0 for no match) per address into `provider_ids`, and optionally a
+    /// uint64 tag mask per address into `tag_masks`. Nothing is copied and the
+    /// GIL is released during the lookup.
+    #[pyo3(signature = (addresses, provider_ids, tag_masks = None))]
+    fn lookup_ipv4_into(
+        &self,
+        py: Python<'_>,
+        addresses: PyBuffer<u32>,
+        mut provider_ids: PyBuffer<u32>,
+        mut tag_masks: Option<PyBuffer<u64>>,
+    ) -> PyResult<()> {
+        let address_slice = buffer_slice(&addresses, "addresses")?;
+        let id_slice = buffer_slice_mut(&mut provider_ids, "provider_ids")?;
+        let mask_slice = match tag_masks.as_mut() {
+            Some(buffer) => Some(buffer_slice_mut(buffer, "tag_masks")?),
+            None => None,
+        };
+        let mut ranges = vec![
+            byte_range("addresses", address_slice),
+            byte_range("provider_ids", id_slice),
+        ];
+        if let Some(mask_slice) = mask_slice.as_deref() {
+            ranges.push(byte_range("tag_masks", mask_slice));
+        }
+        check_disjoint(&ranges)?;
+
+        let inner = &self.inner;
+        py.detach(|| {
+            pyo3_async_runtimes::tokio::get_runtime().block_on(inner.lookup_ipv4_packed(
+                address_slice,
+                id_slice,
+                mask_slice,
+            ))
+        })
+        .map_err(to_py_err)
+    }
+
+    /// Same as `lookup_ipv4_into()`, for a (N, 2) uint64 buffer of IPv6
+    /// addresses split into (high 64 bits, low 64 bits).
+    #[pyo3(signature = (addresses, provider_ids, tag_masks = None))]
+    fn lookup_ipv6_into(
+        &self,
+        py: Python<'_>,
+        addresses: PyBuffer<u64>,
+        mut provider_ids: PyBuffer<u32>,
+        mut tag_masks: Option<PyBuffer<u64>>,
+    ) -> PyResult<()> {
+        let address_slice = buffer_slice(&addresses, "addresses")?;
+        if !address_slice.len().is_multiple_of(2) {
+            return Err(PyValueError::new_err(
+                "addresses must hold (high, low) uint64 pairs",
+            ));
+        }
+        let id_slice = buffer_slice_mut(&mut provider_ids, "provider_ids")?;
+        let mask_slice = match tag_masks.as_mut() {
+            Some(buffer) => Some(buffer_slice_mut(buffer, "tag_masks")?),
+            None => None,
+        };
+        let mut ranges = vec![
+            byte_range("addresses", address_slice),
+            byte_range("provider_ids", id_slice),
+        ];
+        if let Some(mask_slice) = mask_slice.as_deref() {
+            ranges.push(byte_range("tag_masks", mask_slice));
+        }
+        check_disjoint(&ranges)?;
+        let (pairs, _) = address_slice.as_chunks::<2>();
+
+        let inner = &self.inner;
+        py.detach(|| {
+            pyo3_async_runtimes::tokio::get_runtime()
+                .block_on(inner.lookup_ipv6_packed(pairs, id_slice, mask_slice))
+        })
+        .map_err(to_py_err)
+    }
 }
@@ -0,0 +1,199 @@
+use std::collections::{BTreeMap, HashMap};
+use std::sync::Mutex;
+use std::sync::atomic::{AtomicU64, Ordering};
+use std::time::Duration;
+
+/// Number of latency buckets. Bucket `i` counts calls that took less than
+/// `2^i` microseconds, and the last one counts everything slower.
+const LATENCY_BUCKETS: usize = 24;
+
+/// A latency histogram with power-of-two microsecond buckets.
+pub(crate) struct Histogram {
+    buckets: [AtomicU64; LATENCY_BUCKETS],
+}
+
+impl Histogram {
+    fn new() -> Self {
+        Histogram {
+            buckets: std::array::from_fn(|_| AtomicU64::new(0)),
+        }
+    }
+
+    pub(crate) fn record(&self, elapsed: Duration) {
+        let micros = elapsed.as_micros().min(u64::MAX as u128) as u64;
+        // smallest i with micros < 2^i
+        let bucket = (u64::BITS - micros.leading_zeros()) as usize;
+        self.buckets[bucket.min(LATENCY_BUCKETS - 1)].fetch_add(1, Ordering::Relaxed);
+    }
+
+    /// Returns (upper bound, count) for each bucket. The last bound is None,
+    /// meaning unbounded.
+    fn snapshot(&self) -> Vec<(Option<Duration>, u64)> {
+        self.buckets
+            .iter()
+            .enumerate()
+            .map(|(i, count)| {
+                let bound = (i < LATENCY_BUCKETS - 1).then(|| Duration::from_micros(1 << i));
+                (bound, count.load(Ordering::Relaxed))
+            })
+            .collect()
+    }
+}
+
+/// How long loading one index took.
+#[derive(Debug, Clone, Copy, Default, PartialEq, Eq)]
+pub struct LoadTimings {
+    /// Parsing the JSON (zero when a snapshot was used).
+    pub parse: Duration,
+    /// Building the radix tree and serializing the index (zero when a
+    /// snapshot was used).
+    pub build: Duration,
+    /// The whole load, including reading or writing the snapshot.
+    pub total: Duration,
+    /// Whether an existing index snapshot or published index was mapped.
+    pub from_snapshot: bool,
+}
+
+/// A point-in-time copy of the runtime metrics of a `CloudCheck`.
+#[derive(Debug, Clone, Default, PartialEq)]
+pub struct Stats {
+    /// Targets looked up, including packed addresses.
+    pub lookups: u64,
+    /// Lookups that matched at least one provider.
+    pub hits: u64,
+    /// Lookups that matched each provider.
+    pub hits_by_provider: BTreeMap<String, u64>,
+    /// Lookups that matched a provider with each tag.
+    pub hits_by_tag: BTreeMap<String, u64>,
+    /// Latency of single lookups, as (upper bound, count) buckets.
+    pub lookup_latency: Vec<(Option<Duration>, u64)>,
+    /// Latency of batch lookups, as (upper bound, count) buckets.
+    pub batch_latency: Vec<(Option<Duration>, u64)>,
+    /// Number of indexes loaded (the first load and every refresh).
+    pub index_loads: u64,
+    /// Total time spent loading indexes.
+    pub index_load_time: Duration,
+    /// Total time spent parsing JSON.
+    pub json_parse_time: Duration,
+    /// Total time spent building indexes from parsed JSON.
+    pub index_build_time: Duration,
+    /// Timings of the most recent load.
+    pub last_load: Option<LoadTimings>,
+    /// Time since the current data was fetched.
+    pub dataset_age: Option<Duration>,
+    /// Approximate memory used by the current index, in bytes.
+    pub index_memory: usize,
+    /// Whether the current index is memory-mapped from a file.
+    pub index_mapped: bool,
+}
+
+#[derive(Default)]
+struct Loads {
+    count: u64,
+    total: Duration,
+    parse: Duration,
+    build: Duration,
+    last: Option<LoadTimings>,
+}
+
+/// Lookup and hit counts of one or more indexes.
+#[derive(Clone, Default)]
+pub(crate) struct HitCounts {
+    pub(crate) lookups: u64,
+    pub(crate) hits: u64,
+    pub(crate) by_provider: HashMap<String, u64>,
+    pub(crate) by_tag: HashMap<String, u64>,
+}
+
+impl HitCounts {
+    fn add(&mut self, other: HitCounts) {
+        self.lookups += other.lookups;
+        self.hits += other.hits;
+        for (name, hits) in other.by_provider {
+            *self.by_provider.entry(name).or_default() += hits;
+        }
+        for (tag, hits) in other.by_tag {
+            *self.by_tag.entry(tag).or_default() += hits;
+        }
+    }
+}
+
+/// Runtime metrics shared by every clone of a `CloudCheck`. Hit counts live in
+/// the index itself (see `Index::hit_counts`) and are folded in here when the
+/// index is swapped out.
+pub(crate) struct Metrics {
+    pub(crate) lookup_latency: Histogram,
+    pub(crate) batch_latency: Histogram,
+    loads: Mutex<Loads>,
+    /// Counts of indexes that have been swapped out.
+    retired: Mutex<HitCounts>,
+}
+
+impl Metrics {
+    pub(crate) fn new() -> Self {
+        Metrics {
+            lookup_latency: Histogram::new(),
+            batch_latency: Histogram::new(),
+            loads: Mutex::default(),
+            retired: Mutex::default(),
+        }
+    }
+
+    pub(crate) fn record_load(&self, timings: LoadTimings) {
+        let mut loads = self.loads.lock().unwrap();
+        loads.count += 1;
+        loads.total += timings.total;
+        loads.parse += timings.parse;
+        loads.build += timings.build;
+        loads.last = Some(timings);
+    }
+
+    /// Keeps the hit counts of an index that is being swapped out. Lookups
+    /// still running on it after this are not counted.
+    pub(crate) fn retire(&self, counts: HitCounts) {
+        self.retired.lock().unwrap().add(counts);
+    }
+
+    /// Combines the retired counts with those of the current index.
+    pub(crate) fn snapshot(&self, current: Option<HitCounts>) -> Stats {
+        let mut counts = self.retired.lock().unwrap().clone();
+        if let Some(current) = current {
+            counts.add(current);
+        }
+        let loads = self.loads.lock().unwrap();
+        Stats {
+            lookups: counts.lookups,
+            hits: counts.hits,
+            hits_by_provider: counts.by_provider.into_iter().collect(),
+            hits_by_tag: counts.by_tag.into_iter().collect(),
+            lookup_latency: self.lookup_latency.snapshot(),
+            batch_latency: self.batch_latency.snapshot(),
+            index_loads: loads.count,
+            index_load_time: loads.total,
+            json_parse_time: loads.parse,
+            index_build_time: loads.build,
+            last_load: loads.last,
+            ..Stats::default()
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_histogram_buckets() {
+        let histogram = Histogram::new();
+        histogram.record(Duration::ZERO);
+        histogram.record(Duration::from_nanos(999));
+        histogram.record(Duration::from_micros(1));
+        histogram.record(Duration::from_micros(3));
+        histogram.record(Duration::from_secs(3600));
+        let snapshot = histogram.snapshot();
+        assert_eq!(snapshot[0], (Some(Duration::from_micros(1)), 2));
+        assert_eq!(snapshot[1], (Some(Duration::from_micros(2)), 1));
+        assert_eq!(snapshot[2], (Some(Duration::from_micros(4)), 1));
+        assert_eq!(snapshot[LATENCY_BUCKETS - 1], (None, 1));
+    }
+}
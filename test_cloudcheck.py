@@ -1,5 +1,14 @@
+import asyncio
+import json
+from pathlib import Path
+
 import pytest
-from cloudcheck import CloudCheck
+from cloudcheck import CloudCheck, Provider
+
+# for features the pure-Python fallback engine does not have
+requires_extension = pytest.mark.skipif(
+    Provider is None, reason="compiled extension not available"
+)
 
 
 @pytest.mark.asyncio
@@ -22,3 +31,471 @@ def test_import_provider():
     from cloudcheck.providers import Amazon
 
     assert Amazon.regexes
+
+
+@pytest.mark.asyncio
+async def test_lookup_many():
+    cloudcheck = CloudCheck()
+    results = await cloudcheck.lookup_many(["8.8.8.8", "asdf.amazon.com", "asdf"])
+    assert len(results) == 3
+    assert "Google" in [provider["name"] for provider in results[0]]
+    assert "Amazon" in [provider["name"] for provider in results[1]]
+    assert results[2] == []
+
+
+def test_lookup_sync():
+    from concurrent.futures import ThreadPoolExecutor
+
+    cloudcheck = CloudCheck()
+    names = [provider["name"] for provider in cloudcheck.lookup_sync("8.8.8.8")]
+    assert "Google" in names, f"Expected Google in results: {names}"
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(cloudcheck.lookup_sync, ["asdf.amazon.com"] * 8))
+    for result in results:
+        assert "Amazon" in [provider["name"] for provider in result]
+
+    results = cloudcheck.lookup_many_sync(["8.8.8.8", "asdf.amazon.com"])
+    assert "Google" in [provider["name"] for provider in results[0]]
+    assert "Amazon" in [provider["name"] for provider in results[1]]
+
+
+@pytest.mark.asyncio
+async def test_lookup_stream():
+    cloudcheck = CloudCheck()
+
+    async def targets():
+        for _ in range(5):
+            yield "8.8.8.8"
+            yield "asdf.amazon.com\n"
+
+    results = [
+        (target, providers)
+        async for target, providers in cloudcheck.lookup_stream(
+            targets(), concurrency=2, chunk_size=3
+        )
+    ]
+    assert [target for target, _ in results] == ["8.8.8.8", "asdf.amazon.com"] * 5
+    for target, providers in results:
+        names = [provider["name"] for provider in providers]
+        assert ("Google" if target == "8.8.8.8" else "Amazon") in names
+
+    results = [r async for r in cloudcheck.lookup_stream(["8.8.8.8"])]
+    assert len(results) == 1
+
+
+@requires_extension
+def test_lookup_provider_objects():
+    from cloudcheck import Provider
+
+    cloudcheck = CloudCheck(result_type="provider")
+    first = cloudcheck.lookup_sync("8.8.8.8")
+    second = cloudcheck.lookup_sync("8.8.4.4")
+    google = [provider for provider in first if provider.name == "Google"]
+    assert google, f"Expected Google in results: {first}"
+    assert isinstance(google[0], Provider)
+    assert google[0]["name"] == "Google"
+    assert "cloud" in google[0].tags
+    # the same object is handed out for every hit
+    assert any(provider is google[0] for provider in second)
+
+    with pytest.raises(ValueError):
+        CloudCheck(result_type="asdf")
+
+
+@requires_extension
+def test_lookup_ip_array():
+    import ipaddress
+
+    np = pytest.importorskip("numpy")
+
+    cloudcheck = CloudCheck()
+    names = cloudcheck.provider_names()
+    tags = cloudcheck.tag_names()
+    google_id = names.index("Google") + 1
+    cloud_bit = 1 << tags.index("cloud")
+
+    addresses = np.array(
+        [int(ipaddress.ip_address("8.8.8.8")), int(ipaddress.ip_address("127.0.0.1"))],
+        dtype=np.uint32,
+    )
+    provider_ids, tag_masks = cloudcheck.lookup_ip_array(addresses, tags=True)
+    assert provider_ids.tolist() == [google_id, 0]
+    assert int(tag_masks[0]) & cloud_bit
+    assert int(tag_masks[1]) == 0
+
+    google_v6 = int(ipaddress.ip_address("2001:4860:4860::8888"))
+    addresses = np.array([[google_v6 >> 64, google_v6 & (2**64 - 1)]], dtype=np.uint64)
+    assert cloudcheck.lookup_ip_array(addresses).tolist() == [google_id]
+
+    with pytest.raises(ValueError):
+        cloudcheck.lookup_ip_array(np.array([1.0]))
+
+
+@requires_extension
+def test_lookup_cache():
+    cloudcheck = CloudCheck(cache_size=2)
+    for _ in range(3):
+        names = [provider["name"] for provider in cloudcheck.lookup_sync("8.8.8.8")]
+        assert "Google" in names
+    assert cloudcheck.lookup_sync("asdf") == []
+    cloudcheck.lookup_sync("asdf.amazon.com")
+    stats = cloudcheck.cache_stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 3
+    assert stats["evictions"] == 1
+    assert stats["size"] == stats["capacity"] == 2
+
+    assert CloudCheck().cache_stats() is None
+
+
+def test_load_from_path_and_data(monkeypatch, tmp_path):
+    # neither source may touch HOME or the network
+    monkeypatch.delenv("HOME")
+    json_path = Path(__file__).parent / "cloud_providers_v2.json"
+    for cloudcheck in (
+        CloudCheck(path=json_path),
+        CloudCheck(path=str(json_path)),
+        CloudCheck(data=json_path.read_bytes()),
+        CloudCheck(data=json_path.read_text()),
+    ):
+        names = [provider["name"] for provider in cloudcheck.lookup_sync("8.8.8.8")]
+        assert "Google" in names
+
+    with pytest.raises(RuntimeError):
+        CloudCheck(path=tmp_path / "missing.json").lookup_sync("8.8.8.8")
+    with pytest.raises(ValueError):
+        CloudCheck(path=json_path, url="https://example.com/signatures.json")
+
+
+def test_offline_without_cache(monkeypatch, tmp_path):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    cloudcheck = CloudCheck(offline=True)
+    with pytest.raises(RuntimeError):
+        cloudcheck.lookup_sync("8.8.8.8")
+
+
+@requires_extension
+def test_publish_and_attach_index(tmp_path):
+    json_path = Path(__file__).parent / "cloud_providers_v2.json"
+    publisher = CloudCheck(path=json_path)
+    index_path = tmp_path / "cloudcheck.idx"
+    publisher.publish_index(index_path)
+
+    worker = CloudCheck(index_path=index_path)
+    for target in ["8.8.8.8", "asdf.amazon.com", "asdf"]:
+        assert worker.lookup_sync(target) == publisher.lookup_sync(target)
+
+    with pytest.raises(RuntimeError):
+        CloudCheck(index_path=tmp_path / "missing.idx").lookup_sync("8.8.8.8")
+
+
+@requires_extension
+def test_stats():
+    json_path = Path(__file__).parent / "cloud_providers_v2.json"
+    cloudcheck = CloudCheck(path=json_path)
+    stats = cloudcheck.stats()
+    assert stats["lookups"] == 0
+    assert stats["last_load"] is None
+
+    cloudcheck.lookup_sync("8.8.8.8")
+    cloudcheck.lookup_sync("asdf")
+    cloudcheck.lookup_many_sync(["asdf.amazon.com"])
+    stats = cloudcheck.stats()
+    assert stats["lookups"] == 3
+    assert stats["hits"] == 2
+    assert stats["hit_rate"] == 2 / 3
+    assert stats["hits_by_provider"]["Google"] == 1
+    assert stats["hit_rate_by_tag"]["cloud"] == 2 / 3
+    assert sum(count for _, count in stats["lookup_latency"]) == 2
+    assert sum(count for _, count in stats["batch_latency"]) == 1
+    assert stats["lookup_latency"][-1][0] == float("inf")
+    assert stats["index_loads"] == 1
+    assert stats["last_load"]["parse_seconds"] > 0
+    assert stats["dataset_age_seconds"] >= 0
+    assert stats["index_memory_bytes"] > 0
+
+
+@requires_extension
+def test_filtered_index():
+    json_path = Path(__file__).parent / "cloud_providers_v2.json"
+    cloudcheck = CloudCheck(path=json_path, tags=["cdn", "waf"])
+    assert cloudcheck.lookup_sync("8.8.8.8") == []
+    names = [
+        provider["name"] for provider in cloudcheck.lookup_sync("asdf.cloudflare.com")
+    ]
+    assert names == ["Cloudflare"]
+
+    cloudcheck = CloudCheck(path=json_path, providers=["Amazon", "Google"])
+    assert cloudcheck.provider_names() == ["Amazon", "Google"]
+
+    with pytest.raises(RuntimeError):
+        CloudCheck(path=json_path, providers=["Amazn"]).lookup_sync("8.8.8.8")
+
+
+@requires_extension
+@pytest.mark.asyncio
+async def test_lookup_range():
+    cloudcheck = CloudCheck()
+    overlaps = await cloudcheck.lookup_range("8.8.0.0/16")
+    assert any(
+        overlap["prefix"].startswith("8.8.8.")
+        and overlap["providers"][0]["name"] == "Google"
+        for overlap in overlaps
+    )
+    assert 0 < sum(overlap["covered"] for overlap in overlaps) <= 2**16
+
+    results = cloudcheck.lookup_ranges_sync(["8.8.8.8/32", "127.0.0.0/8"])
+    assert results[0][0]["covered"] == 1
+    assert results[1] == []
+    assert await cloudcheck.lookup_ranges(["8.8.8.8/32"]) == results[:1]
+
+    with pytest.raises(RuntimeError):
+        cloudcheck.lookup_range_sync("amazon.com")
+
+
+@pytest.mark.asyncio
+async def test_pure_python_engine():
+    from cloudcheck import PureCloudCheck
+
+    json_path = Path(__file__).parent / "cloud_providers_v2.json"
+    cloudcheck = PureCloudCheck(path=json_path)
+    names = [provider["name"] for provider in await cloudcheck.lookup("8.8.8.8")]
+    assert names == ["Google"]
+    results = await cloudcheck.lookup_many(
+        ["asdf.amazon.com", "ASDF.Amazon.com", "asdf"]
+    )
+    assert [provider["name"] for provider in results[0]] == ["Amazon"]
+    assert results[1] == results[0]
+    assert results[2] == []
+    assert cloudcheck.lookup_sync("2001:4860:4860::8888")[0]["name"] == "Google"
+    assert cloudcheck.lookup_sync("8.8.8.0/24")[0]["name"] == "Google"
+    assert cloudcheck.lookup_sync("not a hostname") == []
+    assert "Amazon" in cloudcheck.provider_names()
+    assert "cdn" in cloudcheck.tag_names()
+
+    data = json_path.read_text()
+    assert PureCloudCheck(data=data).lookup_many_sync(["8.8.8.8"]) == [
+        cloudcheck.lookup_sync("8.8.8.8")
+    ]
+
+    # concurrent first lookups load the data once and all see the full index
+    cloudcheck = PureCloudCheck(path=json_path)
+    targets = ["8.8.8.8", "1.1.1.1", "asdf.amazon.com"]
+    batches = await asyncio.gather(
+        *[cloudcheck.lookup_many(targets) for _ in range(8)],
+        *[cloudcheck.lookup("8.8.8.8") for _ in range(8)],
+    )
+    names = [[[p["name"] for p in r] for r in batch] for batch in batches[:8]]
+    assert names == [[["Google"], ["Cloudflare"], ["Amazon"]]] * 8
+    assert all([p["name"] for p in r] == ["Google"] for r in batches[8:])
+
+
+def test_pure_python_engine_options(monkeypatch, tmp_path):
+    from cloudcheck import PureCloudCheck
+    from cloudcheck.pure import _cache_path
+
+    json_path = Path(__file__).parent / "cloud_providers_v2.json"
+    # the extension's options are accepted, and the ones it alone supports
+    # fail clearly instead of being ignored
+    for options in (
+        {"result_type": "provider"},
+        {"cache_size": 100},
+        {"tags": ["cdn"]},
+        {"providers": ["Amazon"]},
+        {"index_path": tmp_path / "cloudcheck.idx"},
+    ):
+        with pytest.raises(NotImplementedError):
+            PureCloudCheck(**options)
+    with pytest.raises(ValueError):
+        PureCloudCheck(result_type="asdf")
+    cloudcheck = PureCloudCheck(path=json_path, ttl=60)
+    assert cloudcheck.cache_stats() is None
+    with pytest.raises(NotImplementedError):
+        cloudcheck.stats()
+    with pytest.raises(NotImplementedError):
+        cloudcheck.lookup_range_sync("8.8.0.0/16")
+    assert cloudcheck.lookup_sync("ASDF.Amazon.com.") == cloudcheck.lookup_sync(
+        "asdf.amazon.com"
+    )
+
+    # load failures are RuntimeErrors, as in the extension
+    with pytest.raises(RuntimeError):
+        PureCloudCheck(data="not json").lookup_sync("8.8.8.8")
+    with pytest.raises(RuntimeError):
+        PureCloudCheck(path=tmp_path / "missing.json").lookup_sync("8.8.8.8")
+
+    # each URL has its own cache file
+    monkeypatch.setenv("HOME", str(tmp_path))
+    urls = ["https://example.com/first.json", "https://example.com/second.json"]
+    for url, name in zip(urls, ["First", "Second"]):
+        cache_path = _cache_path(url)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache_path.write_text(
+            json.dumps(
+                {
+                    name: {
+                        "name": name,
+                        "tags": [],
+                        "cidrs": ["1.0.0.0/8"],
+                        "domains": [],
+                    }
+                }
+            )
+        )
+    for url, name in zip(urls, ["First", "Second"]):
+        results = PureCloudCheck(url=url, offline=True).lookup_sync("1.1.1.1")
+        assert [provider["name"] for provider in results] == [name]
+
+
+@requires_extension
+def test_pure_python_engine_matches_extension():
+    from cloudcheck import PureCloudCheck
+
+    json_path = Path(__file__).parent / "cloud_providers_v2.json"
+    targets = [
+        "8.8.8.8",
+        "8.8.0.0/16",
+        "2001:4860:4860::8888",
+        "asdf.amazon.com",
+        "asdf.blob.core.windows.net",
+        "bücher.de",
+        "asdf",
+    ]
+    expected = CloudCheck(path=json_path).lookup_many_sync(targets)
+    assert PureCloudCheck(path=json_path).lookup_many_sync(targets) == expected
+
+
+def test_classify():
+    json_path = Path(__file__).parent / "cloud_providers_v2.json"
+    cloudcheck = CloudCheck(path=json_path)
+    log = (
+        b'8.8.8.8 - - [10/Oct/2000:13:55:36 -0700] "GET http://asdf.amazon.com/ HTTP/1.0" 200\n'
+        b"nothing here at 12:34:56 example.com\n"
+        b"2001:4860:4860::8888 connected to 127.0.0.1 and ASDF.Amazon.COM\n"
+    )
+    records = list(cloudcheck.classify([log]))
+    assert [line_number for line_number, _, _ in records] == [1, 3]
+    hits = {
+        token: [p["name"] for p in providers]
+        for token, providers in records[1][2].items()
+    }
+    assert hits == {"2001:4860:4860::8888": ["Google"], "asdf.amazon.com": ["Amazon"]}
+
+    # chunks split anywhere, tiny batches and windows give the same records
+    chunks = [log[i : i + 7] for i in range(0, len(log), 7)]
+    assert list(cloudcheck.classify(chunks, batch_size=1, window=1)) == records
+
+    records = list(cloudcheck.classify(log.decode().splitlines(True), only_hits=False))
+    assert len(records) == 3
+    assert records[1][2] == {"example.com": []}
+
+
+def test_extract_tokens():
+    from cloudcheck.classify import extract_tokens
+
+    # an address at the end of a sentence keeps its trailing period out
+    assert extract_tokens("connect to 8.8.8.8.") == ["8.8.8.8"]
+    assert extract_tokens("from 10.0.0.0/8. Then example.com.") == [
+        "10.0.0.0/8",
+        "example.com",
+    ]
+    assert extract_tokens("(8.8.8.8), 2001:db8::1.") == ["8.8.8.8", "2001:db8::1"]
+    # dotted numbers with more parts are not addresses
+    assert extract_tokens("OID 1.3.6.1.4.1 version 1.2.3.4.5") == []
+    assert extract_tokens("1.2.3.4a") == []
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_cli(workers, tmp_path, capsys):
+    from cloudcheck.cli import main
+
+    json_path = Path(__file__).parent / "cloud_providers_v2.json"
+    targets = ["8.8.8.8", "asdf.amazon.com", "asdf"] * 5
+    hosts = tmp_path / "hosts.txt"
+    hosts.write_text("\n".join(targets) + "\n\n")
+
+    args = [
+        str(hosts),
+        "--path",
+        str(json_path),
+        "--workers",
+        str(workers),
+        "--chunk-size",
+        "2",
+    ]
+    assert main(args + ["--ordered"]) == 0
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [record["target"] for record in records] == targets
+    assert records[0]["providers"][0]["name"] == "Google"
+    assert records[2]["providers"] == []
+
+    assert main(args + ["--format", "csv"]) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == "target,providers,tags"
+    expected = ["8.8.8.8,Google,cloud", "asdf.amazon.com,Amazon,cloud", "asdf,,"] * 5
+    assert sorted(lines[1:]) == sorted(expected)
+
+
+def test_bucket_hostnames():
+    from cloudcheck import BucketMatcher
+
+    matcher = BucketMatcher()
+    match = matcher.match_hostname("My.Bucket.s3-us-west-2.amazonaws.com.")
+    assert match == ("Amazon", "my.bucket", "s3-us-west-2.amazonaws.com")
+    assert matcher.match_hostname("acct.blob.core.windows.net").provider == "Microsoft"
+    assert matcher.match_hostname("proj.firebaseio.com").endpoint == "firebaseio.com"
+    assert matcher.match_hostname("www.example.com") is None
+    assert matcher.match_hostname("amazonaws.com") is None
+
+    hostnames = [
+        "www.example.com\n",
+        "bkt.r2.cloudflarestorage.com\n",
+        "spc.nyc3.digitaloceanspaces.com\n",
+    ]
+    matches = list(matcher.match_hostnames(hostnames))
+    assert [(hostname, match.provider) for hostname, match in matches] == [
+        ("bkt.r2.cloudflarestorage.com", "Cloudflare"),
+        ("spc.nyc3.digitaloceanspaces.com", "DigitalOcean"),
+    ]
+
+    # the regexes from cloud_providers_v2.json work too
+    json_path = Path(__file__).parent / "cloud_providers_v2.json"
+    providers = json.loads(json_path.read_text())
+    regexes = {
+        name: provider.get("regexes", {}) for name, provider in providers.items()
+    }
+    hostname = "acct.blob.core.windows.net"
+    assert BucketMatcher(regexes).match_hostname(hostname) == matcher.match_hostname(
+        hostname
+    )
+
+
+def test_valid_bucket_names():
+    from cloudcheck import BucketMatcher
+
+    matcher = BucketMatcher()
+    names = ["my-bucket\n", "my_bucket\n", "ab\n", "Upper\n", "x" * 64 + "\n"]
+    results = dict(matcher.valid_bucket_names(names, chunk_size=2))
+    assert set(results) == {"my-bucket", "my_bucket"}
+    assert {"Amazon", "DigitalOcean", "Google", "Microsoft"} <= results["my-bucket"]
+    assert "Google" in results["my_bucket"]
+    assert "DigitalOcean" not in results["my_bucket"]
+
+    results = list(
+        matcher.valid_bucket_names(
+            names, providers=["DigitalOcean"], include_invalid=True
+        )
+    )
+    assert [providers for _, providers in results] == [{"DigitalOcean"}] + [set()] * 4
+
+    # one pattern per provider would be 2**64 masks if they were all built up front
+    regexes = {
+        f"provider{i}": {"STORAGE_BUCKET_NAME": [f"[a-z]{{{i + 1}}}"]}
+        for i in range(64)
+    }
+    matcher = BucketMatcher(regexes)
+    results = dict(matcher.valid_bucket_names(["abc", "ab1"]))
+    assert results == {"abc": {"provider2"}}
+    results = dict(matcher.valid_bucket_names(["abc", "a"], providers=["provider0"]))
+    assert results == {"a": {"provider0"}}